@@ -0,0 +1,58 @@
+"""
+Recall@k and latency of the IVF + int8 index against a brute-force
+exact search (same scoring as the match_documents rpc) on a synthetic
+clustered corpus. Run from the repo root:
+    python -m benchmarks.ann
+"""
+# System
+import time
+# Local
+from src.services.ann import IvfIndex, normalize
+# Third party
+import numpy as np
+
+def synthetic_corpus(n: int, dims: int, topics: int, seed: int=0)->np.ndarray:
+    """
+    Clustered unit vectors, roughly like chunks from many tutorials
+    covering a smaller number of positions/techniques.
+    """
+    rng = np.random.default_rng(seed)
+    centers: np.ndarray = rng.normal(size=(topics, dims))
+    labels: np.ndarray = rng.integers(0, topics, size=n)
+    return normalize(centers[labels]+rng.normal(scale=0.6, size=(n, dims)))
+
+def brute_force(corpus: np.ndarray, query: np.ndarray, k: int)->np.ndarray:
+    # Exact cosine similarity top-k over every row
+    scores: np.ndarray = corpus@query
+    top: np.ndarray = np.argpartition(-scores, k-1)[:k]
+    return top[np.argsort(-scores[top])]
+
+def _main(n: int=50000, dims: int=768, queries: int=200, k: int=10):
+    rng = np.random.default_rng(1)
+    corpus: np.ndarray = synthetic_corpus(n, dims, topics=300)
+    # Queries are perturbed corpus rows, like a hyde close to some tutorials
+    probes: np.ndarray = normalize(corpus[rng.integers(0, n, size=queries)]+rng.normal(scale=0.5, size=(queries, dims)))
+
+    started: float = time.perf_counter()
+    index: IvfIndex = IvfIndex.build(corpus, [{'id': i} for i in range(n)])
+    print(f'Built index over {n}x{dims} in {time.perf_counter()-started:.1f}s '
+          f'({len(index.centroids)} cells, {index.codes.nbytes/2**20:.0f}MB int8 codes)')
+
+    started = time.perf_counter()
+    exact: list[set] = [set(brute_force(corpus, q, k).tolist()) for q in probes]
+    exactMs: float = (time.perf_counter()-started)*1000/queries
+    print(f'brute force: {exactMs:.2f}ms/query')
+
+    for nprobe in (1, 2, 4, 8, 16, 32):
+        started = time.perf_counter()
+        found: list[set] = [
+            {index.records[row]['id'] for row, __ in index.search(q, k=k, nprobe=nprobe)}
+            for q in probes
+        ]
+        ms: float = (time.perf_counter()-started)*1000/queries
+        recall: float = np.mean([len(f&e)/k for f, e in zip(found, exact)])
+        print(f'nprobe={nprobe:>3}: recall@{k}={recall:.3f} {ms:.2f}ms/query ({exactMs/ms:.1f}x)')
+    return
+
+if __name__=="__main__":
+    _main()
@@ -0,0 +1,86 @@
+"""
+Cold start of the API: import time of main (python -X importtime totals,
+slowest top level packages) and, with a real server, the time until the
+first request is answered and until /ready reports the warmup is done.
+Run from the repo root:
+    python -m benchmarks.cold_start [runs]
+"""
+# System
+import os
+import sys
+import time
+import socket
+import statistics
+import subprocess
+import urllib.request
+from urllib.error import URLError, HTTPError
+
+def import_time()->tuple[float, dict[str, float]]:
+    """
+    Seconds to import main in a fresh interpreter, and the
+    cumulative seconds of each top level package it imports.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            capture_output=True, text=True, check=True)
+    total: float = 0.0
+    packages: dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line: continue
+        __, cumulative, name = line[len('import time:'):].split('|')
+        # Nesting is shown by indentation, main's own imports are one level in
+        if name.startswith('   ') and not name.startswith('     '):
+            packages[name.strip()] = int(cumulative)/1e6
+        if name.strip()=='main': total = int(cumulative)/1e6
+    return total, packages
+
+def _free_port()->int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _poll(url: str, timeout: float, ok: tuple[int, ...]=(200,))->float|None:
+    started: float = time.perf_counter()
+    while time.perf_counter()-started<timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status in ok: return time.perf_counter()
+        except HTTPError: pass
+        except (URLError, ConnectionError, OSError): pass
+        time.sleep(0.02)
+    return None
+
+def first_request(timeout: float=20)->tuple[float|None, float|None]:
+    """
+    Start uvicorn and return the seconds until GET / is answered
+    and until GET /ready is 200 (None if it timed out).
+    """
+    port: int = _free_port()
+    started: float = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        root: float|None = _poll(f'http://127.0.0.1:{port}/', timeout)
+        ready: float|None = _poll(f'http://127.0.0.1:{port}/ready', timeout)
+    finally:
+        server.terminate()
+        server.wait()
+    return (root-started if root else None), (ready-started if ready else None)
+
+def _main(runs: int=3):
+    totals: list[float] = []
+    for __ in range(runs):
+        total, packages = import_time()
+        totals.append(total)
+    print(f'import main: median {statistics.median(totals):.3f}s over {runs} runs')
+    for name, seconds in sorted(packages.items(), key=lambda p: -p[1])[:8]:
+        print(f'\t{name:<40} {seconds:.3f}s')
+
+    root, ready = first_request()
+    print(f'first request: {root:.2f}s' if root!=None else 'first request: timed out')
+    # NOTE: Needs the .env keys, warmup doesn't report ready without the db
+    print(f'ready: {ready:.2f}s' if ready!=None else 'ready: timed out (check GET /ready errors)')
+    return
+
+if __name__=="__main__":
+    os.environ.setdefault('WARMUP_GEMINI_PING', '0')
+    _main(runs=int(sys.argv[1]) if len(sys.argv)>1 else 3)
@@ -0,0 +1,57 @@
+"""
+Top-k overlap of reduced-dimensionality search against full width search,
+for truncation and PCA at several widths. Uses the real embeddings table
+if supabase env vars are set (or a synthetic corpus with `synthetic`).
+Run from the repo root:
+    python -m benchmarks.dimensions [synthetic]
+"""
+# System
+import sys
+import time
+# Local
+from src.services.projection import Projection
+from src.services.ann import normalize
+from benchmarks.ann import synthetic_corpus, brute_force
+# Third party
+import numpy as np
+
+def overlap(corpus: np.ndarray, queries: np.ndarray, reduced: np.ndarray, reducedQueries: np.ndarray, k: int)->float:
+    # Mean fraction of full width top-k found by the reduced top-k
+    return float(np.mean([
+        len(set(brute_force(corpus, q, k).tolist()) & set(brute_force(reduced, r, k).tolist()))/k
+        for q, r in zip(queries, reducedQueries)
+    ]))
+
+def _main(synthetic: bool=False, k: int=10, queries: int=200):
+    if synthetic:
+        vectors: np.ndarray = synthetic_corpus(20000, 768, topics=300)
+    else:
+        from src.services.db import conn_supabase
+        from src.utils.index import fetch_embeddings
+        __, vectors = fetch_embeddings(conn_supabase())
+    corpus: np.ndarray = normalize(vectors)
+
+    # Hold out rows as queries, searching the rest
+    rng = np.random.default_rng(0)
+    held: np.ndarray = rng.choice(len(corpus), size=min(queries, len(corpus)//10), replace=False)
+    mask: np.ndarray = np.ones(len(corpus), dtype=bool)
+    mask[held] = False
+    probes, corpus = corpus[held], corpus[mask]
+    print(f'{len(corpus)} vectors, {len(probes)} queries, full width {corpus.shape[1]}')
+
+    for dims in (64, 128, 256, 384, 512):
+        for method in ('truncate', 'pca'):
+            projection: Projection = (
+                Projection.fit_pca(corpus, dims) if method=='pca'
+                else Projection.truncate(dims, input_dims=corpus.shape[1])
+            )
+            reduced: np.ndarray = projection.apply(corpus)
+            started: float = time.perf_counter()
+            score: float = overlap(corpus, probes, reduced, projection.apply(probes), k)
+            ms: float = (time.perf_counter()-started)*1000/len(probes)
+            print(f'{method:>8} {dims:>3} dims: top-{k} overlap={score:.3f} '
+                  f'{reduced.nbytes/2**20:.1f}MB ({ms:.2f}ms/query incl. full width search)')
+    return
+
+if __name__=="__main__":
+    _main(synthetic='synthetic' in sys.argv[1:])
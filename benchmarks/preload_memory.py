@@ -0,0 +1,67 @@
+"""
+Memory of the forked workers (serve.py) with and without preloading,
+with a synthetic local index loaded by every worker. Rss counts shared
+pages in each process, Pss splits them between the processes sharing
+them and Private is what each worker costs on its own. Linux only
+(reads /proc). Run from the repo root:
+    python -m benchmarks.preload_memory [workers] [vectors]
+"""
+# System
+import os
+import sys
+import time
+import signal
+import tempfile
+import subprocess
+# Local
+from benchmarks.ann import synthetic_corpus
+from benchmarks.cold_start import _free_port, _poll
+from src.services.ann import IvfIndex
+
+def _children(pid: int)->list[int]:
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(c) for c in f.read().split()]
+
+def _memory(pid: int)->dict[str, float]:
+    # MB of Rss, Pss and Private (clean+dirty) pages of a process
+    fields: dict[str, float] = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts: list[str] = line.split()
+            if len(parts)==3 and parts[2]=='kB': fields[parts[0].rstrip(':')] = int(parts[1])/1024
+    return {'rss': fields['Rss'], 'pss': fields['Pss'],
+            'private': fields['Private_Clean']+fields['Private_Dirty']}
+
+def measure(index: str, workers: int, preload: bool, timeout: float=60)->list[dict[str, float]]:
+    port: int = _free_port()
+    env: dict = {**os.environ, 'ANN_INDEX_PATH': index, 'ANN_INDEX_MMAP': '0', 'WARMUP_GEMINI_PING': '0'}
+    command: list[str] = [sys.executable, 'serve.py', '--port', str(port), '--workers', str(workers)]
+    if not preload: command.append('--no-preload')
+    master = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _poll(f'http://127.0.0.1:{port}/', timeout)
+        # Let every worker finish its startup/warmup
+        started: float = time.perf_counter()
+        while len(_children(master.pid))<workers and time.perf_counter()-started<timeout: time.sleep(0.1)
+        time.sleep(3)
+        return [_memory(pid) for pid in _children(master.pid)]
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait()
+
+def _main(workers: int=4, n: int=100000, dims: int=768):
+    with tempfile.TemporaryDirectory() as tmp:
+        index: str = os.path.join(tmp, 'index')
+        corpus = synthetic_corpus(n, dims, topics=300)
+        IvfIndex.build(corpus, [{'id': i, 'name': f'chunk {i}', 'video_id': str(i%5000)} for i in range(n)]).save(index)
+        print(f'index: {n}x{dims}, {sum(os.path.getsize(os.path.join(index, f)) for f in os.listdir(index))/2**20:.0f}MB on disk')
+        for preload in (False, True):
+            usage: list[dict[str, float]] = measure(index, workers, preload)
+            total: dict[str, float] = {k: sum(u[k] for u in usage) for k in ('rss', 'pss', 'private')}
+            print(f"{'preload' if preload else 'no preload':<11} {len(usage)} workers: "
+                  f"rss {total['rss']:.0f}MB, pss {total['pss']:.0f}MB, private {total['private']:.0f}MB "
+                  f"({total['private']/max(1, len(usage)):.0f}MB per worker)")
+    return
+
+if __name__=="__main__":
+    _main(*(int(a) for a in sys.argv[1:3]))
@@ -0,0 +1,79 @@
+"""
+Latency of /solve and /tutorials replayed from a recorded cassette
+(services.cassette), to profile and regression test performance work
+offline against real payloads. Requests are a json list of
+{"path": "/solve/", "body": {...}} sent in order. Run from the repo root:
+    python -m benchmarks.replay record cassettes/solve.jsonl requests.json
+    python -m benchmarks.replay replay cassettes/solve.jsonl requests.json [latency] [runs]
+NOTE: Recording calls the real services (needs the .env keys), replays
+only serve identical requests (CASSETTE_MATCH=kind to relax it)
+"""
+# System
+import os
+import sys
+import json
+import time
+import statistics
+
+def _send(requests: list[dict])->list[tuple[str, int, float]]:
+    # Imported here, the cassette mode is read when the modules load
+    from fastapi.testclient import TestClient
+    from main import app
+    client = TestClient(app)
+    timings: list[tuple[str, int, float]] = []
+    for request in requests:
+        started: float = time.perf_counter()
+        response = client.post(request['path'], json=request['body'])
+        timings.append((request['path'], response.status_code, time.perf_counter()-started))
+    return timings
+
+def summarize(cassette: str)->None:
+    """
+    Print the recorded calls per kind: count, payload sizes and latency.
+    """
+    kinds: dict[str, list[dict]] = {}
+    with open(cassette) as f:
+        for line in f:
+            if line.strip():
+                entry: dict = json.loads(line)
+                kinds.setdefault(entry['kind'], []).append(entry)
+    print(f'{cassette}: {sum(len(e) for e in kinds.values())} calls')
+    for kind, entries in sorted(kinds.items()):
+        seconds: list[float] = [e['seconds'] for e in entries]
+        print(f"\t{kind:<60} x{len(entries):<4} req {statistics.mean(e['request_bytes'] for e in entries)/1024:.1f}KB "
+              f"resp {statistics.mean(e['response_bytes'] for e in entries)/1024:.1f}KB "
+              f"p50 {statistics.median(seconds)*1000:.0f}ms max {max(seconds)*1000:.0f}ms")
+    return
+
+def _main(mode: str, cassette: str, path: str, latency: float=0.0, runs: int=3):
+    with open(path) as f: requests: list[dict] = json.load(f)
+    os.environ['CASSETTE_MODE'] = mode
+    os.environ['CASSETTE_PATH'] = cassette
+    os.environ['CASSETTE_LATENCY'] = str(latency)
+    # NOTE: The warm answer store and checkpoints would skip the recorded calls
+    os.environ.pop('ANSWERS_PATH', None)
+    os.environ['SOLVE_CHECKPOINT_TTL'] = '0'
+    if mode=='record':
+        if os.path.exists(cassette): os.remove(cassette)
+        for endpoint, code, seconds in _send(requests):
+            print(f'{endpoint} {code} {seconds:.2f}s')
+        summarize(cassette)
+        return
+
+    # Every run replays the whole list, first run includes imports/warm caches
+    perRequest: dict[int, list[float]] = {}
+    for run in range(runs):
+        for i, (endpoint, code, seconds) in enumerate(_send(requests)):
+            perRequest.setdefault(i, []).append(seconds)
+            if run==0 and code!=200: print(f'{endpoint} returned {code}')
+    print(f'replay x{runs} at {latency}x recorded latency')
+    for i, seconds in perRequest.items():
+        print(f"\t{i:<3} {requests[i]['path']:<12} median {statistics.median(seconds)*1000:.1f}ms "
+              f"min {min(seconds)*1000:.1f}ms")
+    from src.services.metrics import snapshot
+    counters: dict = snapshot()['counters']
+    print({k: v for k, v in counters.items() if k.startswith('cassette.')})
+    return
+
+if __name__=="__main__":
+    _main(sys.argv[1], sys.argv[2], sys.argv[3], *(float(a) for a in sys.argv[4:5]), *(int(a) for a in sys.argv[5:6]))
@@ -0,0 +1,72 @@
+"""
+Latency and output validity of the default (five stage) and fast
+(single call after grounding) /solve pipeline modes, on real Gemini
+and Supabase clients (needs the .env keys). Run from the repo root:
+    python -m benchmarks.solve_modes [runs]
+"""
+# System
+import sys
+import json
+import time
+import statistics
+# Local
+from src.models.general import Graph
+from src.services.llm import conn_gemini
+from src.services.db import conn_supabase, get_techniques_cached
+from src.services.pipeline import solve_problem
+
+PROBLEMS: list[str] = [
+    "Show me different ways to break an opponents closed guard when i'm on top and pass it to end up in side control or mount.",
+    "I keep getting stuck under side control, how do I escape and recover guard?",
+    "What are some submissions I can hit from mount when my opponent turns to their side?",
+    "How do I take the back from half guard bottom in no-gi?",
+]
+
+def validate(graph: Graph, techniqueIds: set[int])->list[str]:
+    """
+    Return the problems with a generated graph (empty if valid):
+    unknown techniques, dangling edges, or not exactly one root.
+    """
+    errors: list[str] = []
+    nodeIds: set[int] = {node.id for node in graph.nodes}
+    if len(nodeIds)!=len(graph.nodes): errors.append('duplicate node ids')
+    if any(node.technique_id not in techniqueIds for node in graph.nodes): errors.append('unknown technique')
+    if any(e.source_id not in nodeIds or e.target_id not in nodeIds for e in graph.edges): errors.append('dangling edge')
+    roots: set[int] = nodeIds-{e.target_id for e in graph.edges}
+    if len(roots)!=1: errors.append(f'{len(roots)} roots')
+    if len(graph.nodes)>10: errors.append('over 10 nodes')
+    if any(not e.note for e in graph.edges): errors.append('missing notes')
+    return errors
+
+def _main(runs: int=1):
+    gemini = conn_gemini()
+    supabase = conn_supabase()
+    techniqueIds: set[int] = {t['id'] for t in json.loads(get_techniques_cached(supabase))}
+
+    for mode in ('default', 'fast'):
+        latencies: list[float] = []
+        valid: int = 0
+        failed: int = 0
+        for __ in range(runs):
+            for problem in PROBLEMS:
+                started: float = time.perf_counter()
+                try:
+                    graph, __ = solve_problem(gemini, supabase, problem, mode=mode)
+                except Exception as e:
+                    failed += 1
+                    print(f'\t{mode}: failed ({str(e)[:80]})')
+                    continue
+                latencies.append(time.perf_counter()-started)
+                errors: list[str] = validate(graph, techniqueIds)
+                if len(errors)<=0: valid += 1
+                else: print(f'\t{mode}: invalid graph ({", ".join(errors)})')
+        total: int = runs*len(PROBLEMS)
+        if len(latencies)<=0:
+            print(f'{mode:>8}: all {total} runs failed')
+            continue
+        print(f'{mode:>8}: median {statistics.median(latencies):.1f}s '
+              f'max {max(latencies):.1f}s valid {valid}/{total} failed {failed}/{total}')
+    return
+
+if __name__=="__main__":
+    _main(runs=int(sys.argv[1]) if len(sys.argv)>1 else 1)
@@ -1,21 +1,46 @@
 # System
-import json
-from typing import Annotated
+import asyncio
+import threading
+from typing import Annotated, Literal, Callable, TYPE_CHECKING
+from contextlib import asynccontextmanager
 # Local
-from src.models.general import UserQuery, Sequence, Graph, Video
+from src.models.general import UserQuery, Graph, ExpandedGraph, Video, BatchResult, BatchResponse
 from src.models.reactflow import Node, Edge
-from src.services.llm import conn_gemini, create_paragraph, create_embedding, ground, extract_sequences, create_flowchart, rename_add_notes, extract_paragraph
-from src.services.db import conn_supabase, similarity_search, get_techniques, get_user_limit, get_usage, log_use, get_video
+from src.services.llm import conn_gemini, create_embedding, extract_paragraph
+from src.services.db import conn_supabase, get_technique_details, similarity_search, get_user_limit, get_usage, log_use, get_video, get_videos_cached
+from src.services.rerank import diversify
+from src.services.metrics import snapshot
+from src.services.pipeline import BATCH_CONCURRENCY, BATCH_MAX_ITEMS, solve_problem, solve_batch, StageError
+from src.services.scheduler import Overloaded, llm_user
+from src.services.router import DeadlineExceeded, route, router
+from src.services.cancel import Cancelled, cancellation, watch_disconnect
+from src.services.serialize import GRAPH, EXPANDED_GRAPH, VIDEOS, BATCH, JsonResponse, json_response, dumps
+from src.services.compression import CompressionMiddleware
+from src.services.profiler import ProfilerMiddleware, profiling_enabled
+from src.services.warmup import warmup, is_ready, running, status as warmup_status
 # Third party
-# import uvicorn # NOTE: Commented out for production
-from fastapi import FastAPI, Depends, HTTPException, status, Body
-from google.genai import Client as LlmClient
-from supabase import Client as DbClient
+from fastapi import FastAPI, Depends, HTTPException, status, Body, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+# NOTE: The SDKs are imported on first use (see services.lazy),
+# their client types are only needed by type checkers here
+if TYPE_CHECKING:
+    from google.genai import Client as LlmClient
+    from supabase import Client as DbClient
+else: LlmClient = DbClient = object
 # For cross origin resource sharing
 from fastapi.middleware.cors import CORSMiddleware
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Warm up in the background so the port is bound right away
+    # NOTE: GET /ready reports 503 until it's done (services.warmup)
+    app.state.warmup = asyncio.create_task(run_in_threadpool(warmup))
+    yield
+
 # Initialize fast APi
-app = FastAPI()
+# NOTE: Responses are rendered with orjson, see services.serialize
+app = FastAPI(default_response_class=JsonResponse, lifespan=lifespan)
 
 
 origins = [
@@ -30,12 +55,36 @@ app.add_middleware(
     allow_methods=["GET", "POST"],
     allow_headers=["*"],
 )
+# Compress large responses (brotli or gzip), e.g. graphs with long notes
+app.add_middleware(CompressionMiddleware)
+# Per request profiling for admins (X-Profile header), see services.profiler
+# NOTE: Only installed when configured, no overhead otherwise
+if profiling_enabled(): app.add_middleware(ProfilerMiddleware)
+
+def overloaded(e: Overloaded)->HTTPException:
+    """
+    Convert a rejected LLM call into a 503 telling
+    the client when it's worth trying again.
+    """
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail=f'Too many requests in progress, try again in {e.retry_after} seconds.',
+        headers={'Retry-After': str(e.retry_after)}
+    )
 
 # Placeholder endpoint for webservice root
 @app.get('/')
 async def root():
     return {"message": "Hello world"}
 
+# Readiness for the platform's health checks (root is liveness)
+@app.get('/ready')
+async def ready():
+    # Retry a failed warmup (e.g. the db was briefly unreachable)
+    if not is_ready() and not running():
+        app.state.warmup = asyncio.create_task(run_in_threadpool(warmup))
+    return JsonResponse(warmup_status(), status_code=200 if is_ready() else 503)
+
 @app.get('/sample', response_model=Graph)
 def sample():
     """
@@ -97,6 +146,13 @@ def sample():
     }
     return Graph(**data)
 
+# Endpoint for inspecting pipeline metrics
+# e.g. prompt budget used per stage
+@app.get('/metrics')
+def metrics():
+    # Include the router's current latency estimates per model
+    return {**snapshot(), 'latency': router.snapshot()}
+
 # Endpoint for returning a given user_id's usage data
 # with boolean vaue determining whether or not they can use the ask ai feature
 @app.get("/usage/{user_id}")
@@ -124,163 +180,258 @@ def usage(
     return {'limit': limit, 'used': used, 'allowed': allowed}
 
 # Actual endpoint for processing a given user problem
-@app.post('/solve/', response_model=Graph)
-def solve(
+# NOTE: Async so the client connection can be watched while
+# the (sync) pipeline runs in the threadpool, see _solve below
+@app.post('/solve/', response_model=Graph|ExpandedGraph)
+async def solve(
         query: Annotated[UserQuery, Body()],
+        request: Request,
         gemini: Annotated[LlmClient, Depends(conn_gemini)],
         supabase: Annotated[DbClient, Depends(conn_supabase)],
+        mode: Literal['default', 'fast']|None = None,
+        expand: Literal['techniques']|None = None,
     ):
     """
     Given a problem faced by the user in their jiu-jitsu practice,
     return a jitsu-journal friendly directed graph/flowchart.
     Passed into the app for creating initial nodes and edges.
+    Set mode=fast to build the named graph in a single call after
+    grounding (defaults to the SOLVE_MODE config).
+    Set expand=techniques to include the name, description and tags
+    of the graph's techniques (saves the client a techniques query).
     """
-
+    # Cancel remaining stages if the client disconnects (e.g. closed tab)
+    disconnected = threading.Event()
+    watcher = asyncio.create_task(watch_disconnect(request, disconnected))
+    try:
+        renamed: Graph = await run_in_threadpool(_solve, query, gemini, supabase, disconnected, mode)
+        if expand=='techniques':
+            expanded: ExpandedGraph|Graph = await run_in_threadpool(expand_techniques, renamed, supabase)
+            if isinstance(expanded, ExpandedGraph): return json_response(EXPANDED_GRAPH, expanded)
+        # Serialized in one pass with the cached adapter
+        return json_response(GRAPH, renamed)
+    finally:
+        watcher.cancel()
+
+def expand_techniques(graph: Graph, supabase: DbClient)->ExpandedGraph|Graph:
+    """
+    Add a side table with the details of every technique the graph's nodes
+    reference, from the cached catalog (the one passed to the flowchart
+    stage). Returns the graph as is if the catalog couldn't be loaded.
+    """
+    try:
+        techniques: dict[int, dict] = get_technique_details(supabase, [node.technique_id for node in graph.nodes])
+    except Exception:
+        # NOTE: Without the side table the client fetches the techniques itself
+        return graph
+    return ExpandedGraph(name=graph.name, nodes=graph.nodes, edges=graph.edges, techniques=techniques)
+
+def _solve(query: UserQuery, gemini: LlmClient, supabase: DbClient,
+        disconnected: threading.Event, mode: str|None=None
+    )->Graph:
     # Before processing the request,
     # we first check if the user is within their rate limit
-    used: int = get_usage(supabase, query.user_id)
-    limit: int = get_user_limit(supabase, query.user_id)
+    _check_usage(supabase, query.user_id)
+    return _run_solve(query, gemini, supabase, disconnected, mode)
+
+def _check_usage(supabase: DbClient, user_id: str)->None:
+    used: int = get_usage(supabase, user_id)
+    limit: int = get_user_limit(supabase, user_id)
     if not used<limit:
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             detail=f'Usage limit exceeded for the current period.'
         )
+    return
 
+def _run_solve(query: UserQuery, gemini: LlmClient, supabase: DbClient,
+        disconnected: threading.Event, mode: str|None=None,
+        emit: Callable[[dict], None]|None=None
+    )->Graph:
+    # Run the pipeline with calls attributed to the user for fair queueing
     try:
-        # Create a hypothetical solution using the users problem
-        hypothetical: str = create_paragraph(gemini, query.problem).text
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to create hyde. Error: {str(e)}'
-        )
+        with llm_user(query.user_id), cancellation(disconnected):
+            renamed, metadata = solve_problem(gemini, supabase, query.problem,
+                                              user_id=query.user_id, mode=mode, emit=emit)
+    except (Cancelled, Overloaded, DeadlineExceeded, StageError) as e:
+        raise solve_error(e)
 
-    # Create embedding using the hypothetical solution
-    # Used for searching tutorials with similar content
-    try:
-        embedding = create_embedding(gemini, paragraph=hypothetical)
-        vector: list[float] = embedding.embeddings[0].values
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to embedd. Error: {str(e)}'
-        )
-    
-    try:
-        # Retrive similar records to the generated solution from Supabase
-        # NOTE: Using default match threshold and count for searching
-        similar = similarity_search(client=supabase, vector=vector)
-        # Flatten into a json string to pass to LLM for grounding
-        paragraphs: str = json.dumps([{
-                'name': sequence['name'],
-                'paragraph': sequence['content']
-            } for sequence in similar.data]
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to perform vector search. Error: {str(e)}'
-        )
+    # If response and graph was successfully generated
+    # increment the usage count before returning response to the user
+    log_use(client=supabase, userid=query.user_id, metadata=metadata)
 
+    # Return generated directed graph/flowchart to the user
+    # FastAPI automatically dumps the response model obj as JSON
+    return renamed
 
-    # Use top-k records in similar
-    # to gound the hypothetical result
-    try:
-        grounded = ground(client=gemini, problem=query.problem, 
-                        solution=hypothetical, similar=paragraphs)
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to ground generated solution. Error: {str(e)}'
+def solve_error(e: Exception)->HTTPException:
+    """
+    Convert an error raised by the pipeline into
+    the status code and detail returned to the user.
+    """
+    if isinstance(e, HTTPException): return e
+    elif isinstance(e, Cancelled):
+        # Nobody is waiting for the response, skip logging usage
+        # NOTE: 499 (client closed request) is only seen in server logs
+        return HTTPException(status_code=499, detail='Client disconnected.')
+    elif isinstance(e, Overloaded):
+        return overloaded(e)
+    elif isinstance(e, DeadlineExceeded):
+        return HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f'Took too long to solve the problem ({e.stage}), please try again.'
         )
-
-
-    # Convert grounded answer into steps in a sequence
-    try:
-        extracted: list[Sequence] = extract_sequences(client=gemini, paragraph=grounded.text).parsed
-    
-        flattened: list[dict] = [sequence.model_dump() for sequence in extracted]
-
-        # iterate over parsed sequences and dump into dict
-        # for passing back into model as json string
-        sequences: str = json.dumps(flattened)
-    except Exception as e:
-        raise HTTPException(
+    elif isinstance(e, StageError):
+        return HTTPException(
             status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to extract steps from generated solution. Error: {str(e)}'
+            detail=e.detail
         )
-
-
-    try:
-        # Load techniques into memory for passing as context in next stage
-        # Using the DB service to fetch from Supabase (w/ joins for tags and cat IDs)
-        techniques = get_techniques(client=supabase)
-    except Exception as e:
+    return HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail='Unexpected error when solving the problem.'
+    )
+
+# Batch variant of /solve for bulk generation (curriculum generation,
+# cache warming, QA runs...), each stage is run across all the problems
+# together instead of N separate requests, see pipeline.solve_batch
+# NOTE: Returns 200 with a result per problem, failed ones have
+# the status and detail /solve would have returned for them
+@app.post('/solve/batch/', response_model=BatchResponse)
+async def solve_batch_endpoint(
+        queries: Annotated[list[UserQuery], Body()],
+        request: Request,
+        gemini: Annotated[LlmClient, Depends(conn_gemini)],
+        supabase: Annotated[DbClient, Depends(conn_supabase)],
+        mode: Literal['default', 'fast']|None = None,
+        concurrency: int|None = None,
+    ):
+    """
+    Given a list of problems (each with its user), return a graph or
+    an error per problem, in the same order. At most `concurrency`
+    problems (capped by the BATCH_CONCURRENCY config) are solved at once.
+    """
+    if len(queries)>BATCH_MAX_ITEMS:
         raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to get techniques from DB. Error: {str(e)}'
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f'At most {BATCH_MAX_ITEMS} problems per batch.'
         )
-
+    concurrency = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
+    disconnected = threading.Event()
+    watcher = asyncio.create_task(watch_disconnect(request, disconnected))
     try:
-        # Use grounded steps with retrieved techniques
-        # and create a basic lightweight directed graph
-        flowchart: Graph = create_flowchart(client=gemini, problem=query.problem,
-                                            sequences=sequences, techniques=techniques).parsed
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to create flowchart using extracted steps. Error: {str(e)}'
-        )
+        response: BatchResponse = await run_in_threadpool(
+            _solve_batch, queries, gemini, supabase, disconnected, mode, concurrency)
+        return json_response(BATCH, response)
+    finally:
+        watcher.cancel()
+
+def _solve_batch(queries: list[UserQuery], gemini: LlmClient, supabase: DbClient,
+        disconnected: threading.Event, mode: str|None, concurrency: int
+    )->BatchResponse:
+    results: list[BatchResult|None] = [None]*len(queries)
+    # Problems past their user's remaining usage are rejected up front
+    remaining: dict[str, int|None] = {}
+    for userId in dict.fromkeys(q.user_id for q in queries):
+        try: remaining[userId] = get_user_limit(supabase, userId)-get_usage(supabase, userId)
+        except Exception: remaining[userId] = None
+    accepted: list[int] = []
+    for i, query in enumerate(queries):
+        if remaining[query.user_id]==None:
+            results[i] = BatchResult(index=i, status=status.HTTP_424_FAILED_DEPENDENCY,
+                                     detail='Unexpected error when checking usage.')
+        elif remaining[query.user_id]<=0:
+            results[i] = BatchResult(index=i, status=status.HTTP_429_TOO_MANY_REQUESTS,
+                                     detail='Usage limit exceeded for the current period.')
+        else:
+            remaining[query.user_id] -= 1
+            accepted.append(i)
 
-    if flowchart==None:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail='Failed to create flowchart, null response.'
-        )
-    elif flowchart.nodes==None or len(flowchart.nodes)<=0:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail='No nodes generated.'
-        )
-    elif flowchart.edges==None or len(flowchart.edges)<=0:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail='No edges generated.'
-        )
-    
-    
-    # If flowchart was created successfully without errors
-    # We pass the flowchart back into a model to 
-    # Update the flowchart names and notes
     try:
-        renamed: Graph = rename_add_notes(
-            client=gemini, problem=query.problem,
-            flowchart=flowchart.model_dump_json(),
-            sequences=sequences, similar=paragraphs,
-            techniques=techniques
-        ).parsed
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_424_FAILED_DEPENDENCY,
-            detail=f'Failed to rename flowchart and create notes: {str(e)}'
-        )
-
-    # Setup the metadata with pipeline's data above
-    # this is passed to the log_use func and stored in DB for reference
-    metadata:dict = {
-        'problem': query.problem,
-        'hyde': hypothetical,
-        'grounded': grounded.text,
-        'sequences': flattened,
-    }
-
-    # If response and graph was successfully generated
-    # increment the usage count before returning response to the user
-    log_use(client=supabase, userid=query.user_id, metadata=metadata)
-
-    # Return generated directed graph/flowchart to the user
-    # FastAPI automatically dumps the response model obj as JSON
-    return renamed
+        with cancellation(disconnected):
+            outcomes: list = solve_batch(gemini, supabase, [queries[i].problem for i in accepted],
+                                         user_ids=[queries[i].user_id for i in accepted],
+                                         mode=mode, concurrency=concurrency)
+    except (Cancelled, Overloaded) as e:
+        raise solve_error(e)
+    if disconnected.is_set(): raise solve_error(Cancelled())
+
+    for i, outcome in zip(accepted, outcomes):
+        if isinstance(outcome, Exception):
+            error: HTTPException = solve_error(outcome)
+            results[i] = BatchResult(index=i, status=error.status_code, detail=error.detail)
+            continue
+        renamed, metadata = outcome
+        # Usage is only counted for the problems that were solved
+        log_use(client=supabase, userid=queries[i].user_id, metadata=metadata)
+        results[i] = BatchResult(index=i, status=status.HTTP_200_OK, graph=renamed)
+    solved: int = sum(r.status==status.HTTP_200_OK for r in results)
+    return BatchResponse(results=results, solved=solved, failed=len(results)-solved)
+
+# Streaming variant of /solve, sending newline delimited json events
+# NOTE: Events are {event, stage, data}: 'stage' when a graph stage starts,
+# 'name'/'node'/'edge' as soon as each is generated by the flowchart and
+# rename stages (the frontend can start drawing the draft flowchart),
+# then the validated 'graph' or an 'error' {status, detail} to end the stream
+@app.post('/solve/stream/')
+async def solve_stream(
+        query: Annotated[UserQuery, Body()],
+        request: Request,
+        gemini: Annotated[LlmClient, Depends(conn_gemini)],
+        supabase: Annotated[DbClient, Depends(conn_supabase)],
+        mode: Literal['default', 'fast']|None = None,
+        expand: Literal['techniques']|None = None,
+    ):
+    """
+    Same as /solve, streaming the graph's nodes and edges as they're
+    generated instead of waiting for the whole flowchart.
+    With expand=techniques, the final graph event has the techniques table.
+    """
+    # Rate limit errors are still returned as a status code
+    await run_in_threadpool(_check_usage, supabase, query.user_id)
+
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+    disconnected = threading.Event()
+
+    def push(line: str|None)->None:
+        # Called from the pipeline's threads
+        loop.call_soon_threadsafe(events.put_nowait, line)
+
+    def emit(event: dict)->None:
+        # Serialized in the calling thread, off the event loop
+        push(dumps(event)+'\n')
+
+    def run()->None:
+        try:
+            renamed: Graph = _run_solve(query, gemini, supabase, disconnected, mode, emit=emit)
+            if expand=='techniques': renamed = expand_techniques(renamed, supabase)
+            adapter = EXPANDED_GRAPH if isinstance(renamed, ExpandedGraph) else GRAPH
+            push('{"event":"graph","data":'+adapter.dump_json(renamed).decode()+'}\n')
+        except HTTPException as e:
+            emit({'event': 'error', 'status': e.status_code, 'detail': e.detail})
+        except Exception:
+            emit({'event': 'error', 'status': 500, 'detail': 'Unexpected error when solving the problem.'})
+        finally:
+            # End of stream
+            push(None)
+        return
+
+    async def lines():
+        worker = asyncio.ensure_future(run_in_threadpool(run))
+        try:
+            while True:
+                line: str|None = await events.get()
+                if line==None: break
+                yield line
+        finally:
+            # Stops the pipeline if the client went away mid stream
+            # NOTE: Starlette cancels this generator on disconnect,
+            # the thread stops on its own, the task isn't left pending
+            disconnected.set()
+            worker.cancel()
+        return
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
 
 
 @app.post('/tutorials/', response_model=list[Video])
@@ -288,6 +439,7 @@ def tutorials(
         nodes: list[Node], edges: list[Edge],
         gemini: Annotated[LlmClient, Depends(conn_gemini)],
         supabase: Annotated[DbClient, Depends(conn_supabase)],
+        request: Request, user_id: Annotated[str|None, Body()]=None,
     ):
     """
     Given lightweight react-flow nodes and edges with the technique names
@@ -297,20 +449,27 @@ def tutorials(
     The unique list of tutorials with metadata is sent to the user/frontend,
     usually for rendering videoCards showing recommended tutorials.
     """
+    # Calls are queued fairly per user like /solve, falling back
+    # to the client's address for requests without a user_id
+    # NOTE: Optional so existing clients keep working
+    caller: str = user_id or f'ip:{request.client.host if request.client else "unknown"}'
+
     # Convert nodes and edges into strings
     # for passing down to LLM
     try:
-        str_nodes: str = json.dumps([n.model_dump() for n in nodes])
-        str_edges: str = json.dumps([e.model_dump() for e in edges])
+        str_nodes: str = dumps([n.model_dump() for n in nodes])
+        str_edges: str = dumps([e.model_dump() for e in edges])
     except: raise HTTPException(status.HTTP_406_NOT_ACCEPTABLE, detail="Failed to parse inputs for extracting paragraphs")
 
     # Pass nodes/edges to extract paragraph 
     # and retrieve paragraphs representing going from
     # each root node to the leaf, taking notes into account
     try:
-        extracted: list[str] = extract_paragraph(
-            client=gemini, nodes=str_nodes, edges=str_edges
-        ).parsed
+        with llm_user(caller):
+            extracted: list[str] = route('paragraph', lambda model: extract_paragraph(
+                client=gemini, nodes=str_nodes, edges=str_edges, model=model
+            )).parsed
+    except Overloaded as e: raise overloaded(e)
     except: raise HTTPException(status.HTTP_424_FAILED_DEPENDENCY, detail="Failed to extract paragraphs.")
 
     # Iterate over each paragraph in extracted
@@ -318,65 +477,72 @@ def tutorials(
     # unique tutorials metadata in dict below
     # NOTE: Will be turned to list[Video] before returning
     tutorials: dict[str, Video] = {}
+    # Video metadata from the cached snapshot, queried if missing
+    # NOTE: Fetched once per request, the sqlite cache unpickles it on every get
+    try: videos: dict[str, dict] = get_videos_cached(supabase)
+    except Exception: videos = {}
     try:
-        for paragraph in extracted:
+        # NOTE: Continues the request above in the caller's queue
+        with llm_user(caller, inflight=True):
+            for paragraph in extracted:
             
-            # Create an embedded representation for each branch/paragraph
-            try:
-                embedding: list[float] = create_embedding(gemini, paragraph).embeddings[0].values
-            except:
-                # Skip the current paragraph if we failed to generate embedding
-                # TODO/NOTE: Handle the case of empty below and throw error or log
-                continue
+                # Create an embedded representation for each branch/paragraph
+                try:
+                    embedding: list[float] = route('embed', lambda model: create_embedding(
+                        gemini, paragraph, model=model)).embeddings[0].values
+                except:
+                    # Skip the current paragraph if we failed to generate embedding
+                    # TODO/NOTE: Handle the case of empty below and throw error or log
+                    continue
             
-            # Perform a similarity search to retrive simlar sequences
-            try:
-                similar: list[dict] = similarity_search(client=supabase, vector=embedding, 
-                                            match_threshold=0.75, match_count=5).data
-            except:
-                # Skip the current paragraph if we failed to perform sim. search
-                # TODO/NOTE: Handle the case of empty below and throw error or log
-                continue
-
-            # If similar exists, iterate over the sequences and 
-            # use their tutorial id's to get metadata from video table
-            for sequence in similar:
-                # Isolate the sequences videoId
-                # and use it to retrieve the video metadata
+                # Perform a similarity search to retrive simlar sequences
                 try:
-                    videoId: str = sequence['video_id']
-                    # If it's data doesn't already exist in the tutorials dict
-                    if videoId not in tutorials: # checks keys
-                        # Use the unique video id to get the video metadata
-                        # from the videos table and pack into the video model/object
-                        videoInfo: dict = get_video(client=supabase, id=videoId).data[0]
-                        video = Video(
-                            id=videoId, title=videoInfo['title'],
-                            description=videoInfo['description'],
-                            uploaded_at=videoInfo['uploaded_at'],
-                            uploaded_by=videoInfo['uploaded_by'],
-                            thumbnail=videoInfo['thumbnail'],
-                        )
-                        # set video id as key and model as value 
-                        # to add to the tutorials dict
-                        tutorials[videoId] = video
+                    # NOTE: Over-fetch and rerank, keeping one chunk per tutorial
+                    candidates: list[dict] = similarity_search(client=supabase, vector=embedding, 
+                                                match_threshold=0.75, match_count=15).data
+                    similar: list[dict] = diversify(client=supabase, query=embedding,
+                                                similar=candidates, k=5, max_per_video=1)
                 except:
-                    # Skip the current similar sequence if we failed to get metadata
-                    # TODO/NOTE: Handle the case of empty below and throw error or log                
+                    # Skip the current paragraph if we failed to perform sim. search
+                    # TODO/NOTE: Handle the case of empty below and throw error or log
                     continue
 
+                # If similar exists, iterate over the sequences and 
+                # use their tutorial id's to get metadata from video table
+                for sequence in similar:
+                    # Isolate the sequences videoId
+                    # and use it to retrieve the video metadata
+                    try:
+                        videoId: str = sequence['video_id']
+                        # If it's data doesn't already exist in the tutorials dict
+                        if videoId not in tutorials: # checks keys
+                            # Use the unique video id to get the video metadata
+                            # from the videos table and pack into the video model/object
+                            videoInfo: dict|None = videos.get(videoId)
+                            if videoInfo==None: videoInfo = get_video(client=supabase, id=videoId).data[0]
+                            video = Video(
+                                id=videoId, title=videoInfo['title'],
+                                description=videoInfo['description'],
+                                uploaded_at=videoInfo['uploaded_at'],
+                                uploaded_by=videoInfo['uploaded_by'],
+                                thumbnail=videoInfo['thumbnail'],
+                            )
+                            # set video id as key and model as value 
+                            # to add to the tutorials dict
+                            tutorials[videoId] = video
+                    except:
+                        # Skip the current similar sequence if we failed to get metadata
+                        # TODO/NOTE: Handle the case of empty below and throw error or log                
+                        continue
+
     except: raise HTTPException(status.HTTP_424_FAILED_DEPENDENCY, detail="Unexpected error when retrieving videos")
     
     # Flatten data into a list of Video objects
     # to match the response model defined in the tutorials endpoint
     output: list[Video] = list(tutorials.values())
 
-    return output
+    return json_response(VIDEOS, output)
 
 
-# NOTE: Commented out driver code to avoid collisions 
-# with production env. Can be uncommeneted when testing.
-"""
-if __name__=="__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
-"""
\ No newline at end of file
+# NOTE: Served by serve.py (preloaded master + forked workers),
+# or `uvicorn main:app` when testing.
\ No newline at end of file
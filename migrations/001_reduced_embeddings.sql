@@ -0,0 +1,39 @@
+-- Reduced-dimensionality embeddings (see src/services/projection.py)
+-- NOTE: The vector width (256) must match EMBEDDING_DIMENSIONS or the
+-- dims of the saved projection, update all occurrences below if changed.
+
+alter table embeddings add column if not exists embedding_reduced vector(256);
+
+-- Same output as match_documents, searching the reduced column
+create or replace function match_documents_reduced (
+  query_embedding vector(256),
+  match_threshold float,
+  match_count int
+)
+returns table (id bigint, name text, content text, video_id text, similarity float)
+language sql stable
+as $$
+  select
+    embeddings.id, embeddings.name, embeddings.content, embeddings.video_id,
+    1 - (embeddings.embedding_reduced <=> query_embedding) as similarity
+  from embeddings
+  where embeddings.embedding_reduced is not null
+    and 1 - (embeddings.embedding_reduced <=> query_embedding) > match_threshold
+  order by embeddings.embedding_reduced <=> query_embedding
+  limit match_count;
+$$;
+
+-- Bulk update used by src/utils/reproject.py
+-- rows: [{"id": 1, "embedding": "[0.1, ...]"}, ...]
+create or replace function set_reduced_embeddings (rows jsonb)
+returns void
+language sql
+as $$
+  update embeddings
+  set embedding_reduced = (r->>'embedding')::vector
+  from jsonb_array_elements(rows) r
+  where embeddings.id = (r->>'id')::bigint;
+$$;
+
+create index if not exists embeddings_embedding_reduced_idx
+  on embeddings using hnsw (embedding_reduced vector_cosine_ops);
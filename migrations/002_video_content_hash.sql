@@ -0,0 +1,4 @@
+-- Change detection for metadata refreshes (see src/utils/jobs.py)
+-- sha256 of the stored fields, rows are only rewritten when it changes
+
+alter table videos add column if not exists content_hash text;
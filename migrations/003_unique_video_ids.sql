@@ -0,0 +1,18 @@
+-- Server side distinct for src/services/db.py (scan_unique_embedded_videoids)
+-- Keyset paginated, pass the last id of the previous page as after_id
+
+create index if not exists embeddings_video_id_idx on embeddings (video_id);
+
+create or replace function unique_embedded_video_ids (
+  after_id text default null,
+  max_count int default 1000
+)
+returns table (video_id text)
+language sql stable
+as $$
+  select distinct embeddings.video_id
+  from embeddings
+  where after_id is null or embeddings.video_id > after_id
+  order by embeddings.video_id
+  limit max_count;
+$$;
@@ -0,0 +1,7 @@
+-- Deduplication of ingested paragraphs (see src/utils/corpus.py)
+-- sha256 of the paragraph's content, existing rows are left null
+
+alter table embeddings add column if not exists content_hash text;
+
+create unique index if not exists embeddings_content_hash_idx
+  on embeddings (content_hash) where content_hash is not null;
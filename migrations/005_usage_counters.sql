@@ -0,0 +1,86 @@
+-- Split the quota path from the audit path (src/services/db.py log_use, get_usage)
+-- usage_counters: one narrow row per user, feature and monthly period,
+-- incremented atomically, get_usage reads a single row by primary key
+-- usage_metadata: append-only pipeline metadata (hyde, grounded, sequences)
+-- compressed with lz4, read by offline jobs (src/utils/precompute.py)
+-- NOTE: The usage table is no longer written, kept for reference
+
+create table if not exists usage_counters (
+  user_id uuid not null,
+  feature text not null,
+  period date not null, -- First day of the month (UTC)
+  used integer not null default 0,
+  updated_at timestamptz not null default now(),
+  primary key (user_id, feature, period)
+);
+
+create table if not exists usage_metadata (
+  id bigint generated always as identity primary key,
+  user_id uuid not null,
+  feature text not null,
+  used_at timestamptz not null default now(),
+  metadata jsonb
+);
+-- NOTE: Needs postgres 14+ built with lz4 (e.g. supabase), large values
+-- are otherwise pglz compressed
+do $$
+begin
+  alter table usage_metadata alter column metadata set compression lz4;
+exception when feature_not_supported then
+  raise notice 'lz4 is not available, usage_metadata stays pglz compressed';
+end;
+$$;
+create index if not exists usage_metadata_used_at_idx on usage_metadata (used_at);
+
+-- Append-only, rows can't be changed or removed once logged
+create or replace function usage_metadata_append_only()
+returns trigger
+language plpgsql
+as $$
+begin
+  raise exception 'usage_metadata is append-only';
+end;
+$$;
+
+drop trigger if exists usage_metadata_append_only on usage_metadata;
+create trigger usage_metadata_append_only
+  before update or delete on usage_metadata
+  for each row execute function usage_metadata_append_only();
+
+-- Count a use and append its metadata in one statement,
+-- returns the user's count for the current period
+create or replace function log_usage (
+  p_user_id uuid,
+  p_feature text default 'askai',
+  p_metadata jsonb default null
+)
+returns integer
+language sql
+as $$
+  with audit as (
+    insert into usage_metadata (user_id, feature, metadata)
+    select p_user_id, p_feature, p_metadata
+    where p_metadata is not null
+  )
+  insert into usage_counters as c (user_id, feature, period, used)
+  values (p_user_id, p_feature, date_trunc('month', now() at time zone 'utc')::date, 1)
+  on conflict (user_id, feature, period)
+  do update set used = c.used+1, updated_at = now()
+  returning c.used;
+$$;
+
+-- Backfill from the usage table
+-- NOTE: Safe to re-run, live counters are never lowered (they started from
+-- these counts and only grew since) and the log is only copied into an empty table
+insert into usage_counters as c (user_id, feature, period, used)
+select user_id, feature, date_trunc('month', used_at at time zone 'utc')::date, count(*)
+from usage
+group by 1, 2, 3
+on conflict (user_id, feature, period) do update set used = greatest(c.used, excluded.used);
+
+insert into usage_metadata (user_id, feature, used_at, metadata)
+select user_id, feature, used_at, metadata
+from usage
+where metadata is not null
+  and not exists (select 1 from usage_metadata)
+order by used_at;
@@ -0,0 +1,231 @@
+"""
+Production entry point: preload, then fork the workers.
+The master imports the app and runs the warmup once (SDKs, technique
+catalog, video snapshot, local index and projection), then forks the
+workers, so they start ready and share those read-only pages copy-on-write
+instead of each loading their own copy. Workers are recycled after a
+number of requests or seconds and on SIGHUP, one at a time: the old one is
+only stopped once its replacement is accepting requests. Run from the repo root:
+    python serve.py [--workers N] [--port P] [--max-requests N] [--max-age S] [--no-preload]
+NOTE: The LLM scheduler's rate limits (services.scheduler) are per process,
+each worker gets 1/WEB_CONCURRENCY of them (set from --workers)
+"""
+# System
+import os
+import gc
+import sys
+import time
+import select
+import signal
+import socket
+import argparse
+import importlib
+# Third party
+import uvicorn
+
+# Seconds a worker gets to finish its requests before it's killed
+GRACEFUL_TIMEOUT: int = int(os.getenv('GRACEFUL_TIMEOUT', 30))
+# Seconds a recycled worker's replacement gets to start before
+# the old one is stopped anyway
+READY_TIMEOUT: int = int(os.getenv('READY_TIMEOUT', 60))
+
+def _bind(host: str, port: int)->socket.socket:
+    # Bound once in the master, inherited by every worker
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def _preload()->None:
+    # NOTE: Read the index into memory rather than mapping it, the pages are
+    # then shared with the workers without each one faulting them in
+    os.environ.setdefault('ANN_INDEX_MMAP', '0')
+    # Load the app, its routes and every service module once here, the
+    # workers inherit them (their `from main import app` is then a lookup)
+    importlib.import_module('main')
+    from src.services.warmup import warmup
+    result: dict = warmup()
+    print(f"[master] preloaded in {result['seconds']}s, ready={result['ready']} {result['errors'] or ''}", flush=True)
+    # Move everything loaded so far out of the collector's generations,
+    # otherwise the first collection in each worker writes to (and copies) every page
+    gc.collect()
+    gc.freeze()
+    return
+
+def _after_fork()->None:
+    """
+    Drop state inherited from the master that can't be shared
+    between processes: open connections and locks.
+    """
+    from src.services.llm import conn_gemini
+    from src.services.db import conn_supabase
+    from src.services.cache import get_cache
+    conn_gemini.cache_clear()
+    conn_supabase.cache_clear()
+    get_cache().after_fork()
+    return
+
+class _Server(uvicorn.Server):
+    """
+    Tells the master (over a pipe) once it's accepting requests.
+    """
+    def __init__(self, config: uvicorn.Config, ready: int|None):
+        super().__init__(config)
+        self.ready = ready
+
+    async def startup(self, sockets: list[socket.socket]|None=None)->None:
+        await super().startup(sockets=sockets)
+        if self.started and self.ready!=None:
+            os.write(self.ready, b'1')
+            os.close(self.ready)
+        return
+
+def _worker(sock: socket.socket, max_requests: int|None, ready: int|None)->None:
+    # Default signal handling, uvicorn installs its own
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+        signal.signal(sig, signal.SIG_DFL)
+    if 'main' in sys.modules: _after_fork()
+    from main import app
+    config = uvicorn.Config(app, limit_max_requests=max_requests,
+                            timeout_graceful_shutdown=GRACEFUL_TIMEOUT, log_level='info')
+    _Server(config, ready).run(sockets=[sock])
+    return
+
+class Master:
+    def __init__(self, sock: socket.socket, workers: int, max_requests: int|None, max_age: float|None):
+        self.sock = sock
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_age = max_age
+        # pid -> started at
+        self.children: dict[int, float] = {}
+        # pid -> when it was asked to stop (killed after GRACEFUL_TIMEOUT)
+        self.stopping: dict[int, float] = {}
+        self.running: bool = True
+        self.recycle: bool = False
+        # Workers waiting to be replaced, oldest first
+        self.retiring: list[int] = []
+        # The replacement being started: (pid, readiness pipe, started at)
+        self.replacing: tuple[int, int, float]|None = None
+
+    def spawn(self, wait: bool=False)->tuple[int, int|None]:
+        """
+        Fork a worker, returns its pid and (if wait) the
+        pipe it writes to once it's accepting requests.
+        """
+        ready, readyWrite = os.pipe() if wait else (None, None)
+        pid: int = os.fork()
+        if pid==0:
+            if ready!=None: os.close(ready)
+            code: int = 0
+            try: _worker(self.sock, self.max_requests, readyWrite)
+            except BaseException as e:
+                print(f'[worker {os.getpid()}] {e!r}', file=sys.stderr, flush=True)
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                # Skip the master's atexit handlers and finalizers
+                os._exit(code)
+        if readyWrite!=None: os.close(readyWrite)
+        self.children[pid] = time.time()
+        print(f'[master] started worker {pid}', flush=True)
+        return pid, ready
+
+    def stop(self, pid: int)->None:
+        if pid in self.stopping: return
+        self.stopping[pid] = time.time()
+        try: os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError: pass
+        return
+
+    def reap(self)->None:
+        while True:
+            try: pid, __ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError: return
+            if pid==0: return
+            self.children.pop(pid, None)
+            self.stopping.pop(pid, None)
+            print(f'[master] worker {pid} exited', flush=True)
+
+    def _signal(self, signum: int, frame)->None:
+        if signum==signal.SIGHUP: self.recycle = True
+        else: self.running = False
+        return
+
+    def run(self)->None:
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self._signal)
+        while self.running:
+            self.reap()
+            now: float = time.time()
+            serving: list[int] = [pid for pid in self.children if pid not in self.stopping]
+            # Replace exited workers (incl. those past max_requests)
+            for __ in range(self.workers-len(serving)): self.spawn()
+            old: list[int] = sorted(serving, key=lambda p: self.children[p])
+            if self.recycle:
+                self.recycle = False
+                self.retiring += [pid for pid in old if pid not in self.retiring]
+            elif self.max_age!=None and not self.retiring and old and now-self.children[old[0]]>self.max_age:
+                self.retiring.append(old[0])
+            self.retiring = [pid for pid in self.retiring if pid in serving]
+            # Rolling recycle, one at a time so capacity isn't lost: start
+            # the replacement, stop the old worker once it's ready, repeat
+            if self.replacing!=None:
+                pid, ready, since = self.replacing
+                # Ready once it wrote to the pipe (EOF if it exited first)
+                readable, __, __ = select.select([ready], [], [], 0)
+                started: bool = len(readable)>0 and os.read(ready, 1)==b'1'
+                if started or pid not in self.children or now-since>READY_TIMEOUT:
+                    os.close(ready)
+                    self.replacing = None
+                    # NOTE: If the replacement died the old worker keeps serving
+                    # and another replacement is started
+                    if pid in self.children and self.retiring: self.stop(self.retiring.pop(0))
+            if self.replacing==None and self.retiring:
+                self.replacing = (*self.spawn(wait=True), now)
+            for pid, since in list(self.stopping.items()):
+                if now-since>GRACEFUL_TIMEOUT:
+                    try: os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError: pass
+            time.sleep(0.5)
+        self.shutdown()
+        return
+
+    def shutdown(self)->None:
+        for pid in list(self.children): self.stop(pid)
+        deadline: float = time.time()+GRACEFUL_TIMEOUT
+        while self.children and time.time()<deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            try: os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError: pass
+        self.reap()
+        return
+
+def _main():
+    parser = argparse.ArgumentParser(description='Serve the API with preloaded, forked workers')
+    parser.add_argument('--host', default=os.getenv('HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_CONCURRENCY', 2)))
+    parser.add_argument('--max-requests', type=int, default=int(os.getenv('MAX_REQUESTS', 0)) or None,
+                        help='Recycle a worker after this many requests')
+    parser.add_argument('--max-age', type=float, default=float(os.getenv('MAX_WORKER_AGE', 0)) or None,
+                        help='Recycle a worker after this many seconds')
+    parser.add_argument('--no-preload', action='store_true',
+                        help='Load and warm up in each worker instead of once in the master')
+    args = parser.parse_args()
+
+    # Read by the scheduler to split the rate limits between the workers
+    os.environ['WEB_CONCURRENCY'] = str(args.workers)
+    sock: socket.socket = _bind(args.host, args.port)
+    if not args.no_preload: _preload()
+    print(f'[master] {os.getpid()} serving on {args.host}:{args.port} with {args.workers} workers', flush=True)
+    Master(sock, args.workers, args.max_requests, args.max_age).run()
+    return
+
+if __name__=="__main__":
+    _main()
@@ -26,6 +26,36 @@ class Graph(BaseModel):
     edges: list[Edge]
 
 
+# Technique details added to /solve responses with expand=techniques
+class TechniqueInfo(BaseModel):
+    name: str
+    description: Optional[str] = None
+    tags: list[str] = []
+
+# Graph with a side table of the techniques its nodes reference,
+# each technique is included once however many nodes use it
+class ExpandedGraph(Graph):
+    techniques: dict[int, TechniqueInfo] # Keyed by Node.technique_id
+
+# Compound response for the single call "fast" pipeline mode,
+# sequences are kept for the usage metadata
+class FastSolution(BaseModel):
+    sequences: list[Sequence]
+    graph: Graph
+
+# Outcome of one problem of a /solve/batch request,
+# the graph if it was solved or the error status and detail
+class BatchResult(BaseModel):
+    index: int # Position in the request
+    status: int
+    graph: Optional[Graph] = None
+    detail: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    results: list[BatchResult]
+    solved: int
+    failed: int
+
 class Video(BaseModel):
     id: str # TODO: Add data validation by enforcing the length of the id
     title: str
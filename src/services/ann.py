@@ -0,0 +1,172 @@
+"""
+Approximate nearest neighbour (IVF) index for the tutorial embeddings.
+Vectors are clustered into coarse cells with k-means and stored as int8
+with a scale per vector. A search only scans the closest `nprobe` cells
+and reranks the best approximate hits exactly with the float32 vectors.
+"""
+# System
+import os
+import json
+import threading
+# Third party
+import numpy as np
+from pydantic import BaseModel
+
+class SearchResponse(BaseModel):
+    # Mirrors the `data` attribute of the supabase rpc response
+    # so callers of similarity_search don't need to know the source
+    data: list[dict]
+
+def normalize(matrix: np.ndarray)->np.ndarray:
+    """
+    Scale vectors to unit length so dot products are cosine similarities.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix/np.where(norms==0, 1, norms)
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int=20, seed: int=0)->tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized Lloyd's k-means on unit vectors (spherical k-means).
+    Returns the centroids and the cell label of every vector.
+    """
+    rng = np.random.default_rng(seed)
+    k = min(k, len(vectors))
+    centroids: np.ndarray = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    for __ in range(iterations):
+        labels: np.ndarray = np.argmax(vectors@centroids.T, axis=1)
+        # Sum vectors per cell in one pass and renormalize
+        sums: np.ndarray = np.zeros_like(centroids)
+        np.add.at(sums, labels, vectors)
+        counts: np.ndarray = np.bincount(labels, minlength=k)
+        # Re-seed empty cells with random vectors
+        empty: np.ndarray = counts==0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    labels = np.argmax(vectors@centroids.T, axis=1)
+    return centroids, labels
+
+def quantize(vectors: np.ndarray)->tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric int8 quantization with one scale per vector.
+    vector ~= codes*scale
+    """
+    scales: np.ndarray = np.abs(vectors).max(axis=1)/127
+    scales = np.where(scales==0, 1, scales).astype(np.float32)
+    codes: np.ndarray = np.round(vectors/scales[:, None]).astype(np.int8)
+    return codes, scales
+
+class IvfIndex:
+    """
+    Inverted file index over unit vectors. Vectors are kept sorted by cell,
+    with `offsets[c]:offsets[c+1]` being the rows that belong to cell c.
+    """
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, codes: np.ndarray,
+            scales: np.ndarray, vectors: np.ndarray, records: list[dict], nprobe: int=16
+        ):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.codes = codes
+        self.scales = scales
+        self.vectors = vectors
+        self.records = records
+        self.nprobe = nprobe
+        # Row lookup for fetching vectors by embeddings record id
+        self.rows: dict = {record.get('id'): row for row, record in enumerate(records)}
+
+    def get_vectors(self, ids: list)->dict:
+        """
+        Same output as db.get_embedding_vectors, served from memory.
+        """
+        return {id: self.vectors[self.rows[id]] for id in ids if id in self.rows}
+
+    @classmethod
+    def build(cls, vectors, records: list[dict], cells: int|None=None, nprobe: int=16, seed: int=0):
+        """
+        Given raw vectors and a record (id, name, content, video_id...) per vector,
+        cluster and quantize them into a new index. Defaults to ~sqrt(n) cells.
+        """
+        vectors = normalize(vectors)
+        cells = cells if cells!=None else max(1, int(np.sqrt(len(vectors))))
+        centroids, labels = kmeans(vectors, cells, seed=seed)
+        # Sort rows by cell so each cell is a contiguous slice
+        order: np.ndarray = np.argsort(labels, kind='stable')
+        offsets: np.ndarray = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=len(centroids)))])
+        vectors = vectors[order]
+        codes, scales = quantize(vectors)
+        return cls(centroids, offsets, codes, scales, vectors,
+                   [records[i] for i in order], nprobe=nprobe)
+
+    def search(self, query, k: int=10, nprobe: int|None=None, rerank: int=4)->list[tuple[int, float]]:
+        """
+        Return up to k (row, cosine similarity) pairs for the query, best first.
+        The top `k*rerank` approximate hits are rescored exactly in float32.
+        """
+        q: np.ndarray = normalize(query)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        # Closest cells to the query
+        cells: np.ndarray = np.argpartition(-(self.centroids@q), nprobe-1)[:nprobe]
+        rows: np.ndarray = np.concatenate([
+            np.arange(self.offsets[c], self.offsets[c+1]) for c in cells
+        ])
+        if len(rows)<=0: return []
+        # Approximate scores from the int8 codes
+        approx: np.ndarray = (self.codes[rows].astype(np.float32)@q)*self.scales[rows]
+        shortlist: int = min(k*rerank, len(rows))
+        finalists: np.ndarray = rows[np.argpartition(-approx, shortlist-1)[:shortlist]]
+        # Exact rerank
+        exact: np.ndarray = self.vectors[finalists]@q
+        best: np.ndarray = np.argsort(-exact)[:k]
+        return [(int(finalists[i]), float(exact[i])) for i in best]
+
+    def similarity_search(self, vector, match_threshold: float=0.51, match_count: int=10)->SearchResponse:
+        """
+        Same interface and output shape as the match_documents RPC,
+        records with a `similarity` field ordered best first.
+        """
+        hits = self.search(vector, k=match_count)
+        return SearchResponse(data=[
+            {**self.records[row], 'similarity': score}
+            for row, score in hits if score>match_threshold
+        ])
+
+    def save(self, path: str)->None:
+        """
+        Save to a directory of .npy files (+ records json),
+        so the arrays can be memory mapped when loading.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ('centroids', 'offsets', 'codes', 'scales', 'vectors'):
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(path, 'records.json'), 'w') as f:
+            json.dump(self.records, f)
+        return
+
+    @classmethod
+    def load(cls, path: str, nprobe: int=16, mmap: bool=True):
+        arrays: dict = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+            for name in ('centroids', 'offsets', 'codes', 'scales', 'vectors')
+        }
+        with open(os.path.join(path, 'records.json')) as f:
+            records: list[dict] = json.load(f)
+        return cls(records=records, nprobe=nprobe, **arrays)
+
+# Index shared by all requests in the process, loaded on first use
+# NOTE: Only used when ANN_INDEX_PATH is set, otherwise searches use pgvector
+_index: IvfIndex|None = None
+_indexLock = threading.Lock()
+
+def get_index()->IvfIndex|None:
+    global _index
+    path: str|None = os.getenv('ANN_INDEX_PATH')
+    if path==None: return None
+    if _index==None:
+        with _indexLock:
+            if _index==None:
+                # NOTE: ANN_INDEX_MMAP=0 reads the arrays into memory instead
+                # (e.g. preloaded once and shared by forked workers, see serve.py)
+                _index = IvfIndex.load(path, nprobe=int(os.getenv('ANN_NPROBE', 16)),
+                                       mmap=os.getenv('ANN_INDEX_MMAP', '1')=='1')
+    return _index
@@ -0,0 +1,86 @@
+"""
+Warm answer store: graphs precomputed offline for popular problems
+(see utils.precompute), served by /solve without running the pipeline
+when a new problem is close enough to one of them. Matching is an exact
+dot product over the stored problem embeddings (a few thousand rows).
+"""
+# System
+import os
+import json
+import threading
+# Local
+from .ann import normalize
+# Third party
+import numpy as np
+
+# Smallest cosine similarity between a problem and a precomputed one to serve it
+ANSWER_THRESHOLD: float = float(os.getenv('ANSWER_THRESHOLD', 0.92))
+
+class AnswerStore:
+    """
+    Problem embeddings (unit vectors) and, for each, the precomputed
+    answer: {problem, graph (json), metadata, cluster, traffic}.
+    """
+    def __init__(self, vectors: np.ndarray, answers: list[dict], threshold: float=ANSWER_THRESHOLD):
+        self.vectors = normalize(vectors) if len(answers)>0 else np.zeros((0, 0), dtype=np.float32)
+        self.answers = answers
+        self.threshold = threshold
+
+    def __len__(self)->int:
+        return len(self.answers)
+
+    def scores(self, vectors)->tuple[np.ndarray, np.ndarray]:
+        """
+        Best match (row, cosine similarity) of each of the given vectors.
+        """
+        queries: np.ndarray = normalize(np.atleast_2d(vectors))
+        if len(self.answers)<=0: return np.zeros(len(queries), dtype=int), np.zeros(len(queries))
+        similarity: np.ndarray = queries@self.vectors.T
+        rows: np.ndarray = np.argmax(similarity, axis=1)
+        return rows, similarity[np.arange(len(queries)), rows]
+
+    def match(self, vector, threshold: float|None=None)->tuple[dict, float]|None:
+        """
+        The precomputed answer closest to the vector and its similarity,
+        None if none is over the threshold.
+        """
+        rows, scores = self.scores(vector)
+        if len(self.answers)<=0 or scores[0]<(self.threshold if threshold==None else threshold): return None
+        return self.answers[int(rows[0])], float(scores[0])
+
+    def save(self, path: str)->None:
+        """
+        Save to a single .npz file (vectors + answers json), written
+        to a temporary file and swapped in so a worker loading the
+        store never sees half of it.
+        """
+        with open(path+'.tmp', 'wb') as f:
+            np.savez(f, vectors=self.vectors, answers=np.array(json.dumps(self.answers)))
+        os.replace(path+'.tmp', path)
+        return
+
+    @classmethod
+    def load(cls, path: str, threshold: float=ANSWER_THRESHOLD):
+        with np.load(path) as data:
+            return cls(data['vectors'], json.loads(str(data['answers'])), threshold=threshold)
+
+# Store shared by all requests in the process, loaded on first use
+# and reloaded when the precompute job replaces the file
+# NOTE: Only used when ANSWERS_PATH (e.g. answers.npz) is set
+_store: AnswerStore|None = None
+_storeModified: float|None = None
+_storeLock = threading.Lock()
+
+def get_answers()->AnswerStore|None:
+    global _store, _storeModified
+    path: str|None = os.getenv('ANSWERS_PATH')
+    if path==None: return None
+    try: modified: float|None = os.stat(path).st_mtime
+    except FileNotFoundError: modified = None
+    if _store==None or modified!=_storeModified:
+        with _storeLock:
+            if _store==None or modified!=_storeModified:
+                # Empty until the precompute job has run
+                _store = AnswerStore.load(path) if modified!=None else AnswerStore(np.zeros((0, 0)), [])
+                _storeModified = modified
+    return _store
@@ -0,0 +1,137 @@
+"""
+Prompt budgeting for the stages that receive retrieved tutorial paragraphs.
+Paragraphs are ranked by similarity and packed into a fixed token budget,
+so a few long transcripts can't blow up prompt size (and call latency).
+"""
+from __future__ import annotations
+# System
+import os
+import math
+import hashlib
+from typing import Callable, TYPE_CHECKING
+# Local
+from .metrics import record
+from .serialize import dumps
+from .cache import get_cache
+# Third party
+if TYPE_CHECKING: from google import genai
+
+# Token budget per stage for the similar paragraphs passed as context
+# NOTE: Can be overwritten with env vars (e.g. PROMPT_BUDGET_GROUND=4000)
+PROMPT_BUDGETS: dict[str, int] = {
+    'ground': int(os.getenv('PROMPT_BUDGET_GROUND', 6000)),
+    'rename': int(os.getenv('PROMPT_BUDGET_RENAME', 4000)),
+}
+# Rough characters per token for english text, used when estimating
+CHARS_PER_TOKEN: int = 4
+# Model used when counting tokens with the gemini API
+COUNT_MODEL: str = 'gemini-2.0-flash-lite'
+
+# Tokens counted with gemini are kept in the shared cache (services.cache),
+# keyed by model + text hash
+# NOTE: Retrieved paragraphs repeat a lot across requests
+
+def estimate_tokens(text: str)->int:
+    """
+    Cheap local estimate of the number of tokens in a string.
+    """
+    return math.ceil(len(text)/CHARS_PER_TOKEN)
+
+def count_tokens(client: genai.Client, text: str, model: str=COUNT_MODEL)->int:
+    """
+    Count tokens for a string using gemini's count_tokens endpoint.
+    Results are cached by content hash, falling back to the local
+    estimate if the API call fails.
+    """
+    key: str = 'tokens:'+model+':'+hashlib.sha256(text.encode()).hexdigest()
+    cached: int|None = get_cache().get(key)
+    if cached!=None: return cached
+    try:
+        tokens: int = client.models.count_tokens(model=model, contents=[text]).total_tokens
+    except Exception:
+        # Don't cache estimates so the next call can retry the API
+        return estimate_tokens(text)
+    get_cache().set(key, tokens)
+    return tokens
+
+def get_counter(client: genai.Client|None=None)->Callable[[str], int]:
+    """
+    Return the token counting function to use for budgeting.
+    Set PROMPT_BUDGET_COUNTER=gemini to count with the API (cached),
+    otherwise the local estimate is used to avoid an extra round trip.
+    """
+    if client!=None and os.getenv('PROMPT_BUDGET_COUNTER')=='gemini':
+        return lambda text: count_tokens(client, text)
+    return estimate_tokens
+
+def truncate(text: str, tokens: int, counter: Callable[[str], int]=estimate_tokens)->str:
+    """
+    Shorten text to roughly fit the given number of tokens,
+    cutting at the last full sentence when one is available.
+    """
+    total: int = counter(text)
+    if total<=tokens: return text
+    # Scale down by the ratio of allowed to counted tokens
+    # which holds for both the estimate and the API counter
+    cut: str = text[:int(len(text)*tokens/total)]
+    end: int = cut.rfind('. ')
+    if end>len(cut)//2: cut = cut[:end+1]
+    return cut.rstrip()+' ...'
+
+def encode_paragraphs(similar: list[dict])->list[tuple[dict, str]]:
+    """
+    Serialize each retrieved paragraph once, to be packed by
+    fit_paragraphs for every stage without dumping it again.
+    """
+    encoded: list[tuple[dict, str]] = []
+    for sequence in similar:
+        item: dict = {'name': sequence['name'], 'paragraph': sequence['content']}
+        encoded.append((item, dumps(item)))
+    return encoded
+
+def fit_paragraphs(similar: list[dict], stage: str, budget: int|None=None,
+        counter: Callable[[str], int]=estimate_tokens, min_tokens: int=100,
+        encoded: list[tuple[dict, str]]|None=None
+    )->tuple[str, dict]:
+    """
+    Given the records returned by the similarity search, pack the most relevant
+    paragraphs (by similarity) into the stage's token budget and return them
+    as the json string passed to the LLM, along with a report of budget usage.
+    The first paragraph that overflows is truncated if at least `min_tokens`
+    are left, everything after that is dropped.
+    Pass encoded (encode_paragraphs of similar) to reuse it across stages.
+    """
+    budget = budget if budget!=None else PROMPT_BUDGETS[stage]
+    encoded = encoded if encoded!=None else encode_paragraphs(similar)
+
+    # Highest similarity first, missing scores keep the search order
+    order: list[int] = sorted(range(len(similar)), key=lambda i: similar[i].get('similarity') or 0, reverse=True)
+
+    # Packed items as json strings, joined into the array at the end
+    packed: list[str] = []
+    used: int = 0
+    truncated: int = 0
+    for i in order:
+        item, text = encoded[i]
+        tokens: int = counter(text)
+        if used+tokens<=budget:
+            packed.append(text)
+            used += tokens
+            continue
+        # Overflow, fill what's left of the budget with a truncated paragraph
+        # leaving room for the name and json syntax around it
+        remaining: int = budget-used-counter(dumps({'name': item['name'], 'paragraph': ''}))
+        if remaining>=min_tokens:
+            text = dumps({'name': item['name'], 'paragraph': truncate(item['paragraph'], remaining, counter)})
+            packed.append(text)
+            used += counter(text)
+            truncated += 1
+        break
+
+    report: dict = {
+        'budget': budget, 'used': used,
+        'retrieved': len(similar), 'kept': len(packed),
+        'truncated': truncated, 'dropped': len(similar)-len(packed),
+    }
+    record(f'budget.{stage}', **report)
+    return '['+','.join(packed)+']', report
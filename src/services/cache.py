@@ -0,0 +1,216 @@
+"""
+Cache backends for data shared across requests (technique catalog, video
+snapshot, token counts, solve checkpoints...). The memory backend is
+per process, the sqlite backend (WAL mode) is a local file shared by every
+worker on the same machine, so workers share warm data without an
+external service. Both have per-key TTLs, size bounded (LRU) eviction
+and an atomic pop. Select with CACHE_BACKEND=memory|sqlite.
+"""
+# System
+import os
+import time
+import pickle
+import sqlite3
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Callable
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Most keys kept before the least recently used are evicted
+CACHE_MAX_ITEMS: int = int(os.getenv('CACHE_MAX_ITEMS', 10000))
+
+class CacheBackend(ABC):
+    """
+    Interface of the cache backends, values are any picklable object.
+    ttl is in seconds (None never expires), pop atomically gets and
+    deletes a key (only one caller gets the value).
+    """
+    @abstractmethod
+    def get(self, key: str, default=None): ...
+
+    @abstractmethod
+    def set(self, key: str, value, ttl: float|None=None)->None: ...
+
+    @abstractmethod
+    def delete(self, key: str)->None: ...
+
+    @abstractmethod
+    def pop(self, key: str, default=None): ...
+
+    def after_fork(self)->None:
+        """
+        Called in forked worker processes (see serve.py) to drop
+        state that can't be shared with the parent, e.g. connections.
+        """
+        return
+
+    def get_or_set(self, key: str, fn: Callable[[], object], ttl: float|None=None):
+        """
+        Return the cached value, or call fn and cache its result.
+        NOTE: Concurrent misses may call fn more than once
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = fn()
+            self.set(key, value, ttl=ttl)
+        return value
+
+_MISSING = object()
+
+class MemoryCache(CacheBackend):
+    def __init__(self, max_items: int=CACHE_MAX_ITEMS):
+        self.max_items = max_items
+        # key -> (value, expires_at), in least to most recently used order
+        self._items: OrderedDict[str, tuple[object, float|None]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def after_fork(self)->None:
+        # Items are kept (shared copy-on-write), the lock is new
+        self._lock = threading.Lock()
+        return
+
+    def _live(self, key: str):
+        # Caller holds the lock
+        item = self._items.get(key)
+        if item==None: return _MISSING
+        value, expires = item
+        if expires!=None and expires<=time.time():
+            del self._items[key]
+            return _MISSING
+        self._items.move_to_end(key)
+        return value
+
+    def _put(self, key: str, value, ttl: float|None)->None:
+        self._items[key] = (value, time.time()+ttl if ttl!=None else None)
+        self._items.move_to_end(key)
+        while len(self._items)>self.max_items: self._items.popitem(last=False)
+        return
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            value = self._live(key)
+        return default if value is _MISSING else value
+
+    def set(self, key: str, value, ttl: float|None=None)->None:
+        with self._lock: self._put(key, value, ttl)
+        return
+
+    def delete(self, key: str)->None:
+        with self._lock: self._items.pop(key, None)
+        return
+
+    def pop(self, key: str, default=None):
+        with self._lock:
+            value = self._live(key)
+            if value is not _MISSING: del self._items[key]
+        return default if value is _MISSING else value
+
+class SqliteCache(CacheBackend):
+    """
+    Cache in a local sqlite file in WAL mode (concurrent readers with a
+    single writer), shared by every process that opens the same path.
+    Values are pickled.
+    """
+    def __init__(self, path: str, max_items: int=CACHE_MAX_ITEMS, evict_every: int=100,
+            touch_after: float=60
+        ):
+        self.path = path
+        self.max_items = max_items
+        # Eviction runs every so many writes rather than on each one
+        self.evict_every = evict_every
+        # Reads only refresh a key's accessed_at once it's this many seconds
+        # old, so most reads don't take the write lock (LRU to the minute)
+        self.touch_after = touch_after
+        # NOTE: next() on a count is atomic, writes come from many threads
+        self._writes = itertools.count(1)
+        # sqlite connections can't be shared across threads
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute('create table if not exists cache ('
+                       'key text primary key, value blob, expires_at real, accessed_at real)')
+            db.execute('create index if not exists cache_accessed on cache (accessed_at)')
+
+    def _connect(self)->sqlite3.Connection:
+        db: sqlite3.Connection|None = getattr(self._local, 'db', None)
+        if db==None:
+            # Autocommit, transactions are opened explicitly where needed
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute('pragma journal_mode=wal')
+            db.execute('pragma synchronous=normal')
+            self._local.db = db
+        return db
+
+    def after_fork(self)->None:
+        # The parent's connections must not be used by the child
+        self._local = threading.local()
+        return
+
+    def get(self, key: str, default=None):
+        db = self._connect()
+        now: float = time.time()
+        row = db.execute('select value, accessed_at from cache where key=? and (expires_at is null or expires_at>?)',
+                         (key, now)).fetchone()
+        if row==None: return default
+        if row[1]==None or row[1]<now-self.touch_after:
+            db.execute('update cache set accessed_at=? where key=?', (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value, ttl: float|None=None)->None:
+        now: float = time.time()
+        self._connect().execute(
+            'insert or replace into cache (key, value, expires_at, accessed_at) values (?, ?, ?, ?)',
+            (key, pickle.dumps(value), now+ttl if ttl!=None else None, now))
+        self._written()
+        return
+
+    def delete(self, key: str)->None:
+        self._connect().execute('delete from cache where key=?', (key,))
+        return
+
+    def pop(self, key: str, default=None):
+        db = self._connect()
+        # Delete returning the row, so only one worker gets it
+        row = db.execute('delete from cache where key=? and (expires_at is null or expires_at>?) returning value',
+                         (key, time.time())).fetchone()
+        return default if row==None else pickle.loads(row[0])
+
+    def _written(self)->None:
+        if next(self._writes)%self.evict_every==0: self.evict()
+        return
+
+    def evict(self)->None:
+        """
+        Drop expired keys, then the least recently used over max_items.
+        """
+        db = self._connect()
+        db.execute('delete from cache where expires_at<=?', (time.time(),))
+        db.execute('delete from cache where key in (select key from cache order by accessed_at desc limit -1 offset ?)',
+                   (self.max_items,))
+        return
+
+# Backend shared by the service modules
+_backend: CacheBackend|None = None
+_backendLock = threading.Lock()
+
+def set_cache(backend: CacheBackend|None)->None:
+    global _backend
+    _backend = backend
+    return
+
+def get_cache()->CacheBackend:
+    """
+    The configured backend, CACHE_BACKEND=sqlite (file at CACHE_PATH)
+    to share the cache across workers, per process memory otherwise.
+    """
+    global _backend
+    if _backend==None:
+        with _backendLock:
+            if _backend==None:
+                if os.getenv('CACHE_BACKEND')=='sqlite':
+                    _backend = SqliteCache(os.getenv('CACHE_PATH', 'cache.sqlite3'))
+                else: _backend = MemoryCache()
+    return _backend
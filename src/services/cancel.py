@@ -0,0 +1,50 @@
+"""
+Cancellation of in-flight pipeline work when the client disconnects.
+The endpoint watches the request and sets an event, which is checked
+between stages and while waiting on LLM calls (queued or running).
+"""
+# System
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+# Third party
+from fastapi import Request
+
+class Cancelled(Exception):
+    """
+    Raised inside the pipeline once the client has disconnected.
+    """
+    pass
+
+# Events of the enclosing cancellation blocks, outermost first
+_events: ContextVar[tuple[threading.Event, ...]] = ContextVar('cancelled', default=())
+
+@contextmanager
+def cancellation(event: threading.Event):
+    """
+    Make the calls inside the block cancellable with the given event,
+    as well as by the events of any enclosing blocks (e.g. the request's).
+    """
+    token = _events.set((*_events.get(), event))
+    try: yield
+    finally: _events.reset(token)
+
+def cancelled()->bool:
+    return any(event.is_set() for event in _events.get())
+
+def raise_if_cancelled()->None:
+    if cancelled(): raise Cancelled()
+    return
+
+async def watch_disconnect(request: Request, event: threading.Event, interval: float=0.5)->None:
+    """
+    Poll the request until the client disconnects (or the event is set
+    elsewhere), run as a task alongside the threadpool work.
+    """
+    while not event.is_set():
+        if await request.is_disconnected():
+            event.set()
+            break
+        await asyncio.sleep(interval)
+    return
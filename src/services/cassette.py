@@ -0,0 +1,333 @@
+"""
+Record/replay of the Gemini and Supabase traffic (services.llm, services.db)
+to profile and regression test /solve and /tutorials offline against real
+payloads, structured outputs and latencies instead of synthetic fakes.
+CASSETTE_MODE=record wraps the real clients and appends every call (request
+fingerprint, response, payload sizes, latency) to the CASSETTE_PATH file
+(json lines) with secrets scrubbed. CASSETTE_MODE=replay serves the calls
+from the cassette without any network or credentials, instantly or at the
+recorded latency scaled by CASSETTE_LATENCY (0 instant, 1 as recorded).
+Replay is strict: a call whose request wasn't recorded raises CassetteMiss,
+CASSETTE_MATCH=kind serves the next recording of the same kind instead.
+"""
+# System
+import os
+import re
+import time
+import hashlib
+import importlib
+import threading
+from types import SimpleNamespace
+from typing import Callable
+# Local
+from .metrics import record
+# Third party
+import orjson
+from pydantic import BaseModel, TypeAdapter
+
+# off, record or replay
+CASSETTE_MODE: str = os.getenv('CASSETTE_MODE', 'off')
+CASSETTE_PATH: str = os.getenv('CASSETTE_PATH', 'cassettes/session.jsonl')
+# Replayed latency as a multiple of the recorded one
+CASSETTE_LATENCY: float = float(os.getenv('CASSETTE_LATENCY', 0))
+# How replayed requests are matched: 'exact' (same fingerprint only) or
+# 'kind', falling back to the next recording of the same model or table
+# NOTE: Kind matches may serve a response recorded for another prompt
+CASSETTE_MATCH: str = os.getenv('CASSETTE_MATCH', 'exact')
+# Characters of each request kept in the cassette for inspecting misses
+PREVIEW_CHARS: int = 1000
+
+class CassetteMiss(Exception):
+    """
+    Raised in replay mode for a call that has no recording.
+    """
+    pass
+
+class RecordedError(Exception):
+    """
+    An error raised by a recorded call, raised again on replay.
+    """
+    def __init__(self, kind: str, message: str):
+        self.kind = kind
+        # NOTE: Same attribute as postgrest's APIError
+        self.message = message
+        super().__init__(f'{kind}: {message}')
+
+# Values that must never be written to a cassette: keys and tokens
+# from the environment, api keys, JWTs (e.g. supabase keys) and emails
+_SECRET = re.compile(r'AIza[0-9A-Za-z_\-]{35}|eyJ[\w-]+\.[\w-]+\.[\w-]+|[\w.+-]+@[\w-]+\.[\w.-]+')
+# Timestamps in requests (e.g. "now" filters) vary between runs
+_TIMESTAMP = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?([+-]\d{2}:\d{2}|Z)?')
+
+def _env_secrets()->list[str]:
+    return [value for name, value in os.environ.items()
+            if any(s in name.upper() for s in ('KEY', 'TOKEN', 'SECRET', 'PASSWORD', 'GEMINI'))
+            and len(value)>=8]
+
+def scrub(text: str, secrets: list[str]|None=None)->str:
+    for secret in secrets if secrets!=None else _env_secrets():
+        text = text.replace(secret, '<scrubbed>')
+    return _SECRET.sub('<scrubbed>', text)
+
+def _default(value):
+    # orjson fallback for SDK types found in requests and responses
+    if isinstance(value, BaseModel): return value.model_dump(exclude_none=True)
+    if isinstance(value, type): return f'{value.__module__}.{value.__qualname__}'
+    if isinstance(value, bytes): return hashlib.sha256(value).hexdigest()
+    return str(value)
+
+def _canonical(request: dict)->str:
+    return orjson.dumps(request, default=_default, option=orjson.OPT_SORT_KEYS).decode()
+
+def _encode(value)->dict|None:
+    # Response to json, keeping its type to rebuild it on replay
+    if value==None: return None
+    if isinstance(value, BaseModel):
+        return {'type': f'{type(value).__module__}.{type(value).__qualname__}',
+                'data': value.model_dump(mode='json', exclude_none=True, exclude={'parsed'})}
+    # postgrest's APIResponse and others with data/count
+    return {'type': None, 'data': orjson.loads(orjson.dumps(
+        {'data': getattr(value, 'data', None), 'count': getattr(value, 'count', None)}, default=_default))}
+
+def _decode(encoded: dict|None, config=None):
+    if encoded==None: return None
+    if encoded['type']==None: return SimpleNamespace(**encoded['data'])
+    module, __, name = encoded['type'].rpartition('.')
+    value = getattr(importlib.import_module(module), name).model_validate(encoded['data'])
+    # Structured outputs are parsed by the SDK from the text, same here
+    schema = getattr(config, 'response_schema', None)
+    if schema!=None and getattr(value, 'text', None):
+        # NOTE: Left as None when the text doesn't match, like the SDK
+        try: value.parsed = TypeAdapter(schema).validate_json(value.text)
+        except ValueError: pass
+    return value
+
+class Cassette:
+    """
+    Recorded calls of a session. In record mode calls are appended to the
+    file as they complete. In replay mode each call is served the recording
+    with the same fingerprint (in recorded order if it was made more than
+    once). Other calls raise CassetteMiss, unless match is 'kind' where
+    they get the next recording of the same kind of call (e.g. the same
+    model or table).
+    """
+    def __init__(self, path: str=CASSETTE_PATH, mode: str=CASSETTE_MODE, latency: float=CASSETTE_LATENCY,
+            match: str=CASSETTE_MATCH
+        ):
+        if match not in ('exact', 'kind'): raise ValueError(f'Unknown cassette match {match}')
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.match = match
+        self.secrets: list[str] = _env_secrets()
+        self._lock = threading.Lock()
+        self._exact: dict[str, list[dict]] = {}
+        self._kinds: dict[str, list[dict]] = {}
+        self._served: dict[str, int] = {}
+        if mode=='replay':
+            with open(path) as f:
+                for line in f:
+                    if not line.strip(): continue
+                    entry: dict = orjson.loads(line)
+                    self._exact.setdefault(entry['fingerprint'], []).append(entry)
+                    self._kinds.setdefault(entry['kind'], []).append(entry)
+        elif mode=='record':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def fingerprint(self, request: dict)->tuple[str, str]:
+        canonical: str = _TIMESTAMP.sub('<timestamp>', scrub(_canonical(request), self.secrets))
+        return hashlib.sha256(canonical.encode()).hexdigest(), canonical
+
+    def _next(self, key: str, entries: list[dict])->dict:
+        # Recordings of a key are served in order, the last one repeats
+        with self._lock:
+            served: int = self._served.get(key, 0)
+            self._served[key] = served+1
+        return entries[min(served, len(entries)-1)]
+
+    def lookup(self, kind: str, request: dict)->dict:
+        fingerprint, canonical = self.fingerprint(request)
+        if fingerprint in self._exact:
+            record('cassette', exact=1)
+            return self._next(fingerprint, self._exact[fingerprint])
+        if self.match=='kind' and kind in self._kinds:
+            record('cassette', fallback=1)
+            return self._next('kind:'+kind, self._kinds[kind])
+        record('cassette', misses=1)
+        raise CassetteMiss(f'No recording of this {kind} request in {self.path}: {canonical[:200]}')
+
+    def save(self, kind: str, request: dict, response, seconds: float,
+            error: Exception|None=None, chunks: list[tuple[float, object]]|None=None
+        )->None:
+        fingerprint, canonical = self.fingerprint(request)
+        encoded = _encode(response) if chunks==None else [[round(at, 4), _encode(c)] for at, c in chunks]
+        entry: dict = {
+            'kind': kind,
+            'fingerprint': fingerprint,
+            'request': canonical[:PREVIEW_CHARS],
+            'request_bytes': len(canonical),
+            'seconds': round(seconds, 4),
+            'response': encoded if chunks==None else None,
+            'chunks': encoded if chunks!=None else None,
+            'response_bytes': len(orjson.dumps(encoded)),
+            'error': [type(error).__name__, str(getattr(error, 'message', error))] if error!=None else None,
+        }
+        line: str = scrub(orjson.dumps(entry).decode(), self.secrets)
+        with self._lock:
+            with open(self.path, 'a') as f: f.write(line+'\n')
+        return
+
+    def wait(self, seconds: float)->None:
+        if self.latency>0 and seconds>0: time.sleep(seconds*self.latency)
+        return
+
+    def call(self, kind: str, request: dict, fn: Callable[[], object]|None, config=None):
+        """
+        Record fn's result (or error) for the request, or replay it.
+        """
+        if self.mode=='replay':
+            entry: dict = self.lookup(kind, request)
+            self.wait(entry['seconds'])
+            if entry['error']!=None: raise RecordedError(*entry['error'])
+            return _decode(entry['response'], config)
+        started: float = time.perf_counter()
+        try: response = fn()
+        except Exception as e:
+            self.save(kind, request, None, time.perf_counter()-started, error=e)
+            raise
+        self.save(kind, request, response, time.perf_counter()-started)
+        return response
+
+    def stream(self, kind: str, request: dict, fn: Callable[[], object]|None, config=None):
+        """
+        Same as call for streamed responses, chunks are replayed
+        at their recorded offsets (scaled).
+        """
+        if self.mode=='replay':
+            entry: dict = self.lookup(kind, request)
+            if entry['error']!=None: raise RecordedError(*entry['error'])
+            last: float = 0.0
+            for at, chunk in entry['chunks'] or []:
+                self.wait(at-last)
+                last = at
+                yield _decode(chunk)
+            return
+        started: float = time.perf_counter()
+        chunks: list[tuple[float, object]] = []
+        error: Exception|None = None
+        try:
+            for chunk in fn():
+                chunks.append((time.perf_counter()-started, chunk))
+                yield chunk
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Also saved when the consumer stops early (GeneratorExit),
+            # with the chunks it got, replays then end at the same point
+            if error!=None: self.save(kind, request, None, time.perf_counter()-started, error=error)
+            else: self.save(kind, request, None, time.perf_counter()-started, chunks=chunks)
+        return
+
+class _GeminiNamespace:
+    # client.models / client.caches, every method call goes through the cassette
+    def __init__(self, cassette: Cassette, name: str, target):
+        self._cassette = cassette
+        self._name = name
+        self._target = target
+
+    def __getattr__(self, method: str):
+        def call(**kwargs):
+            kind: str = f"gemini.{self._name}.{method}:{kwargs.get('model', '')}"
+            request: dict = {'kind': kind, **kwargs}
+            fn = (lambda: getattr(self._target, method)(**kwargs)) if self._target!=None else None
+            if method.endswith('_stream'): return self._cassette.stream(kind, request, fn)
+            return self._cassette.call(kind, request, fn, config=kwargs.get('config'))
+        return call
+
+class GeminiClient:
+    """
+    Stand-in for genai.Client recording or replaying its calls.
+    """
+    def __init__(self, cassette: Cassette, client=None):
+        self.models = _GeminiNamespace(cassette, 'models', getattr(client, 'models', None))
+        self.caches = _GeminiNamespace(cassette, 'caches', getattr(client, 'caches', None))
+
+class _Query:
+    """
+    Chain of postgrest builder calls (table().select().eq()...),
+    run against the real client (or replayed) on execute.
+    """
+    def __init__(self, cassette: Cassette, client, steps: list):
+        self._cassette = cassette
+        self._client = client
+        self._steps = steps
+
+    def __getattr__(self, name: str):
+        # Attribute access (e.g. .not_) until called
+        return _Query(self._cassette, self._client, self._steps+[[name]])
+
+    def __call__(self, *args, **kwargs):
+        name: str = self._steps[-1][0]
+        return _Query(self._cassette, self._client, self._steps[:-1]+[[name, list(args), kwargs]])
+
+    def _kind(self)->str:
+        # e.g. supabase.table:usage_counters.select or supabase.rpc:log_usage
+        method, args, kwargs = self._steps[0]
+        # The table or function name, passed by position or keyword
+        name = args[0] if args else next(iter(kwargs.values()), '')
+        kind: str = f'supabase.{method}:{name}'
+        return kind+('.'+self._steps[1][0] if len(self._steps)>1 else '')
+
+    def execute(self):
+        kind: str = self._kind()
+        request: dict = {'kind': kind, 'steps': self._steps}
+        return self._cassette.call(kind, request, self._run if self._client!=None else None)
+
+    def _run(self):
+        target = self._client
+        for step in self._steps:
+            target = getattr(target, step[0])
+            if len(step)>1: target = target(*step[1], **step[2])
+        return target.execute()
+
+class SupabaseClient:
+    """
+    Stand-in for the supabase Client recording or replaying
+    the table and rpc queries made through it.
+    """
+    def __init__(self, cassette: Cassette, client=None):
+        self._cassette = cassette
+        self._client = client
+
+    def table(self, *args, **kwargs):
+        return _Query(self._cassette, self._client, [['table', list(args), kwargs]])
+
+    def rpc(self, *args, **kwargs):
+        return _Query(self._cassette, self._client, [['rpc', list(args), kwargs]])
+
+# Cassette shared by both clients in the process, opened on first use
+_cassette: Cassette|None = None
+_cassetteLock = threading.Lock()
+
+def get_cassette()->Cassette:
+    global _cassette
+    if _cassette==None:
+        with _cassetteLock:
+            if _cassette==None: _cassette = Cassette()
+    return _cassette
+
+def wrap_gemini(create: Callable[[], object]):
+    """
+    The gemini client from create(), or its recording/replaying stand-in.
+    NOTE: Replays don't create the real client (no credentials needed)
+    """
+    if CASSETTE_MODE=='off': return create()
+    return GeminiClient(get_cassette(), create() if CASSETTE_MODE=='record' else None)
+
+def wrap_supabase(create: Callable[[], object]):
+    """
+    Same as wrap_gemini for the supabase client.
+    """
+    if CASSETTE_MODE=='off': return create()
+    return SupabaseClient(get_cassette(), create() if CASSETTE_MODE=='record' else None)
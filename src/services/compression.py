@@ -0,0 +1,65 @@
+"""
+Response compression, brotli when the client accepts it (and the optional
+brotli package is installed), gzip otherwise. Responses under a size
+threshold are sent as is. Streamed responses (e.g. /solve/stream) are
+flushed chunk by chunk so events aren't held back by the compressor.
+"""
+# System
+import os
+# Third party
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipResponder, IdentityResponder
+from starlette.types import ASGIApp, Receive, Scope, Send
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smallest body (bytes) worth compressing
+COMPRESSION_MIN_SIZE: int = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+
+class _FlushingGZipResponder(GZipResponder):
+    def apply_compression(self, body: bytes, *, more_body: bool)->bytes:
+        self.gzip_file.write(body)
+        # Sync flush so each streamed chunk can be decoded on arrival
+        if more_body: self.gzip_file.flush()
+        else: self.gzip_file.close()
+        body = self.gzip_buffer.getvalue()
+        self.gzip_buffer.seek(0)
+        self.gzip_buffer.truncate()
+        return body
+
+class _BrotliResponder(IdentityResponder):
+    content_encoding = 'br'
+
+    def __init__(self, app: ASGIApp, minimum_size: int, quality: int=4):
+        super().__init__(app, minimum_size)
+        # NOTE: Low quality levels are much faster for similar ratios on json
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def apply_compression(self, body: bytes, *, more_body: bool)->bytes:
+        compressed: bytes = self.compressor.process(body)
+        return compressed+(self.compressor.flush() if more_body else self.compressor.finish())
+
+class CompressionMiddleware:
+    def __init__(self, app: ASGIApp, minimum_size: int=COMPRESSION_MIN_SIZE,
+            gzip_level: int=6, brotli_quality: int=4
+        ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send)->None:
+        if scope['type']!='http':
+            await self.app(scope, receive, send)
+            return
+        accepted: str = Headers(scope=scope).get('Accept-Encoding', '')
+        if brotli!=None and 'br' in accepted:
+            responder = _BrotliResponder(self.app, self.minimum_size, quality=self.brotli_quality)
+        elif 'gzip' in accepted:
+            responder = _FlushingGZipResponder(self.app, self.minimum_size, compresslevel=self.gzip_level)
+        else:
+            responder = IdentityResponder(self.app, self.minimum_size)
+        await responder(scope, receive, send)
+        return
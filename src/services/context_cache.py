@@ -0,0 +1,231 @@
+"""
+Prompt prefix caching for the static parts of LLM calls (technique catalog
+and fixed instructions). Prefixes are stored as gemini cached contents and
+referenced by name, so only the per-request inputs are sent and processed.
+Any failure falls back to sending the full context inline. Live prefix names
+are shared through services.cache, with CACHE_BACKEND=sqlite every worker
+on the machine reuses the same cached content instead of creating its own.
+"""
+from __future__ import annotations
+# System
+import os
+import time
+import hashlib
+import threading
+import itertools
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+# Local
+from .metrics import record
+from .lazy import lazy_import
+from .cache import CacheBackend, get_cache
+# Third party
+# NOTE: Imported on first use, see services.lazy
+genai = lazy_import('google.genai')
+types = lazy_import('google.genai.types')
+
+load_dotenv()
+
+class PrefixCache(ABC):
+    """
+    Interface for the backend that stores cached prompt prefixes.
+    create returns the name used as `cached_content` when generating.
+    """
+    @abstractmethod
+    def create(self, client: genai.Client, model: str, contents: list[str],
+            system_instruction: str|None, ttl: int
+        )->str: ...
+
+    @abstractmethod
+    def delete(self, client: genai.Client, name: str)->None: ...
+
+class GeminiPrefixCache(PrefixCache):
+    """
+    Backed by gemini's cached contents api (client.caches).
+    NOTE: Gemini requires a minimum prefix size and a model that supports
+    explicit caching, otherwise create fails and callers go inline.
+    """
+    def create(self, client, model, contents, system_instruction, ttl):
+        cached = client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=contents,
+                system_instruction=system_instruction,
+                ttl=f'{ttl}s',
+            )
+        )
+        return cached.name
+
+    def delete(self, client, name):
+        client.caches.delete(name=name)
+        return
+
+class LocalPrefixCache(PrefixCache):
+    """
+    In-memory stand-in for the cached contents api, used in tests
+    and local development with a fake gemini client.
+    """
+    def __init__(self):
+        self.entries: dict[str, dict] = {}
+        self._ids = itertools.count(1)
+
+    def create(self, client, model, contents, system_instruction, ttl):
+        name: str = f'cachedContents/local-{next(self._ids)}'
+        self.entries[name] = {
+            'model': model, 'contents': contents,
+            'system_instruction': system_instruction,
+            'expires_at': time.time()+ttl,
+        }
+        return name
+
+    def delete(self, client, name):
+        self.entries.pop(name, None)
+        return
+
+class PrefixManager:
+    """
+    Keeps one live cached prefix per stage and model. A prefix is recreated
+    when it's close to expiring or its content changes (e.g. the technique
+    catalog was refreshed), in which case the old one is deleted.
+    Created prefixes are published to the shared cache (services.cache by
+    default) for other workers to reuse.
+    NOTE: Workers creating the same prefix at once may each create one,
+    the last published is reused and the others expire unused
+    """
+    def __init__(self, backend: PrefixCache, ttl: int=3600, margin: int=120, cooldown: int=600,
+            shared: CacheBackend|None=None
+        ):
+        self.backend = backend
+        self.shared = shared
+        self.ttl = ttl
+        # Recreate prefixes this many seconds before they expire
+        # so requests never reference an expired cache
+        self.margin = margin
+        # Seconds to stay inline after failing to create a prefix
+        self.cooldown = cooldown
+        self._live: dict[tuple, dict] = {}
+        self._failed: dict[tuple, float] = {}
+        # Guards the dicts above, held only briefly (never across the network)
+        self._lock = threading.Lock()
+        # One lock per key, so a slow create only holds up that prefix
+        self._creating: dict[tuple, threading.Lock] = {}
+
+    def _usable(self, key: tuple, digest: str, now: float)->str|None:
+        # Name of the key's live prefix if it's current, caller holds _lock
+        live: dict|None = self._live.get(key)
+        if live!=None and live['digest']==digest and live['expires_at']-self.margin>now:
+            return live['name']
+        return None
+
+    def _cache(self)->CacheBackend:
+        return self.shared if self.shared!=None else get_cache()
+
+    @staticmethod
+    def _shared_key(key: tuple)->str:
+        return 'prefix:'+':'.join(key)
+
+    def _published(self, key: tuple, digest: str, now: float)->dict|None:
+        # The prefix another worker created, if it's current
+        try: live: dict|None = self._cache().get(self._shared_key(key))
+        except Exception: return None
+        if live!=None and live['digest']==digest and live['expires_at']-self.margin>now: return live
+        return None
+
+    def get(self, client: genai.Client, stage: str, model: str,
+            contents: list[str], system_instruction: str|None=None
+        )->str|None:
+        """
+        Return the cached content name for the given static prefix,
+        creating it if needed, or None if the call should go inline.
+        """
+        key: tuple = (stage, model)
+        digest: str = hashlib.sha256(
+            '\0'.join([system_instruction or '', *contents]).encode()
+        ).hexdigest()
+        with self._lock:
+            if time.time()<self._failed.get(key, 0):
+                record(f'context_cache.{stage}', fallback=1)
+                return None
+            name: str|None = self._usable(key, digest, time.time())
+            if name!=None:
+                record(f'context_cache.{stage}', hit=1)
+                return name
+            creating: threading.Lock = self._creating.setdefault(key, threading.Lock())
+        # NOTE: Concurrent requests for the same prefix wait for the
+        # one creating it instead of each creating their own
+        with creating:
+            with self._lock:
+                now: float = time.time()
+                if now<self._failed.get(key, 0):
+                    record(f'context_cache.{stage}', fallback=1)
+                    return None
+                name = self._usable(key, digest, now)
+                if name!=None:
+                    record(f'context_cache.{stage}', hit=1)
+                    return name
+                live: dict|None = self._live.get(key)
+            published: dict|None = self._published(key, digest, now)
+            if published!=None:
+                with self._lock: self._live[key] = published
+                record(f'context_cache.{stage}', shared=1)
+                return published['name']
+            try:
+                name = self.backend.create(client, model, contents, system_instruction, self.ttl)
+            except Exception:
+                with self._lock: self._failed[key] = time.time()+self.cooldown
+                record(f'context_cache.{stage}', fallback=1)
+                return None
+            entry: dict = {'name': name, 'digest': digest, 'expires_at': now+self.ttl}
+            with self._lock: self._live[key] = entry
+            try: self._cache().set(self._shared_key(key), entry, ttl=self.ttl)
+            except Exception: pass
+        record(f'context_cache.{stage}', created=1)
+        # Clean up a prefix replaced because its content changed, ones
+        # replaced near expiry are left to expire for in-flight requests
+        # NOTE: Calls referencing a deleted prefix are retried inline
+        if live!=None and live['digest']!=digest:
+            try: self.backend.delete(client, live['name'])
+            except Exception: pass
+        return name
+
+    def evict(self, name: str)->None:
+        """
+        Forget the live prefix with the given name (e.g. a call using it
+        failed because it expired or was deleted), the next get recreates it.
+        """
+        with self._lock:
+            keys: list[tuple] = [key for key, live in self._live.items() if live['name']==name]
+            for key in keys: del self._live[key]
+        for key in keys:
+            try:
+                shared = self._cache()
+                published: dict|None = shared.get(self._shared_key(key))
+                if published!=None and published['name']==name: shared.delete(self._shared_key(key))
+            except Exception: pass
+        return
+
+# Manager used by the llm service functions, configured with CONTEXT_CACHE
+# ('gemini' or 'local'), unset disables caching and prompts go inline
+_manager: PrefixManager|None = None
+
+def set_backend(backend: PrefixCache|None, ttl: int=3600)->None:
+    """
+    Swap the cache backend (e.g. LocalPrefixCache in tests), None disables it.
+    """
+    global _manager
+    _manager = PrefixManager(backend, ttl=ttl) if backend!=None else None
+    return
+
+def get_prefix(client: genai.Client, stage: str, model: str,
+        contents: list[str], system_instruction: str|None=None
+    )->str|None:
+    if _manager==None: return None
+    return _manager.get(client, stage, model, contents, system_instruction)
+
+def evict_prefix(name: str)->None:
+    if _manager!=None: _manager.evict(name)
+    return
+
+match os.getenv('CONTEXT_CACHE'):
+    case 'gemini': set_backend(GeminiPrefixCache(), ttl=int(os.getenv('CONTEXT_CACHE_TTL', 3600)))
+    case 'local': set_backend(LocalPrefixCache())
@@ -1,20 +1,36 @@
+from __future__ import annotations
 # System
 import os
 import json
+import threading
+from typing import Iterator, TYPE_CHECKING
+from functools import lru_cache
 from dotenv import load_dotenv
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
 # Local
 from ..models.general import Video
+from .ann import get_index
+from .projection import get_projection, reduce_query
+from .serialize import dumps
+from .cache import get_cache
+from .cassette import wrap_supabase
 # Third Party
-from supabase import create_client, Client
+import orjson
+if TYPE_CHECKING: from supabase import Client
 
 load_dotenv()
 
+# NOTE: Cached, one client (and connection pool) per process
+@lru_cache(maxsize=1)
 def conn_supabase()->Client:
-    return create_client(
+    # NOTE: Imported on first use, supabase pulls in several
+    # sub clients (realtime, storage, auth) that slow down cold starts
+    from supabase import create_client
+    # NOTE: Queries are recorded/replayed with CASSETTE_MODE, see services.cassette
+    return wrap_supabase(lambda: create_client(
         supabase_url=os.environ.get("SUPABASE_URL"), 
         supabase_key=os.environ.get("SUPABASE_SERVICE_KEY")
-    )
+    ))
 
 # function for performing similarity search
 # used to find relevant documents and ground hyde answer
@@ -22,8 +38,15 @@ def similarity_search(
         client: Client, vector: list[float], 
         match_threshold:float=0.51,match_count:int=10
     ):
+    # Project the query into the stored space if using reduced embeddings
+    vector = reduce_query(vector)
+    # Search the local approximate index instead if one is configured
+    # NOTE: Returns the same shape as the rpc (records under .data)
+    index = get_index()
+    if index!=None:
+        return index.similarity_search(vector, match_threshold=match_threshold, match_count=match_count)
     response = (
-        client.rpc(fn='match_documents', params={
+        client.rpc(fn='match_documents_reduced' if get_projection()!=None else 'match_documents', params={
             "query_embedding": vector,
             "match_threshold": match_threshold, # Over 51% Match in similarity
             "match_count": match_count, # Top k=10 default
@@ -32,6 +55,27 @@ def similarity_search(
     )
     return response
 
+def get_embedding_vectors(client: Client, ids: list)->dict:
+    """
+    Given a list of record ids from the embeddings table, return
+    a dict mapping each id to its embedding vector. Used for reranking
+    similarity search hits locally (e.g. MMR) without another RPC.
+    """
+    if len(ids)<=0: return {}
+    # Use the reduced column if queries are searched in the reduced space
+    column: str = 'embedding_reduced' if get_projection()!=None else 'embedding'
+    response = (
+        client.table('embeddings')
+        .select(f'id, {column}')
+        .in_('id', ids)
+        .execute()
+    )
+    # NOTE: PostgREST serializes pgvector columns as strings, e.g. "[0.1,0.2]"
+    return {
+        record['id']: json.loads(record[column]) if isinstance(record[column], str) else record[column]
+        for record in response.data if record[column]!=None
+    }
+
 # Function for returning techniques as json string
 # to use as context when creating basic graph datastructure
 # NOTE: String returned since Gemini only accepts this type
@@ -56,7 +100,54 @@ def get_techniques(client: Client)->str:
         for record in response.data
     ]
     """
-    return json.dumps(response.data)
+    return dumps(response.data)
+
+# Copy of the technique catalog in the shared cache (services.cache)
+# NOTE: The catalog rarely changes, a changed catalog also refreshes
+# the cached prompt prefixes since their content hash changes
+# The lock only avoids concurrent fetches within a process
+_catalogLock = threading.Lock()
+
+def get_techniques_cached(client: Client, ttl: int=int(os.getenv('CATALOG_TTL', 600)))->str:
+    """
+    Same output as get_techniques, re-fetched at most once every ttl seconds.
+    """
+    with _catalogLock:
+        return get_cache().get_or_set('catalog', lambda: get_techniques(client), ttl=ttl)
+
+@lru_cache(maxsize=1)
+def _technique_table(catalog: str)->dict[int, dict]:
+    # Parsed once per catalog version rather than per request
+    return {
+        record['id']: {
+            'name': record['name'],
+            'description': record.get('description'),
+            'tags': [tag['name'] for tag in record.get('tags') or []],
+        }
+        for record in orjson.loads(catalog)
+    }
+
+def get_technique_details(client: Client, ids: list[int])->dict[int, dict]:
+    """
+    Name, description and tag names of the given techniques
+    from the cached catalog, keyed by id (unknown ids are left out).
+    """
+    table: dict[int, dict] = _technique_table(get_techniques_cached(client))
+    return {id: table[id] for id in dict.fromkeys(ids) if id in table}
+
+# Snapshot of the videos table keyed by video_id, for the tutorials
+# endpoint to look up recommendations without a query per video
+_videosLock = threading.Lock()
+
+def get_videos_cached(client: Client, ttl: int=int(os.getenv('VIDEOS_TTL', 3600)))->dict[str, dict]:
+    """
+    Every record in the videos table keyed by video_id,
+    re-fetched at most once every ttl seconds.
+    """
+    with _videosLock:
+        return get_cache().get_or_set('videos', lambda: {
+            record['video_id']: record for record in scan(client, 'videos', '*', key='video_id')
+        }, ttl=ttl)
 
 def get_user_limit(client: Client, userid: str) -> int:
     """
@@ -97,55 +188,127 @@ def get_user_limit(client: Client, userid: str) -> int:
 
     return response
 
-def get_usage(client: Client, userid: str)->int:
+def usage_period(now: datetime|None=None)->str:
+    """
+    The current usage period, the first day of the month (UTC),
+    matching the period the log_usage rpc counts into.
     """
-    This function is responsible for counting the number of attempts
+    now = now or datetime.now(timezone.utc)
+    return now.date().replace(day=1).isoformat()
+
+def get_usage(client: Client, userid: str, feature: str='askai')->int:
+    """
+    This function is responsible for returning the number of attempts
     the user has made since the beggining of their current usage period
     and returning that number for limiting their token consumption.
+    NOTE: A single row lookup by primary key on the usage_counters
+    table kept by log_use (see migrations/005_usage_counters.sql)
     """
-
-    # Initialize the current month and nexts dates
-    # for using to filter current periods usage records
-    today: datetime = datetime.now(timezone.utc)
-    start_month: datetime = today.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    next_month: datetime = (start_month+timedelta(days=32)).replace(day=1)
-
-    # query all the given users usage for a given period (i.e. current month)
-    # return the count as the functions response
     response = (
-        client.table('usage')
-        .select('used_at', count='exact')
-        # Filter for requested users data
+        client.table('usage_counters')
+        .select('used')
         .eq('user_id', userid)
-        .eq('feature', 'askai')
-        # Filter to only return the current periods records
-        .gte('used_at', start_month.isoformat()) 
-        .lte('used_at', next_month.isoformat()) 
+        .eq('feature', feature)
+        .eq('period', usage_period())
+        .limit(1)
         .execute()
     )
 
-    # Return 0 if no count, or the usage count as is
-    return response.count if response.count!=None else 0
+    # Return 0 if the user has no uses this period
+    return response.data[0]['used'] if len(response.data)>0 else 0
 
-def log_use(client: Client, userid: str, feature:str='askai', metadata:dict|None=None)->None:
+def log_use(client: Client, userid: str, feature:str='askai', metadata:dict|None=None)->int:
     """
-    This function uses the supabase client and creates
-    a record in the usage table to keep track of how much
-    the user is using askai or other JitsuJournal features.
+    This function uses the supabase client to count a use of askai
+    or other JitsuJournal features towards the user's usage this period
+    and append the pipeline's metadata (if given) to the usage log.
+    Returns the user's updated count.
     """
-    # create payload for inserting a usage record
-    # w/ required user_id and metadata if given
-    # NOTE: The used_at field defaults to now() db side
-    payload = {'user_id': userid, 'feature': feature}
-    if metadata: payload['metadata'] = metadata
+    # NOTE: Both in a single statement through the log_usage rpc,
+    # the counter row is incremented atomically (concurrent requests
+    # of a user can't lose counts) and metadata is only ever appended
+    # Empty fields (e.g. a skipped hyde) aren't stored
+    if metadata: metadata = {key: value for key, value in metadata.items() if value!=None}
+    response = client.rpc('log_usage', {
+        'p_user_id': userid,
+        'p_feature': feature,
+        'p_metadata': metadata or None,
+    }).execute()
+    return response.data
 
-    # Use Supabase client and pass payload 
-    # to insert into usage table
-    __ = (
-        client.table('usage')
-        .insert(payload)
-        .execute()
-    )
+# Rows per request when scanning whole tables
+# NOTE: Kept at or below PostgREST's max rows (1000 by default),
+# otherwise pages are silently truncated and the scan ends early
+SCAN_PAGE_SIZE: int = int(os.getenv('SCAN_PAGE_SIZE', 1000))
+
+def scan_pages(client: Client, table: str, columns: str, page_size: int=SCAN_PAGE_SIZE,
+        key: str|None='id'
+    )->Iterator[list[dict]]:
+    """
+    Generator over every row of a table, one page (list of records) at a time,
+    so callers hold a single page in memory whatever the table size.
+    Pages are keyset paginated on `key` (unique and part of `columns`),
+    or by offset (range) if key is None.
+    """
+    last = None
+    start: int = 0
+    while True:
+        query = client.table(table).select(columns)
+        if key!=None:
+            if last!=None: query = query.gt(key, last)
+            query = query.order(key).limit(page_size)
+        else:
+            query = query.range(start, start+page_size-1)
+        page: list[dict] = query.execute().data
+        if len(page)<=0: break
+        yield page
+        if len(page)<page_size: break
+        if key!=None: last = page[-1][key]
+        start += page_size
+    return
+
+def scan(client: Client, table: str, columns: str, page_size: int=SCAN_PAGE_SIZE,
+        key: str|None='id'
+    )->Iterator[dict]:
+    """
+    Same as scan_pages, yielding one record at a time.
+    """
+    for page in scan_pages(client, table, columns, page_size=page_size, key=key):
+        yield from page
+    return
+
+def scan_usage_metadata(client: Client, since: datetime|None=None, feature: str='askai',
+        page_size: int=SCAN_PAGE_SIZE
+    )->Iterator[list[dict]]:
+    """
+    Generator over the usage log (id, used_at, metadata) of a feature,
+    optionally only since a date, one page at a time (keyset on id).
+    """
+    last = None
+    while True:
+        query = client.table('usage_metadata').select('id, used_at, metadata').eq('feature', feature)
+        if since!=None: query = query.gte('used_at', since.isoformat())
+        if last!=None: query = query.gt('id', last)
+        page: list[dict] = query.order('id').limit(page_size).execute().data
+        if len(page)<=0: break
+        yield page
+        if len(page)<page_size: break
+        last = page[-1]['id']
+    return
+
+def scan_unique_embedded_videoids(client: Client, page_size: int=SCAN_PAGE_SIZE)->Iterator[str]:
+    """
+    Generator over the unique video id's in the embeddings table,
+    deduplicated by the database (migrations/003_unique_video_ids.sql).
+    """
+    last: str|None = None
+    while True:
+        page: list[dict] = client.rpc(fn='unique_embedded_video_ids', params={
+            'after_id': last, 'max_count': page_size,
+        }).execute().data
+        for record in page: yield record['video_id']
+        if len(page)<page_size: break
+        last = page[-1]['video_id']
     return
 
 def get_unique_embedded_videoids(client: Client) -> list[str]:
@@ -155,14 +318,8 @@ def get_unique_embedded_videoids(client: Client) -> list[str]:
     utils.embed for getting metadata for already embedding videos
     and storing their information in the videos table.
     """
-    # Connect to existing embeddings table
-    # fetch all uniuqe video ID's stored
-    response = (
-        client.table("embeddings")
-        .select("video_id")
-        .execute()
-    )
-    uniqueIds: list[str] = list(dict.fromkeys(d['video_id'] for d in response.data))
+    # Distinct ids are paged from the database, see above
+    uniqueIds: list[str] = list(scan_unique_embedded_videoids(client))
     return uniqueIds
 
 def insert_video_record(client: Client, video: Video):
@@ -221,6 +378,68 @@ def update_video_record(client: Client, video: Video):
     )
     return response
 
+def upsert_video_records(client: Client, videos: list[Video], hashes: dict[str, str]|None=None):
+    """
+    Bulk version of insert_video_record/update_video_record, inserting
+    new videos and updating existing ones (by video_id) in one request.
+    hashes (video id to content hash) are stored for change detection.
+    """
+    if len(videos)<=0: return None
+    data: list[dict] = [{
+        'video_id': video.id, 'title': video.title,
+        'description': video.description, 'uploaded_at': video.uploaded_at,
+        'uploaded_by': video.uploaded_by, 'thumbnail': video.thumbnail,
+        **({'content_hash': hashes.get(video.id)} if hashes!=None else {})
+    } for video in videos]
+    response = (
+        client.table('videos')
+        .upsert(data, on_conflict='video_id')
+        .execute()
+    )
+    return response
+
+def get_video_hashes(client: Client, ids: list[str])->dict[str, str|None]:
+    """
+    Given video ids, return the content hash stored with each
+    existing record (ids without a record are left out).
+    """
+    if len(ids)<=0: return {}
+    response = (
+        client.table('videos')
+        .select('video_id, content_hash')
+        .in_('video_id', ids)
+        .execute()
+    )
+    return {record['video_id']: record['content_hash'] for record in response.data}
+
+def get_existing_hashes(client: Client, hashes: list[str])->set[str]:
+    """
+    Given content hashes of paragraphs, return the ones that
+    already have a record in the embeddings table.
+    """
+    if len(hashes)<=0: return set()
+    response = (
+        client.table('embeddings')
+        .select('content_hash')
+        .in_('content_hash', hashes)
+        .execute()
+    )
+    return {record['content_hash'] for record in response.data}
+
+def insert_embedding_records(client: Client, records: list[dict]):
+    """
+    Bulk insert embedded paragraphs into the embeddings table,
+    records have the table's fields (name, content, video_id,
+    embedding, content_hash and optionally embedding_reduced).
+    """
+    if len(records)<=0: return None
+    response = (
+        client.table('embeddings')
+        .insert(records)
+        .execute()
+    )
+    return response
+
 
 if __name__=="__main__":    
     # Initialize db connection
@@ -0,0 +1,30 @@
+"""
+Deferred imports for the heavy SDKs (google-genai, supabase), so importing
+the app stays fast on cold starts and the cost is paid on first use
+(or by the startup warmup, see services.warmup) instead.
+"""
+# System
+import importlib
+import threading
+from types import ModuleType
+
+class LazyModule:
+    """
+    Stand-in for a module that's imported on first attribute access.
+    """
+    def __init__(self, name: str):
+        self._name = name
+        self._module: ModuleType|None = None
+        self._lock = threading.Lock()
+
+    def _load(self)->ModuleType:
+        if self._module==None:
+            with self._lock:
+                if self._module==None: self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+def lazy_import(name: str)->LazyModule:
+    return LazyModule(name)
@@ -1,27 +1,78 @@
+from __future__ import annotations
 # System
 import os
+from typing import TYPE_CHECKING
+from functools import lru_cache
 from dotenv import load_dotenv
 # Local
-from ..models.general import Sequence, Graph
+from ..models.general import Sequence, Graph, FastSolution
+from .projection import get_projection
+from .context_cache import get_prefix, evict_prefix
+from .metrics import record
+from .budget import estimate_tokens
+from .scheduler import schedule, Overloaded
+from .router import DeadlineExceeded
+from .cancel import Cancelled
+from .lazy import lazy_import
+from .cassette import wrap_gemini
 # Third Party
-from google import genai
-from google.genai import types, Client
+# NOTE: Imported on first use to keep cold starts fast, see services.lazy
+genai = lazy_import('google.genai')
+types = lazy_import('google.genai.types')
+if TYPE_CHECKING: from google.genai import Client
 
 load_dotenv()
 
-# NOTE: Can be cached with lru_cache
+# Output tokens reserved per call when checking token budgets
+EXPECTED_OUTPUT_TOKENS: int = 1024
+
+def _estimate(contents: list, config=None)->int:
+    # Rough prompt size of a call for the scheduler's token budgets
+    text: str = ''.join(c for c in contents if isinstance(c, str))
+    if config!=None and isinstance(config.system_instruction, str):
+        text += config.system_instruction
+    return estimate_tokens(text)
+
+def _generate(client: genai.Client, model: str, contents: list, config=None):
+    """
+    All generate_content calls go through the shared scheduler,
+    which waits for the model's request/token budget to allow it.
+    """
+    return schedule(model, _estimate(contents, config)+EXPECTED_OUTPUT_TOKENS,
+                    client.models.generate_content, model=model, contents=contents, config=config)
+
+def _generate_stream(client: genai.Client, model: str, contents: list, config=None):
+    """
+    Same as _generate, streaming the response's text as it's generated.
+    """
+    stream = schedule(model, _estimate(contents, config)+EXPECTED_OUTPUT_TOKENS,
+                      client.models.generate_content_stream, model=model, contents=contents, config=config)
+    for chunk in stream:
+        if chunk.text: yield chunk.text
+    return
+
+def _embed(client: genai.Client, model: str, contents: list, config=None):
+    """
+    Same as _generate, for embed_content calls.
+    """
+    return schedule(model, _estimate(contents), client.models.embed_content,
+                    model=model, contents=contents, config=config)
+
 # Gemini connection as a shared dependency
 # Initilize geni AI client to use Gemini
+# NOTE: Cached, one client (and connection pool) per process
+# NOTE: Calls are recorded/replayed with CASSETTE_MODE, see services.cassette
+@lru_cache(maxsize=1)
 def conn_gemini() -> Client:
-    return genai.Client(api_key=os.getenv('GEMINI'))
+    return wrap_gemini(lambda: genai.Client(api_key=os.getenv('GEMINI')))
 
-def create_paragraph(client: genai.Client, problem: str):
+def create_paragraph(client: genai.Client, problem: str, model: str="gemini-2.5-flash-lite-preview-06-17"):
     """
     Given a users jiu-jitsu problem, this function uses Gemini 2.5 
     and generates a hypothetical answer in a paragraph as solution.
     """
-    solution = client.models.generate_content(
-        model= "gemini-2.5-flash-lite-preview-06-17", #"gemini-2.0-flash-lite",
+    solution = _generate(client,
+        model=model, #"gemini-2.0-flash-lite",
         config=types.GenerateContentConfig(
             temperature=0.25
         ),
@@ -34,26 +85,56 @@ def create_paragraph(client: genai.Client, problem: str):
     )
     return solution
 
-def create_embedding(client: genai.Client, paragraph: str):
+def query_dimensions()->int|None:
+    """
+    Width to request query embeddings at, the reduced width
+    if stored embeddings are truncated (None for full width).
+    """
+    projection = get_projection()
+    if projection!=None and projection.method=='truncate': return projection.dims
+    return None
+
+def create_embedding(client: genai.Client, paragraph: str, dimensions: int|None=None, model: str='text-embedding-004'):
     """
     Given a paragraph, convert it to a embedding using 
-    Gemini text embedding models.
+    Gemini text embedding models. If dimensions isn't given and
+    stored embeddings are truncated, the reduced vector is requested.
     """
-    embedding = client.models.embed_content(
-        model='text-embedding-004',
+    if dimensions==None: dimensions = query_dimensions()
+    embedding = _embed(client,
+        model=model,
         contents=[paragraph],
+        config=types.EmbedContentConfig(output_dimensionality=dimensions) if dimensions else None,
     )
     return embedding
 
-def ground(client:genai.Client, problem:str, solution: str, similar: str):
+# Most paragraphs embedded per embed_content request
+EMBED_BATCH_SIZE: int = 100
+
+def create_embeddings(client: genai.Client, paragraphs: list[str], dimensions: int|None=None, model: str='text-embedding-004'):
+    """
+    Batched create_embedding, converting up to EMBED_BATCH_SIZE paragraphs
+    in a single request. Embeddings are returned in the same order.
+    NOTE: Full width unless dimensions is given, used for storing
+    paragraphs (the embedding column) rather than for queries.
+    """
+    if len(paragraphs)>EMBED_BATCH_SIZE: raise ValueError(f'At most {EMBED_BATCH_SIZE} paragraphs per request')
+    embeddings = _embed(client,
+        model=model,
+        contents=paragraphs,
+        config=types.EmbedContentConfig(output_dimensionality=dimensions) if dimensions else None,
+    )
+    return embeddings
+
+def ground(client:genai.Client, problem:str, solution: str, similar: str, model: str="gemini-2.0-flash-lite"):
     """
     Given a user's problem, a hyde, and similar documents.
     Ground the hyde to actually use the techniques, positions, 
     and paths from the paragraphs. Remove contradictions 
     and inconsistences or contradictions.
     """
-    grounded = client.models.generate_content(
-        model="gemini-2.0-flash-lite",
+    grounded = _generate(client,
+        model=model,
         config=types.GenerateContentConfig(
             temperature=0.25
         ),
@@ -74,7 +155,7 @@ def ground(client:genai.Client, problem:str, solution: str, similar: str):
     )
     return grounded
 
-def extract_sequences(client: genai.Client, paragraph: str, single: bool=False):
+def extract_sequences(client: genai.Client, paragraph: str, single: bool=False, model: str="gemini-2.0-flash-lite"):
     """
     Given a paragraph (i.e. transcript), this function 
     returns a list of different Sequence objects 
@@ -82,8 +163,8 @@ def extract_sequences(client: genai.Client, paragraph: str, single: bool=False):
     """
     # Analyze and extract sequences from the given paragraph
     # isolating key information to create flowcharts with
-    response = client.models.generate_content(
-        model="gemini-2.0-flash-lite",
+    response = _generate(client,
+        model=model,
         config=types.GenerateContentConfig(
             response_mime_type="application/json",
             response_schema=Sequence if single else list[Sequence],
@@ -102,22 +183,9 @@ def extract_sequences(client: genai.Client, paragraph: str, single: bool=False):
     )
     return response
 
-def create_flowchart(client: genai.Client, problem: str, sequences: str, techniques: str):
-    """
-    Given sequences and techniques as a JSON str,
-    return a Graph object containing a list of nodes and edges.
-    """
-    # Create a flowchart/directed graph using the sequences steps,
-    # and using appropriate branching where applicable
-    flowchart = client.models.generate_content(
-        model="gemini-2.0-flash-lite",#"gemini-2.5-flash-preview-05-20",
-        config=types.GenerateContentConfig(
-            response_mime_type="application/json",
-            response_schema=Graph,
-            temperature=0.25
-        ),
-        contents=[techniques, sequences, problem,
-            """
+# Fixed instructions for the flowchart and renaming stages
+# NOTE: Sent with the technique catalog as a cached prefix when possible
+FLOWCHART_INSTRUCTIONS: str = """
             Your task is to analyze the provided jiu-jitsu `sequences` 
             and merge them into a single, compact, directed graph.
             Prioritize the techniques and pathways relevant to the given user problem.
@@ -133,35 +201,15 @@ def create_flowchart(client: genai.Client, problem: str, sequences: str, techniq
                 - `techinque_id`: ID from the provided technique list   
             - Each edge should connect `source` to `target` using node IDs
             - Eliminate duplicate steps and pathways.
-            """]
-    )
-    return flowchart
-
-def rename_add_notes(client: genai.Client, problem: str, flowchart: str, 
-        sequences:str, similar:str, techniques: str
-    ):
-    """
-    Given the flowchart, list of techinques, sequence in text form, and paragraphs 
-    of other similar sequences. Rename the flowchart and create detailed notes.
-    """
-    renamed = client.models.generate_content(
-        model="gemini-2.0-flash",
-        config=types.GenerateContentConfig(
-            system_instruction="""
+            """
+RENAME_SYSTEM: str = """
             You're a black belt jiu-jitsu coach capable of
             analyzing a sequence and giving practitioners (users)
             advice/details on how to execute and transition between techniques,
             or any other supplementary information that may be valuable for increasing
             the success of the sequence they're trying to implement/execute. 
-            """,
-            response_mime_type="application/json",
-            response_schema=Graph,
-            temperature=0.75
-        ),
-        contents=[
-            problem, flowchart, techniques, 
-            sequences, similar,
             """
+RENAME_INSTRUCTIONS: str = """
             Given the following flowchart which is a directed graph along with a
             list of techniques, the original, and the similar sequences paragraphs:
                 - Analyze the sequence and rename the flowchart (max 30 characters).
@@ -170,11 +218,160 @@ def rename_add_notes(client: genai.Client, problem: str, flowchart: str,
                 - Notes should help practitioners understand how to execute the sequence.
                 - Notes should contain text from the similar and original sequence in text.
             """
-        ]
+
+def _generate_prefixed(client: genai.Client, model: str, cached: str|None,
+        cachedContents: list, inlineContents: list, system_instruction: str|None=None,
+        stream: bool=False, **config
+    ):
+    """
+    Generate using a cached prompt prefix if one is given, retrying
+    with the full context inline if the cached call fails
+    (e.g. the prefix expired or was replaced mid request),
+    in which case the prefix is evicted and recreated on the next call.
+    With stream, returns an iterator over the response's text instead.
+    """
+    if stream:
+        return _stream_prefixed(client, model, cached, cachedContents, inlineContents, system_instruction, **config)
+    if cached:
+        try:
+            return _generate(client,
+                model=model,
+                config=types.GenerateContentConfig(cached_content=cached, **config),
+                contents=cachedContents,
+            )
+        # Not retried when the request was cancelled or ran out of time
+        except (Overloaded, Cancelled, DeadlineExceeded): raise
+        except Exception:
+            evict_prefix(cached)
+            record('context_cache', fallback=1)
+    return _generate(client,
+        model=model,
+        config=types.GenerateContentConfig(system_instruction=system_instruction, **config),
+        contents=inlineContents,
+    )
+
+def _stream_prefixed(client: genai.Client, model: str, cached: str|None,
+        cachedContents: list, inlineContents: list, system_instruction: str|None=None, **config
+    ):
+    # NOTE: Only falls back to inline before the first chunk,
+    # once text was yielded the caller has already used it
+    if cached:
+        chunks = _generate_stream(client,
+            model=model,
+            config=types.GenerateContentConfig(cached_content=cached, **config),
+            contents=cachedContents,
+        )
+        try:
+            first: str|None = next(chunks, None)
+        # Not retried when the request was cancelled or ran out of time
+        except (Overloaded, Cancelled, DeadlineExceeded): raise
+        except Exception:
+            evict_prefix(cached)
+            record('context_cache', fallback=1)
+        else:
+            if first!=None: yield first
+            yield from chunks
+            return
+    yield from _generate_stream(client,
+        model=model,
+        config=types.GenerateContentConfig(system_instruction=system_instruction, **config),
+        contents=inlineContents,
+    )
+    return
+
+def create_flowchart(client: genai.Client, problem: str, sequences: str, techniques: str,
+        model: str="gemini-2.0-flash-lite", #"gemini-2.5-flash-preview-05-20"
+        stream: bool=False
+    ):
+    """
+    Given sequences and techniques as a JSON str,
+    return a Graph object containing a list of nodes and edges.
+    With stream, returns an iterator over the json text instead
+    (parsed incrementally with services.stream).
+    """
+    # Reference the catalog + instructions from the prefix cache if available
+    # otherwise send everything inline (original prompt order)
+    cached: str|None = get_prefix(client, stage='flowchart', model=model,
+                                  contents=[techniques, FLOWCHART_INSTRUCTIONS])
+    # Create a flowchart/directed graph using the sequences steps,
+    # and using appropriate branching where applicable
+    flowchart = _generate_prefixed(
+        client, model=model, cached=cached,
+        cachedContents=[sequences, problem],
+        inlineContents=[techniques, sequences, problem, FLOWCHART_INSTRUCTIONS],
+        stream=stream,
+        response_mime_type="application/json",
+        response_schema=Graph,
+        temperature=0.25,
+    )
+    return flowchart
+
+def rename_add_notes(client: genai.Client, problem: str, flowchart: str, 
+        sequences:str, similar:str, techniques: str, model: str="gemini-2.0-flash",
+        stream: bool=False
+    ):
+    """
+    Given the flowchart, list of techinques, sequence in text form, and paragraphs 
+    of other similar sequences. Rename the flowchart and create detailed notes.
+    With stream, returns an iterator over the json text instead.
+    """
+    # NOTE: The system instruction is part of the cached prefix,
+    # so it's only passed in the config when going inline
+    cached: str|None = get_prefix(client, stage='rename', model=model,
+                                  contents=[techniques, RENAME_INSTRUCTIONS],
+                                  system_instruction=RENAME_SYSTEM)
+    renamed = _generate_prefixed(
+        client, model=model, cached=cached,
+        cachedContents=[problem, flowchart, sequences, similar],
+        inlineContents=[problem, flowchart, techniques, sequences, similar, RENAME_INSTRUCTIONS],
+        system_instruction=RENAME_SYSTEM,
+        stream=stream,
+        response_mime_type="application/json",
+        response_schema=Graph,
+        temperature=0.75,
     )
     return renamed
 
-def extract_paragraph(client: genai.Client, nodes: str, edges: str):
+FAST_INSTRUCTIONS: str = """
+            You are a black belt jiu-jitsu coach. Given a practitioner's problem and
+            a grounded solution, using the provided list of techniques:
+                - Break the solution down into sequences of detailed steps
+                  (`sequences`, names under 30 characters).
+                - Merge the sequences into a single, compact, directed graph (`graph`)
+                  prioritizing the pathways relevant to the problem.
+                - The graph must not exceed 10 nodes and should only contain 1 root node,
+                  with branches where the paths diverge.
+                - Each node has a unique `id` (1, 2, 3, etc.) and a `technique_id`
+                  from the provided techniques only. Edges connect `source_id` to `target_id`.
+                - Name the graph after the problem and its sequences (max 30 characters).
+                - Write notes (max 400 characters each) on every edge that help
+                  practitioners execute the transition, using text from the solution.
+            """
+
+def solve_fast(client: genai.Client, problem: str, grounded: str, techniques: str,
+        model: str="gemini-2.0-flash", stream: bool=False
+    ):
+    """
+    Single call alternative to extract_sequences, create_flowchart and
+    rename_add_notes. Given the grounded solution, returns a FastSolution
+    with the named graph (w/ notes) and the sequences it was built from.
+    """
+    cached: str|None = get_prefix(client, stage='fast', model=model,
+                                  contents=[techniques, FAST_INSTRUCTIONS],
+                                  system_instruction=RENAME_SYSTEM)
+    solved = _generate_prefixed(
+        client, model=model, cached=cached,
+        cachedContents=[problem, grounded],
+        inlineContents=[techniques, problem, grounded, FAST_INSTRUCTIONS],
+        system_instruction=RENAME_SYSTEM,
+        stream=stream,
+        response_mime_type="application/json",
+        response_schema=FastSolution,
+        temperature=0.5,
+    )
+    return solved
+
+def extract_paragraph(client: genai.Client, nodes: str, edges: str, model: str='gemini-2.5-flash'):
     """
     Given a sequence represented by nodes and edges, forming a
     directed graph, this function is responsible for creating
@@ -185,8 +382,8 @@ def extract_paragraph(client: genai.Client, nodes: str, edges: str):
     Response is generally used for performing similarity searches
     and identifying tutorials teaching how to execute the sequence.
     """
-    extracted = client.models.generate_content(
-        model='gemini-2.5-flash',
+    extracted = _generate(client,
+        model=model,
         config=types.GenerateContentConfig(
             system_instruction="You're a black belt/expert coach in brazilian jiu-jitsu, gi and no-gi.",
             response_mime_type="application/json",
@@ -0,0 +1,47 @@
+# System
+import time
+import threading
+from collections import deque, defaultdict
+
+# Lock shared by all the module level stores below since
+# endpoints are sync and run across fastapi's threadpool
+_lock = threading.Lock()
+# Running totals (e.g. tokens used per stage) and the
+# last N raw events for inspecting individual requests
+_counters: dict[str, float] = defaultdict(float)
+_events: deque = deque(maxlen=200)
+
+def incr(name: str, value: float=1)->None:
+    """
+    Increment a named counter by the given value.
+    Counters are kept in memory and reset on restart.
+    """
+    with _lock:
+        _counters[name] += value
+    return
+
+def record(stage: str, **fields)->None:
+    """
+    Record an event for a pipeline stage (e.g. prompt budget used,
+    model that served a call, latency) and bump the stage counters.
+    Numeric fields are also summed into `<stage>.<field>` counters.
+    """
+    event: dict = {'stage': stage, 'at': time.time(), **fields}
+    with _lock:
+        _events.append(event)
+        _counters[f'{stage}.count'] += 1
+        for key, value in fields.items():
+            # NOTE: bool is a subclass of int, skip flags
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                _counters[f'{stage}.{key}'] += value
+    return
+
+def snapshot(limit: int=50)->dict:
+    """
+    Return a copy of the counters and the most recent events,
+    used by the metrics endpoint for tuning budgets and policies.
+    """
+    with _lock:
+        counters = dict(_counters)
+        events = list(_events)[-limit:]
+    return {'counters': counters, 'events': events}
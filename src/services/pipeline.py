@@ -0,0 +1,440 @@
+"""
+The /solve pipeline (hyde -> embed -> search -> ground -> extract ->
+flowchart -> rename) as a plain function, so it can be run by the
+endpoint, batch jobs and driver scripts alike.
+"""
+from __future__ import annotations
+# System
+import os
+import time
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from typing import Callable, TYPE_CHECKING
+# Local
+from ..models.general import Sequence, Graph, FastSolution
+from .llm import EMBED_BATCH_SIZE, query_dimensions, create_paragraph, create_embedding, create_embeddings, ground, extract_sequences, create_flowchart, rename_add_notes, solve_fast
+from .db import similarity_search, get_techniques_cached
+from .budget import fit_paragraphs, encode_paragraphs, get_counter
+from .rerank import diversify, reciprocal_rank_fusion
+from .scheduler import Overloaded, scheduler, llm_user
+from .router import STAGE_MODELS, SOLVE_DEADLINE, DeadlineExceeded, deadline, remaining, route, stage_budget
+from .cancel import Cancelled, cancellation, raise_if_cancelled
+from .metrics import record
+from .stream import collect
+from .serialize import GRAPH, SEQUENCES, dumps
+from .cache import get_cache
+from .answers import get_answers
+# Third party
+from pydantic import BaseModel
+if TYPE_CHECKING:
+    from google import genai
+    from supabase import Client
+
+# LLM stages of each pipeline mode, sharing the request's deadline
+# NOTE: The fast mode replaces the last three stages with a single call
+SOLVE_STAGES: dict[str, list[str]] = {
+    'default': ['hyde', 'embed', 'ground', 'extract', 'flowchart', 'rename'],
+    'fast': ['hyde', 'embed', 'ground', 'fast'],
+}
+# Mode used when the request doesn't ask for one
+SOLVE_MODE: str = os.getenv('SOLVE_MODE', 'default')
+# Search with the raw problem while hyde is being generated
+# and fuse both result sets (SOLVE_SPECULATIVE=0 to disable)
+SPECULATIVE: bool = os.getenv('SOLVE_SPECULATIVE', '1')=='1'
+_speculative = ThreadPoolExecutor(max_workers=int(os.getenv('SPECULATIVE_WORKERS', 8)))
+
+class StageError(Exception):
+    """
+    Raised when a pipeline stage fails, detail is the message
+    returned to the user (424 failed dependency).
+    """
+    def __init__(self, detail: str):
+        self.detail = detail
+        super().__init__(detail)
+
+@contextmanager
+def stage(detail: str):
+    """
+    Wrap a stage's errors into a StageError with the given message,
+    letting admission, deadline and cancellation errors through as is.
+    Checks for a disconnected client before the stage starts.
+    """
+    raise_if_cancelled()
+    try: yield
+    except (Overloaded, DeadlineExceeded, Cancelled, StageError): raise
+    except Exception as e: raise StageError(f'{detail} Error: {str(e)}') from e
+
+# Partial results of abandoned requests, keyed by user and problem,
+# so a quick retry of the same problem can skip completed stages
+# NOTE: SOLVE_CHECKPOINT_TTL=0 disables checkpointing
+CHECKPOINT_TTL: int = int(os.getenv('SOLVE_CHECKPOINT_TTL', 300))
+# Kept in the shared cache (services.cache), so a retry can
+# resume even if it lands on another worker
+
+def _checkpoint_key(user_id: str, problem: str)->str:
+    return 'checkpoint:'+user_id+':'+hashlib.sha256(problem.encode()).hexdigest()
+
+def save_checkpoint(user_id: str, problem: str, partial: dict)->None:
+    if CHECKPOINT_TTL<=0 or len(partial)<=0: return
+    get_cache().set(_checkpoint_key(user_id, problem), partial, ttl=CHECKPOINT_TTL)
+    return
+
+def pop_checkpoint(user_id: str, problem: str)->dict:
+    """
+    Return (and remove) the partial results saved for the user's problem.
+    """
+    return get_cache().pop(_checkpoint_key(user_id, problem), {})
+
+def solve_problem(gemini: genai.Client, supabase: Client, problem: str,
+        seconds: float=SOLVE_DEADLINE, user_id: str|None=None, mode: str|None=None,
+        emit: Callable[[dict], None]|None=None
+    )->tuple[Graph, dict]:
+    """
+    Given a problem faced by the user in their jiu-jitsu practice,
+    run every stage and return the renamed flowchart along with
+    the pipeline's metadata (stored with the usage record).
+    Stages share a deadline of `seconds`, see services.router.
+    If the client disconnects (services.cancel) and a user_id is given,
+    completed stages are checkpointed for a retry to resume from.
+    The fast mode produces the named graph and sequences in one call.
+    Problems close to one precomputed offline (services.answers) are
+    answered from the store, looked up alongside hyde, instead of
+    running the remaining stages.
+    With emit, graph stages are streamed and their name, nodes and
+    edges passed to emit as events as soon as they're generated.
+    """
+    mode = mode or SOLVE_MODE
+    stages: list[str] = SOLVE_STAGES[mode]
+    partial: dict = pop_checkpoint(user_id, problem) if user_id!=None else {}
+    if len(partial)>0: record('solve', resumed=1)
+    # Reject before spending any calls if the models are saturated
+    scheduler.check(list(dict.fromkeys(STAGE_MODELS[s][0] for s in stages)))
+    try:
+        with deadline(seconds, stages=stages):
+            return _solve(gemini, supabase, problem, partial, mode, emit, lookup=True)
+    except Cancelled:
+        record('solve', abandoned=1, stages=len(partial))
+        if user_id!=None: save_checkpoint(user_id, problem, partial)
+        raise
+
+def _precomputed(problem: str, vector: list[float])->tuple[Graph, dict]|None:
+    """
+    The graph precomputed for the problem closest to the given problem
+    embedding in the answer store, None if there's no store, no close
+    enough problem or matching failed.
+    """
+    store = get_answers()
+    if store==None or len(store)<=0: return None
+    try: found: tuple[dict, float]|None = store.match(vector)
+    except Exception:
+        # Solved by the pipeline as usual
+        return None
+    if found==None:
+        record('answers', misses=1)
+        return None
+    answer, similarity = found
+    record('answers', hits=1, similarity=similarity)
+    metadata: dict = {**answer['metadata'], 'problem': problem,
+                      'precomputed': answer['problem'], 'similarity': round(similarity, 4)}
+    return GRAPH.validate_json(answer['graph']), metadata
+
+# Stages of solve_problem, run within the request's deadline
+# NOTE: Outputs are stored in partial as they complete, stages
+# with an output already in partial (from a checkpoint) are skipped
+def _solve(gemini: genai.Client, supabase: Client, problem: str, partial: dict, mode: str,
+        emit: Callable[[dict], None]|None=None, lookup: bool=False
+    )->tuple[Graph, dict]:
+    # With lookup, the raw problem's embedding is matched against the
+    # answer store while hyde is generated, a hit stops hyde and is returned
+    # NOTE: Resumed requests already missed the store
+    answer: Future|None = None
+    hit = threading.Event()
+    if lookup and 'hyde' not in partial and 'similar' not in partial:
+        store = get_answers()
+        if store!=None and len(store)>0:
+            answer = Future()
+            answer.add_done_callback(lambda f: f.result()!=None and hit.set())
+    # Start retrieval with the raw problem off the critical path
+    speculative: Future|None = None
+    if (SPECULATIVE or answer!=None) and 'similar' not in partial:
+        speculative = _speculative.submit(contextvars.copy_context().run, _speculate,
+                                          gemini, supabase, problem, partial.get('problem_vector'),
+                                          answer, SPECULATIVE)
+
+    with stage('Failed to create hyde.'):
+        # Create a hypothetical solution using the users problem
+        if 'hyde' not in partial:
+            try:
+                with cancellation(hit):
+                    partial['hyde'] = route('hyde', lambda model: create_paragraph(gemini, problem, model=model)).text
+            except Cancelled:
+                if not hit.is_set(): raise
+            except DeadlineExceeded:
+                # Hyde overran its share of the deadline, ground
+                # using the raw problem's search results alone
+                if not SPECULATIVE or speculative==None: raise
+                record('solve', hyde_skipped=1)
+                partial['hyde'] = None
+        # Answered from the store, if hyde finished first the lookup is
+        # waited on (the search below would wait on its embedding anyway)
+        # for an embedding's share of the deadline at most, a miss past it
+        if answer!=None:
+            try: found: tuple[Graph, dict]|None = answer.result(timeout=stage_budget('embed'))
+            except TimeoutError:
+                record('answers', timeouts=1)
+                found = None
+            if found!=None: return found
+        hypothetical: str|None = partial['hyde']
+        if not SPECULATIVE: speculative = None
+
+    # Create embedding using the hypothetical solution
+    # Used for searching tutorials with similar content
+    with stage('Failed to embedd.'):
+        if 'vector' not in partial and hypothetical!=None:
+            embedding = route('embed', lambda model: create_embedding(gemini, paragraph=hypothetical, model=model))
+            partial['vector'] = embedding.embeddings[0].values
+        vector: list[float]|None = partial.get('vector')
+
+    with stage('Failed to perform vector search.'):
+        # Retrive similar records to the generated solution from Supabase
+        # NOTE: Using default match threshold and fetching a larger candidate
+        # set, which is reranked locally for diversity (top k=10 kept)
+        if 'similar' not in partial:
+            candidates: list[dict] = []
+            if vector!=None:
+                candidates = similarity_search(client=supabase, vector=vector, match_count=30).data
+            if speculative!=None:
+                # Fuse the hyde and raw problem results by rank
+                # NOTE: Its embed and search aren't routed, waited on for
+                # what's left of the deadline at most (no hits past it)
+                try: problemVector, problemHits = speculative.result(timeout=remaining())
+                except TimeoutError:
+                    record('solve', speculative_timeout=1)
+                    problemVector, problemHits = None, []
+                if vector==None: vector = problemVector
+                candidates = reciprocal_rank_fusion([candidates, problemHits])
+            if vector==None: raise StageError('Failed to perform vector search, no query vector.')
+            partial['similar'] = diversify(client=supabase, query=vector, similar=candidates, k=10)
+        similar: list[dict] = partial['similar']
+        # Flatten into json strings to pass to LLM for grounding and renaming
+        # packing the most similar paragraphs into each stage's token budget
+        counter = get_counter(gemini)
+        # NOTE: Each paragraph is serialized once and shared by both stages
+        encoded: list[tuple[dict, str]] = encode_paragraphs(similar)
+        paragraphs, __ = fit_paragraphs(similar, stage='ground', counter=counter, encoded=encoded)
+        renameParagraphs, __ = fit_paragraphs(similar, stage='rename', counter=counter, encoded=encoded)
+
+    # Use top-k records in similar
+    # to gound the hypothetical result
+    with stage('Failed to ground generated solution.'):
+        if 'grounded' not in partial:
+            # NOTE: Without a hyde, the problem stands in as the solution to ground
+            partial['grounded'] = route('ground', lambda model: ground(client=gemini, problem=problem,
+                            solution=hypothetical or problem, similar=paragraphs, model=model)).text
+        grounded: str = partial['grounded']
+
+    if mode=='fast': return _solve_fast(gemini, supabase, problem, hypothetical, grounded, emit)
+
+    # Convert grounded answer into steps in a sequence
+    with stage('Failed to extract steps from generated solution.'):
+        if 'sequences' not in partial:
+            extracted: list[Sequence] = route('extract', lambda model: extract_sequences(
+                client=gemini, paragraph=grounded, model=model)).parsed
+            partial['sequences'] = SEQUENCES.dump_python(extracted)
+        flattened: list[dict] = partial['sequences']
+        # Dumped once as the json string passed back into the model,
+        # the flattened dicts are reused for the usage metadata
+        sequences: str = dumps(flattened)
+
+    with stage('Failed to get techniques from DB.'):
+        # Load techniques into memory for passing as context in next stage
+        # Using the DB service to fetch from Supabase (w/ joins for tags and cat IDs)
+        # NOTE: Cached in-process, the catalog is the same for every request
+        techniques: str = get_techniques_cached(client=supabase)
+
+    with stage('Failed to create flowchart using extracted steps.'):
+        # Use grounded steps with retrieved techniques
+        # and create a basic lightweight directed graph
+        # NOTE: Streamed calls aren't hedged, a duplicate would emit twice
+        flowchart: Graph = partial.get('flowchart') or route('flowchart', lambda model: _graph_stage(
+            'flowchart', create_flowchart, Graph, emit, client=gemini, problem=problem,
+            sequences=sequences, techniques=techniques, model=model), hedge=emit==None)
+
+    check_graph(flowchart)
+    partial['flowchart'] = flowchart
+
+    # If flowchart was created successfully without errors
+    # We pass the flowchart back into a model to
+    # Update the flowchart names and notes
+    with stage('Failed to rename flowchart and create notes.'):
+        renamed: Graph = route('rename', lambda model: _graph_stage(
+            'rename', rename_add_notes, Graph, emit,
+            client=gemini, problem=problem,
+            flowchart=GRAPH.dump_json(flowchart).decode(),
+            sequences=sequences, similar=renameParagraphs,
+            techniques=techniques, model=model
+        ), hedge=emit==None)
+
+    # Setup the metadata with pipeline's data above
+    # this is passed to the log_use func and stored in DB for reference
+    metadata: dict = {
+        'problem': problem,
+        'hyde': hypothetical,
+        'grounded': grounded,
+        'sequences': flattened,
+    }
+    return renamed, metadata
+
+def _speculate(gemini: genai.Client, supabase: Client, problem: str,
+        vector: list[float]|None=None, answer: Future|None=None, search: bool=True
+    )->tuple[list[float]|None, list[dict]]:
+    """
+    Embed the raw problem (unless already embedded, e.g. by a batch)
+    and search with it, run alongside hyde. With answer, the embedding is
+    first matched against the answer store and the match (or None) set
+    as its result, the search is skipped on a match.
+    Failures only mean there's nothing to fuse, never fail the request.
+    """
+    try:
+        if vector==None: vector = create_embedding(gemini, paragraph=problem).embeddings[0].values
+        if answer!=None:
+            answer.set_result(_precomputed(problem, vector))
+            if answer.result()!=None: return vector, []
+        if not search: return vector, []
+        hits: list[dict] = similarity_search(client=supabase, vector=vector, match_count=30).data
+    except Exception:
+        return None, []
+    finally:
+        # Never leave hyde waiting on a lookup that failed
+        if answer!=None and not answer.done(): answer.set_result(None)
+    record('solve', speculative_hits=len(hits))
+    return vector, hits
+
+def _graph_stage(name: str, fn: Callable, schema: type[BaseModel],
+        emit: Callable[[dict], None]|None, **kwargs
+    )->BaseModel|None:
+    """
+    Call a graph generating llm function, returning its parsed response.
+    With emit, the response is streamed and its nodes and edges emitted
+    as they complete, then the full text is validated against the schema.
+    """
+    if emit==None: return fn(**kwargs).parsed
+    emit({'event': 'stage', 'stage': name})
+    return collect(fn(stream=True, **kwargs), schema, stage=name, emit=emit)
+
+def check_graph(graph: Graph|None)->None:
+    """
+    Raise a StageError if a generated graph is missing nodes or edges.
+    """
+    if graph==None:
+        raise StageError('Failed to create flowchart, null response.')
+    elif graph.nodes==None or len(graph.nodes)<=0:
+        raise StageError('No nodes generated.')
+    elif graph.edges==None or len(graph.edges)<=0:
+        raise StageError('No edges generated.')
+    return
+
+# Last stage of the fast mode, after grounding
+def _solve_fast(gemini: genai.Client, supabase: Client, problem: str,
+        hypothetical: str, grounded: str, emit: Callable[[dict], None]|None=None
+    )->tuple[Graph, dict]:
+    with stage('Failed to get techniques from DB.'):
+        techniques: str = get_techniques_cached(client=supabase)
+
+    with stage('Failed to create flowchart from grounded solution.'):
+        solved: FastSolution = route('fast', lambda model: _graph_stage(
+            'fast', solve_fast, FastSolution, emit, client=gemini, problem=problem,
+            grounded=grounded, techniques=techniques, model=model), hedge=emit==None)
+    if solved==None: raise StageError('Failed to create flowchart, null response.')
+    check_graph(solved.graph)
+
+    metadata: dict = {
+        'problem': problem,
+        'hyde': hypothetical,
+        'grounded': grounded,
+        'sequences': SEQUENCES.dump_python(solved.sequences),
+        'mode': 'fast',
+    }
+    return solved.graph, metadata
+
+# Items of a batch being solved at once, the rest wait for a slot
+BATCH_CONCURRENCY: int = int(os.getenv('BATCH_CONCURRENCY', 8))
+# Most problems accepted in one batch
+BATCH_MAX_ITEMS: int = int(os.getenv('BATCH_MAX_ITEMS', 100))
+
+def solve_batch(gemini: genai.Client, supabase: Client, problems: list[str],
+        user_ids: list[str]|None=None, seconds: float=SOLVE_DEADLINE,
+        mode: str|None=None, concurrency: int=BATCH_CONCURRENCY
+    )->list[tuple[Graph, dict]|Exception]:
+    """
+    Solve many problems together (curriculum generation, cache warming,
+    QA runs...). Hydes are generated concurrently, then every hyde and
+    raw problem is embedded in batched calls, then the remaining stages
+    (search, ground, extract, flowchart, rename) run concurrently per item.
+    At most `concurrency` items have calls in flight at a time.
+    Returns the same as solve_problem, or the exception raised, per problem.
+    NOTE: Each item has its own deadline of `seconds` from its first call,
+    and calls are attributed to its user (user_ids) for fair queueing
+    """
+    mode = mode or SOLVE_MODE
+    stages: list[str] = SOLVE_STAGES[mode]
+    users: list[str] = user_ids or ['batch']*len(problems)
+    scheduler.check(list(dict.fromkeys(STAGE_MODELS[s][0] for s in stages)))
+    started: list[float|None] = [None]*len(problems)
+    partials: list[dict] = [{} for __ in problems]
+    results: list[tuple[Graph, dict]|Exception|None] = [None]*len(problems)
+
+    def hyde(i: int)->None:
+        started[i] = time.monotonic()
+        with llm_user(users[i]), deadline(seconds, stages=stages):
+            with stage('Failed to create hyde.'):
+                try:
+                    partials[i]['hyde'] = route('hyde', lambda model: create_paragraph(
+                        gemini, problems[i], model=model)).text
+                except DeadlineExceeded:
+                    # Same as solve_problem, the raw problem's results stand in
+                    if not SPECULATIVE: raise
+                    record('solve', hyde_skipped=1)
+                    partials[i]['hyde'] = None
+        return
+
+    def finish(i: int)->None:
+        # Resume within what's left of the item's deadline
+        left: float = max(0.0, started[i]+seconds-time.monotonic())
+        with llm_user(users[i], inflight=True), deadline(left, stages=stages[2:]):
+            results[i] = _solve(gemini, supabase, problems[i], partials[i], mode)
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        _run_each(executor, hyde, range(len(problems)), results)
+        # Hydes (and the raw problems for the speculative search)
+        # of every item in as few embedding requests as possible
+        texts: list[tuple[int, str, str]] = [(i, 'vector', p['hyde']) for i, p in enumerate(partials)
+                                             if results[i]==None and p['hyde']!=None]
+        if SPECULATIVE: texts += [(i, 'problem_vector', problems[i]) for i in range(len(problems))
+                                  if results[i]==None]
+        try:
+            with llm_user(users[0] if len(set(users))==1 else 'batch'), stage('Failed to embedd.'):
+                for offset in range(0, len(texts), EMBED_BATCH_SIZE):
+                    chunk: list[tuple[int, str, str]] = texts[offset:offset+EMBED_BATCH_SIZE]
+                    embedded = route('embed', lambda model: create_embeddings(
+                        gemini, [text for __, __, text in chunk], dimensions=query_dimensions(), model=model))
+                    for (i, key, __), embedding in zip(chunk, embedded.embeddings):
+                        partials[i][key] = embedding.values
+        except (StageError, Overloaded):
+            # Items still missing a vector embed their own in _solve
+            record('solve_batch', embed_failed=1)
+        _run_each(executor, finish, [i for i in range(len(problems)) if results[i]==None], results)
+    record('solve_batch', items=len(problems), failed=sum(isinstance(r, Exception) for r in results))
+    return results
+
+def _run_each(executor: ThreadPoolExecutor, fn: Callable[[int], None], items, results: list)->None:
+    # Run fn for each item, storing what it raises as the item's result
+    futures: dict[int, Future] = {i: executor.submit(contextvars.copy_context().run, fn, i) for i in items}
+    for i, future in futures.items():
+        try: future.result()
+        except Exception as e: results[i] = e
+    return
@@ -0,0 +1,188 @@
+"""
+On-demand profiling of individual requests (e.g. a slow /solve), to see
+whether time goes to network waits, pydantic validation, serialization
+or the SDKs. A sampling profiler snapshots every thread's stack on a
+timer thread and saves collapsed stacks (flamegraph.pl / speedscope
+input), optionally with a tracemalloc report of the top allocations.
+Files are saved per request id in PROFILE_DIR.
+Enabled per request with the admin header `X-Profile: <PROFILE_TOKEN>`
+(`X-Profile-Memory: 1` to also track allocations), or for every request
+with PROFILE_ALL=1. The middleware isn't installed at all otherwise.
+"""
+# System
+import os
+import re
+import sys
+import hmac
+import uuid
+import asyncio
+import threading
+import tracemalloc
+from collections import Counter
+# Third party
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Admin token enabling profiling with the X-Profile header
+PROFILE_TOKEN: str|None = os.getenv('PROFILE_TOKEN')
+# Profile every request (local runs, never in production)
+PROFILE_ALL: bool = os.getenv('PROFILE_ALL', '0')=='1'
+# Where the .folded and .alloc.txt files are saved
+PROFILE_DIR: str = os.getenv('PROFILE_DIR', 'profiles')
+# Seconds between stack samples
+PROFILE_INTERVAL: float = float(os.getenv('PROFILE_INTERVAL', 0.005))
+# Allocation sites listed in the memory report
+PROFILE_TOP: int = int(os.getenv('PROFILE_TOP', 30))
+
+def profiling_enabled()->bool:
+    return PROFILE_TOKEN!=None or PROFILE_ALL
+
+def _label(frame)->str:
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_qualname}"
+
+def _idle(stack: list[str])->bool:
+    """
+    Whether a stack (root first) is a thread waiting for work: an idle
+    pool worker or the event loop waiting on its selector.
+    """
+    leaf: str = stack[-1]
+    if leaf=='concurrent.futures.thread:_worker' or leaf.startswith('selectors:'): return True
+    # anyio's threadpool workers (run_in_threadpool) waiting on their queue
+    for caller, callee in zip(stack, stack[1:]):
+        if caller.endswith('WorkerThread.run') and callee=='queue:Queue.get': return True
+    return False
+
+class Sampler:
+    """
+    Samples the stack of every other thread every `interval` seconds and
+    counts identical stacks, prefixed with the thread's name.
+    NOTE: Threads serving other requests are sampled too,
+    profile on a quiet worker for a clean picture
+    """
+    def __init__(self, interval: float=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples: int = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def start(self)->None:
+        self._thread.start()
+        return
+
+    def stop(self)->None:
+        self._stop.set()
+        self._thread.join()
+        return
+
+    def _run(self)->None:
+        own: int = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names: dict[int, str] = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident==own: continue
+                stack: list[str] = []
+                while frame!=None:
+                    stack.append(_label(frame))
+                    frame = frame.f_back
+                stack.reverse()
+                if _idle(stack): continue
+                self.stacks[(names.get(ident, str(ident)), *stack)] += 1
+            self.samples += 1
+        return
+
+    def collapsed(self)->str:
+        """
+        One `thread;root;...;leaf count` line per unique stack.
+        """
+        return ''.join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+# tracemalloc is process wide, one request tracks allocations at a time
+_memoryLock = threading.Lock()
+
+class Profile:
+    """
+    Profile of one request, started when the request comes in
+    and saved under its id once the response has been sent.
+    """
+    def __init__(self, request_id: str, memory: bool=False):
+        self.request_id = request_id
+        self.sampler = Sampler()
+        # Skipped if another request (or PYTHONTRACEMALLOC) is already tracing
+        self.memory: bool = memory and not tracemalloc.is_tracing() and _memoryLock.acquire(blocking=False)
+        self._baseline: tracemalloc.Snapshot|None = None
+
+    def start(self)->None:
+        if self.memory:
+            tracemalloc.start(25)
+            self._baseline = tracemalloc.take_snapshot()
+        self.sampler.start()
+        return
+
+    def stop(self)->list[str]:
+        """
+        Stop sampling (and tracing) and save the reports, returns their paths.
+        """
+        self.sampler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        paths: list[str] = [os.path.join(PROFILE_DIR, f'{self.request_id}.folded')]
+        with open(paths[0], 'w') as f: f.write(self.sampler.collapsed())
+        if self.memory:
+            try:
+                snapshot: tracemalloc.Snapshot = tracemalloc.take_snapshot()
+                peak: int = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+                _memoryLock.release()
+            paths.append(os.path.join(PROFILE_DIR, f'{self.request_id}.alloc.txt'))
+            with open(paths[1], 'w') as f: f.write(self._allocations(snapshot, peak))
+        return paths
+
+    def _allocations(self, snapshot: tracemalloc.Snapshot, peak: int)->str:
+        # Allocations made (and still held) during the request by line,
+        # leaving out tracemalloc's and the profiler's own
+        ignored = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+        stats = snapshot.filter_traces(ignored).compare_to(self._baseline.filter_traces(ignored), 'lineno')
+        lines: list[str] = [f'request {self.request_id}: peak traced {peak/2**20:.1f}MB, '
+                            f'net {sum(s.size_diff for s in stats)/2**20:+.1f}MB']
+        lines += [str(stat) for stat in stats[:PROFILE_TOP]]
+        return '\n'.join(lines)+'\n'
+
+class ProfilerMiddleware:
+    """
+    Profiles the requests sent with the admin X-Profile header (or all
+    requests with PROFILE_ALL), adding the profile's id to the response
+    as X-Profile-Id. Other requests are passed through untouched.
+    """
+    def __init__(self, app: ASGIApp, token: str|None=PROFILE_TOKEN, always: bool=PROFILE_ALL):
+        self.app = app
+        self.token = token
+        self.always = always
+
+    def _wanted(self, headers: Headers)->bool:
+        if self.always: return True
+        given: str|None = headers.get('X-Profile')
+        return self.token!=None and given!=None and hmac.compare_digest(given, self.token)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send)->None:
+        headers = Headers(scope=scope) if scope['type']=='http' else None
+        if headers==None or not self._wanted(headers):
+            await self.app(scope, receive, send)
+            return
+        # Client supplied ids are kept if safe to use as a file name
+        requestId: str = headers.get('X-Request-ID', '')
+        if not re.fullmatch(r'[A-Za-z0-9_.-]{1,64}', requestId) or requestId.startswith('.'):
+            requestId = uuid.uuid4().hex
+        profile = Profile(requestId, memory=headers.get('X-Profile-Memory')=='1')
+
+        async def send_with_id(message: Message)->None:
+            if message['type']=='http.response.start':
+                MutableHeaders(scope=message)['X-Profile-Id'] = requestId
+            await send(message)
+
+        profile.start()
+        try: await self.app(scope, receive, send_with_id)
+        finally:
+            # Snapshots and file writes off the event loop
+            await asyncio.to_thread(profile.stop)
+        return
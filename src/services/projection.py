@@ -0,0 +1,92 @@
+"""
+Reduced-dimensionality embeddings. A projection maps full width
+text-embedding-004 vectors (768 dims) to fewer dimensions, either by
+truncating (same as gemini's output_dimensionality) or with a fitted PCA.
+Stored rows and query vectors must go through the same projection.
+"""
+# System
+import os
+import threading
+# Third party
+import numpy as np
+
+class Projection:
+    """
+    Linear projection: reduced = normalize((vector-mean)@components.T)
+    Truncation is the special case of a zero mean and identity rows.
+    """
+    def __init__(self, mean: np.ndarray, components: np.ndarray, method: str):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.method = method
+
+    @property
+    def dims(self)->int:
+        return self.components.shape[0]
+
+    @property
+    def input_dims(self)->int:
+        return self.components.shape[1]
+
+    @classmethod
+    def truncate(cls, dims: int, input_dims: int=768):
+        return cls(np.zeros(input_dims), np.eye(dims, input_dims), 'truncate')
+
+    @classmethod
+    def fit_pca(cls, vectors, dims: int):
+        """
+        Fit a PCA projection on a sample of (full width) stored vectors.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        mean: np.ndarray = vectors.mean(axis=0)
+        # Right singular vectors are the principal components
+        __, __, vt = np.linalg.svd(vectors-mean, full_matrices=False)
+        return cls(mean, vt[:dims], 'pca')
+
+    def apply(self, vectors)->np.ndarray:
+        """
+        Project one vector or a matrix of vectors and rescale to unit length.
+        """
+        reduced: np.ndarray = (np.asarray(vectors, dtype=np.float32)-self.mean)@self.components.T
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        return reduced/np.where(norms==0, 1, norms)
+
+    def save(self, path: str)->None:
+        np.savez(path, mean=self.mean, components=self.components, method=self.method)
+        return
+
+    @classmethod
+    def load(cls, path: str):
+        data = np.load(path)
+        return cls(data['mean'], data['components'], str(data['method']))
+
+# Projection used by the running service, configured with env vars:
+#   EMBEDDING_PROJECTION: path to a saved (pca) projection .npz
+#   EMBEDDING_DIMENSIONS: truncate to this many dims if no projection file
+# NOTE: Neither set means full width vectors and the original match_documents rpc
+_projection: Projection|None = None
+_projectionLock = threading.Lock()
+
+def get_projection()->Projection|None:
+    global _projection
+    path: str|None = os.getenv('EMBEDDING_PROJECTION')
+    dims: str|None = os.getenv('EMBEDDING_DIMENSIONS')
+    if path==None and dims==None: return None
+    if _projection==None:
+        with _projectionLock:
+            if _projection==None:
+                _projection = Projection.load(path) if path!=None else Projection.truncate(int(dims))
+    return _projection
+
+def reduce_query(vector: list[float])->list[float]:
+    """
+    Project a query vector into the stored embedding space if a projection
+    is configured. Vectors already at the reduced width (e.g. created with
+    output_dimensionality) are only renormalized.
+    """
+    projection: Projection|None = get_projection()
+    if projection==None: return vector
+    if len(vector)==projection.dims:
+        v = np.asarray(vector, dtype=np.float32)
+        return (v/(np.linalg.norm(v) or 1)).tolist()
+    return projection.apply(vector).tolist()
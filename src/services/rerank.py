@@ -0,0 +1,114 @@
+"""
+Local reranking of similarity search hits before they're passed to the LLM.
+Maximal marginal relevance (MMR) trades off similarity to the query against
+similarity to already selected hits, removing near-duplicate chunks.
+"""
+from __future__ import annotations
+# System
+from typing import TYPE_CHECKING
+# Local
+from .db import get_embedding_vectors
+from .ann import get_index
+from .projection import reduce_query
+# Third party
+import numpy as np
+if TYPE_CHECKING: from supabase import Client
+
+def _normalize(matrix: np.ndarray)->np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix/np.where(norms==0, 1, norms)
+
+def mmr(query: list[float], vectors: list[list[float]], k: int,
+        diversity: float=0.3, groups: list|None=None, max_per_group: int|None=None
+    )->list[int]:
+    """
+    Given a query vector and candidate vectors, greedily select up to k
+    candidate indices using maximal marginal relevance. A diversity of 0
+    returns plain similarity order, higher values penalize redundancy more.
+    If groups (e.g. video id per candidate) are given, at most `max_per_group`
+    candidates are selected from each group.
+    """
+    if len(vectors)<=0: return []
+    candidates: np.ndarray = _normalize(np.asarray(vectors, dtype=np.float32))
+    q: np.ndarray = _normalize(np.asarray(query, dtype=np.float32))
+
+    relevance: np.ndarray = candidates@q
+    # Pairwise cosine similarity between all candidates
+    pairwise: np.ndarray = candidates@candidates.T
+    # Highest similarity of each candidate to anything selected so far
+    redundancy: np.ndarray = np.zeros(len(candidates), dtype=np.float32)
+    available: np.ndarray = np.ones(len(candidates), dtype=bool)
+
+    # Map group labels to ints for counting selections per group
+    if groups!=None and max_per_group!=None:
+        __, labels = np.unique(np.asarray(groups, dtype=object).astype(str), return_inverse=True)
+        counts: np.ndarray = np.zeros(labels.max()+1, dtype=np.int32)
+
+    selected: list[int] = []
+    while len(selected)<k and available.any():
+        scores: np.ndarray = (1-diversity)*relevance-diversity*redundancy
+        scores[~available] = -np.inf
+        best: int = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, pairwise[best])
+        # Drop the rest of the group once it hits its cap
+        if groups!=None and max_per_group!=None:
+            counts[labels[best]] += 1
+            if counts[labels[best]]>=max_per_group:
+                available[labels==labels[best]] = False
+    return selected
+
+def diversify(client: Client, query: list[float], similar: list[dict], k: int,
+        diversity: float=0.3, max_per_video: int|None=2
+    )->list[dict]:
+    """
+    Given the records returned by a (larger) similarity search, fetch their
+    vectors and return the k most relevant and diverse records, with at most
+    `max_per_video` chunks from the same tutorial. Falls back to the search
+    order (still capped per video) if vectors aren't available.
+    """
+    try:
+        # Use the local index's vectors when one is loaded
+        index = get_index()
+        ids: list = [s['id'] for s in similar]
+        vectors: dict = index.get_vectors(ids) if index!=None else get_embedding_vectors(client, ids)
+    except Exception:
+        vectors = {}
+
+    # Only candidates with a vector can be scored by MMR
+    scored: list[dict] = [s for s in similar if s.get('id') in vectors]
+    if len(scored)<=0:
+        output: list[dict] = []
+        perVideo: dict[str, int] = {}
+        for sequence in similar:
+            count: int = perVideo.get(sequence.get('video_id'), 0)
+            if max_per_video!=None and count>=max_per_video: continue
+            perVideo[sequence.get('video_id')] = count+1
+            output.append(sequence)
+            if len(output)>=k: break
+        return output
+
+    selected: list[int] = mmr(
+        query=reduce_query(query), vectors=[vectors[s['id']] for s in scored], k=k,
+        diversity=diversity, groups=[s.get('video_id') for s in scored],
+        max_per_group=max_per_video,
+    )
+    return [scored[i] for i in selected]
+
+def reciprocal_rank_fusion(rankings: list[list[dict]], k: int=60)->list[dict]:
+    """
+    Merge several ranked lists of search records into one, scoring each
+    record by the sum of 1/(k+rank) over the lists it appears in.
+    Records are matched by their embeddings id.
+    """
+    scores: dict = {}
+    records: dict = {}
+    for ranking in rankings:
+        for rank, record in enumerate(ranking):
+            key = record.get('id', record.get('content'))
+            scores[key] = scores.get(key, 0.0)+1/(k+rank+1)
+            # Keep the record with the best similarity for the budgeter
+            if key not in records or (record.get('similarity') or 0)>(records[key].get('similarity') or 0):
+                records[key] = record
+    return [records[key] for key in sorted(scores, key=scores.get, reverse=True)]
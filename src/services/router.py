@@ -0,0 +1,206 @@
+"""
+Latency-aware model routing for the LLM stages. A request gets a deadline
+that's split across its remaining stages, each stage picks the preferred
+model that's expected (EWMA of observed latency) to fit its share, and
+calls running past the expected latency get a hedged duplicate on a faster
+model, with whichever finishes first being used. Latency is measured from
+when a call leaves the scheduler's queue (services.scheduler), time spent
+rate limited counts neither towards the estimates nor towards hedging.
+"""
+# System
+import os
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+# Local
+from .metrics import record
+from .cancel import Cancelled, cancelled, cancellation
+from .scheduler import track_admission
+
+# Candidate models per stage, in order of preference (quality)
+# NOTE: Later models are used when earlier ones don't fit the budget
+STAGE_MODELS: dict[str, list[str]] = {
+    'hyde': ['gemini-2.5-flash-lite-preview-06-17', 'gemini-2.0-flash-lite'],
+    'embed': ['text-embedding-004'],
+    'ground': ['gemini-2.0-flash-lite'],
+    'extract': ['gemini-2.0-flash-lite'],
+    'flowchart': ['gemini-2.0-flash-lite'],
+    'rename': ['gemini-2.0-flash', 'gemini-2.0-flash-lite'],
+    'fast': ['gemini-2.0-flash', 'gemini-2.0-flash-lite'],
+    'paragraph': ['gemini-2.5-flash', 'gemini-2.0-flash'],
+}
+# Relative share of the remaining deadline given to each stage
+STAGE_WEIGHTS: dict[str, float] = {
+    'hyde': 3, 'embed': 0.5, 'ground': 2, 'extract': 2,
+    'flowchart': 2, 'rename': 3, 'fast': 5, 'paragraph': 3,
+}
+# Starting latency estimates (seconds) before any calls are observed
+PRIOR_LATENCY: dict[str, float] = {
+    'gemini-2.5-flash-lite-preview-06-17': 4.0,
+    'gemini-2.5-flash': 8.0,
+    'gemini-2.0-flash': 4.0,
+    'gemini-2.0-flash-lite': 3.0,
+    'text-embedding-004': 0.5,
+}
+# Default request deadline (seconds) for /solve
+SOLVE_DEADLINE: float = float(os.getenv('SOLVE_DEADLINE', 60))
+# Hedge once a call takes this many times its model's EWMA latency
+HEDGE_FACTOR: float = float(os.getenv('HEDGE_FACTOR', 1.5))
+# Seconds between checks for hedging, deadlines and cancellation
+POLL_INTERVAL: float = 0.25
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when a stage couldn't finish within the request's deadline.
+    """
+    def __init__(self, stage: str):
+        self.stage = stage
+        super().__init__(f'Deadline exceeded during {stage}')
+
+class ModelRouter:
+    def __init__(self, alpha: float=0.3):
+        # Weight of the newest observation in the moving average
+        self.alpha = alpha
+        self._latency: dict[str, float] = dict(PRIOR_LATENCY)
+        self._lock = threading.Lock()
+        # Hedged and timed out calls keep running in the background
+        # NOTE: Can't cancel an in-flight HTTP request, only ignore it
+        self._executor = ThreadPoolExecutor(max_workers=int(os.getenv('ROUTER_WORKERS', 32)))
+
+    def observe(self, model: str, seconds: float)->None:
+        with self._lock:
+            previous: float = self._latency.get(model, seconds)
+            self._latency[model] = (1-self.alpha)*previous+self.alpha*seconds
+        return
+
+    def latency(self, model: str)->float:
+        with self._lock:
+            return self._latency.get(model, 5.0)
+
+    def snapshot(self)->dict[str, float]:
+        with self._lock:
+            return dict(self._latency)
+
+    def choose(self, stage: str, budget: float|None)->list[str]:
+        """
+        Return the stage's candidates ordered by which to try first:
+        the most preferred model expected to fit the budget, then the
+        remaining models fastest first (used for hedging).
+        """
+        candidates: list[str] = STAGE_MODELS[stage]
+        fits: list[str] = [m for m in candidates if budget==None or self.latency(m)<=budget]
+        first: str = fits[0] if len(fits)>0 else min(candidates, key=self.latency)
+        return [first]+sorted((m for m in candidates if m!=first), key=self.latency)
+
+    def _timed(self, model: str, fn: Callable[[str], object], attempt: dict):
+        # NOTE: Calls also check the attempt's own event, set by run once
+        # they're no longer needed (cancelled, timed out or hedge lost)
+        with cancellation(attempt['stop']), track_admission(attempt):
+            result = fn(model)
+        # Timed from when the call left the scheduler's queue, calls that
+        # never went through it (e.g. cached) are timed as a whole
+        started: float = attempt['started'] if attempt['started']!=None else attempt['submitted']
+        self.observe(model, time.monotonic()-started)
+        return result
+
+    def run(self, stage: str, fn: Callable[[str], object], hedge: bool=True):
+        """
+        Call fn(model) for the stage within its share of the request deadline,
+        hedging on the next fastest model (or the same one) if it's slow.
+        Calls with side effects as they run (e.g. streaming) pass hedge=False.
+        """
+        budget: float|None = stage_budget(stage)
+        models: list[str] = self.choose(stage, budget)
+        started: float = time.monotonic()
+        stop = threading.Event()
+        # Run in the caller's context so the scheduler sees the same user
+        first: dict = self._attempt(stop)
+        futures: dict = {self._submit(models[0], fn, first): models[0]}
+        hedged: bool = False
+        hedgeAt: float = self.latency(models[0])*HEDGE_FACTOR
+        try:
+            while True:
+                done, __ = wait(futures, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    model: str = futures.pop(future)
+                    # Failed attempts are ignored while another is still running
+                    if future.exception()!=None and len(futures)>0: continue
+                    result = future.result()
+                    record(f'stage.{stage}', model=model, latency=time.monotonic()-started, hedged=hedged)
+                    return result
+                # Client went away, drop calls that haven't started
+                # NOTE: Running calls finish in the background, results ignored
+                if cancelled():
+                    record(f'stage.{stage}', cancelled=1)
+                    raise Cancelled()
+                elapsed: float = time.monotonic()-started
+                if budget!=None and elapsed>=budget:
+                    record(f'stage.{stage}', model=models[0], timed_out=1, hedged=hedged)
+                    raise DeadlineExceeded(stage)
+                # Only hedge a call that's running slow, one still
+                # waiting in the scheduler's queue would just queue twice
+                running: float|None = first['started']
+                if hedge and not hedged and running!=None and time.monotonic()-running>=hedgeAt:
+                    # Duplicate the call, on a faster model when there's one
+                    hedgeModel: str = models[1] if len(models)>1 else models[0]
+                    futures[self._submit(hedgeModel, fn, self._attempt(stop))] = hedgeModel
+                    hedged = True
+                    record(f'stage.{stage}', hedges=1)
+        finally:
+            # Calls left over (lost the hedge, cancelled or timed out) give up
+            # their place in the scheduler's queue instead of using quota
+            for future in futures: future.cancel()
+            stop.set()
+            _finish(stage)
+
+    def _attempt(self, stop: threading.Event)->dict:
+        return {'stop': stop, 'submitted': time.monotonic(), 'started': None}
+
+    def _submit(self, model: str, fn: Callable[[str], object], attempt: dict):
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, self._timed, model, fn, attempt)
+
+# Deadline state for the current request: when it expires and
+# which stages are still left to share the remaining time
+_deadline: ContextVar[dict|None] = ContextVar('deadline', default=None)
+
+@contextmanager
+def deadline(seconds: float, stages: list[str]):
+    token = _deadline.set({'expires_at': time.monotonic()+seconds, 'stages': list(stages)})
+    try: yield
+    finally: _deadline.reset(token)
+
+def stage_budget(stage: str)->float|None:
+    """
+    Seconds the stage may take: its weighted share of what's left
+    of the deadline among the remaining stages (None if no deadline).
+    """
+    state: dict|None = _deadline.get()
+    if state==None: return None
+    remaining: float = max(0.0, state['expires_at']-time.monotonic())
+    stages: list[str] = state['stages'] if stage in state['stages'] else [stage]+state['stages']
+    total: float = sum(STAGE_WEIGHTS.get(s, 1) for s in stages)
+    return remaining*STAGE_WEIGHTS.get(stage, 1)/total
+
+def remaining()->float|None:
+    """
+    Seconds left before the current request's deadline.
+    """
+    state: dict|None = _deadline.get()
+    if state==None: return None
+    return max(0.0, state['expires_at']-time.monotonic())
+
+def _finish(stage: str)->None:
+    state: dict|None = _deadline.get()
+    if state!=None and stage in state['stages']: state['stages'].remove(stage)
+    return
+
+# Router shared by every request in the process
+router = ModelRouter()
+
+def route(stage: str, fn: Callable[[str], object], hedge: bool=True):
+    return router.run(stage, fn, hedge=hedge)
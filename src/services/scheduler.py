@@ -0,0 +1,237 @@
+"""
+Admission control for every gemini call (generate and embed). Calls wait
+for per-model request/token budgets (token buckets matching the provider's
+RPM/TPM limits), are served fairly across users, and calls from pipelines
+that already made progress go before new ones. New pipelines are rejected
+early (503 + Retry-After) when the estimated wait is past a deadline,
+instead of failing partway through the chain.
+"""
+# System
+import os
+import math
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+# Local
+from .metrics import record
+from .cancel import Cancelled, cancelled
+
+# Requests and tokens per minute allowed for each model
+# NOTE: Free tier limits (as of Jul 2025), unknown models use DEFAULT_LIMITS
+MODEL_LIMITS: dict[str, tuple[int, int]] = {
+    'gemini-2.0-flash-lite': (30, 1_000_000),
+    'gemini-2.0-flash': (15, 1_000_000),
+    'gemini-2.5-flash': (10, 250_000),
+    'gemini-2.5-flash-lite-preview-06-17': (15, 250_000),
+    'text-embedding-004': (1500, 1_000_000),
+}
+DEFAULT_LIMITS: tuple[int, int] = (15, 250_000)
+# Worker processes sharing the limits (serve.py sets it from --workers),
+# each process schedules against its share of them
+# NOTE: Buckets are per process, they aren't coordinated across workers
+PROCESSES: int = max(1, int(os.getenv('WEB_CONCURRENCY', 1)))
+# Longest estimated wait (seconds) a new pipeline is admitted with
+MAX_WAIT: float = float(os.getenv('LLM_MAX_WAIT', 20))
+
+class Overloaded(Exception):
+    """
+    Raised when a call can't be admitted within the deadline.
+    retry_after is the estimated number of seconds until it could be.
+    """
+    def __init__(self, model: str, retry_after: float):
+        self.model = model
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(f'{model} is overloaded, retry after {self.retry_after}s')
+
+class TokenBucket:
+    """
+    Classic token bucket refilled continuously at `rate` per second
+    up to `capacity`. Not thread-safe, guarded by the scheduler's lock.
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self)->None:
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens+(now-self.updated)*self.rate)
+        self.updated = now
+        return
+
+    def wait_time(self, amount: float)->float:
+        """
+        Seconds until `amount` tokens are available (0 if they are now).
+        """
+        self._refill()
+        # Requests bigger than the bucket only need it full
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount-self.tokens)/self.rate)
+
+    def take(self, amount: float)->None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+        return
+
+class _Ticket:
+    def __init__(self, user: str, tokens: int, priority: int, start: float, seq: int):
+        self.user = user
+        self.tokens = tokens
+        # 0 for pipelines already in progress, 1 for new ones
+        self.priority = priority
+        # Virtual start time for fair queueing across users
+        self.start = start
+        self.seq = seq
+
+    def order(self)->tuple:
+        return (self.priority, self.start, self.seq)
+
+class _ModelQueue:
+    def __init__(self, rpm: float, tpm: float):
+        self.requests = TokenBucket(rpm/60, rpm)
+        self.tokens = TokenBucket(tpm/60, tpm)
+        self.pending: list[_Ticket] = []
+        # Start time fair queueing state, virtual clock and
+        # the virtual finish time of each user's last ticket
+        # NOTE: Only users with a finish time ahead of the clock are kept
+        self.clock: float = 0.0
+        self.finish: dict[str, float] = {}
+
+    def wait_time(self, tokens: int)->float:
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def estimate(self, tokens: int)->float:
+        """
+        Estimated seconds until a new ticket would be served,
+        draining everything already queued for the model first.
+        """
+        queued: int = len(self.pending)+1
+        queuedTokens: int = sum(t.tokens for t in self.pending)+tokens
+        self.requests._refill()
+        self.tokens._refill()
+        return max(
+            (queued-self.requests.tokens)/self.requests.rate,
+            (queuedTokens-self.tokens.tokens)/self.tokens.rate,
+            0.0,
+        )
+
+class LlmScheduler:
+    def __init__(self, limits: dict[str, tuple[int, int]]=MODEL_LIMITS, max_wait: float=MAX_WAIT):
+        self.limits = limits
+        self.max_wait = max_wait
+        self._queues: dict[str, _ModelQueue] = {}
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+
+    def _queue(self, model: str)->_ModelQueue:
+        if model not in self._queues:
+            rpm, tpm = self.limits.get(model, DEFAULT_LIMITS)
+            self._queues[model] = _ModelQueue(rpm/PROCESSES, tpm/PROCESSES)
+        return self._queues[model]
+
+    def check(self, models: list[str], tokens: int=0)->None:
+        """
+        Raise Overloaded if a new pipeline using the given models
+        would wait longer than the deadline on any of them.
+        """
+        with self._cond:
+            for model in models:
+                wait: float = self._queue(model).estimate(tokens)
+                if wait>self.max_wait:
+                    record('scheduler', rejected=1)
+                    raise Overloaded(model, wait)
+        return
+
+    def acquire(self, model: str, tokens: int, user: str, inflight: bool)->float:
+        """
+        Block until the call is at the head of the model's fair queue and
+        within budget. Returns the seconds spent waiting.
+        """
+        started: float = time.monotonic()
+        with self._cond:
+            queue: _ModelQueue = self._queue(model)
+            # New pipelines are rejected up front if the wait is too long,
+            # in-flight ones always queue so their earlier calls aren't wasted
+            if not inflight:
+                wait: float = queue.estimate(tokens)
+                if wait>self.max_wait:
+                    record('scheduler', rejected=1)
+                    raise Overloaded(model, wait)
+            start: float = max(queue.clock, queue.finish.get(user, 0.0))
+            queue.finish[user] = start+1
+            ticket = _Ticket(user, tokens, 0 if inflight else 1, start, next(self._seq))
+            queue.pending.append(ticket)
+            try:
+                while True:
+                    # Give up the spot in the queue if the client went away
+                    if cancelled(): raise Cancelled()
+                    head: _Ticket = min(queue.pending, key=_Ticket.order)
+                    if head is ticket:
+                        wait = queue.wait_time(tokens)
+                        if wait<=0: break
+                    else: wait = None # Woken up when someone is served
+                    # NOTE: Wake up periodically to check for cancellation
+                    self._cond.wait(timeout=min(wait or 0.5, 0.5))
+                queue.requests.take(1)
+                queue.tokens.take(tokens)
+                queue.clock = ticket.start
+            finally:
+                queue.pending.remove(ticket)
+                # Users whose last ticket finished start at the clock like users
+                # never seen, forgotten so the dict only holds backlogged users
+                # NOTE: Nobody is backlogged once the queue is empty
+                if len(queue.pending)<=0: queue.finish.clear()
+                else:
+                    for idle in [u for u, f in queue.finish.items() if f<=queue.clock]:
+                        del queue.finish[idle]
+                self._cond.notify_all()
+        waited: float = time.monotonic()-started
+        record('scheduler', model=model, waited=waited)
+        return waited
+
+# Per request pipeline state, used to attribute calls to users and
+# to prioritize pipelines that already completed a stage
+_pipeline: ContextVar[dict|None] = ContextVar("llm_user", default=None)
+
+@contextmanager
+def llm_user(user_id: str, inflight: bool=False):
+    """
+    Mark the calls made inside the block as part of one user's request.
+    Set inflight when continuing a request that already made calls.
+    """
+    token = _pipeline.set({'user': user_id, 'calls': 1 if inflight else 0})
+    try: yield
+    finally: _pipeline.reset(token)
+
+# Set by callers timing their calls (services.router), gets the time
+# the first scheduled call was admitted, i.e. when it left the queue
+_admitted: ContextVar[dict|None] = ContextVar('admitted', default=None)
+
+@contextmanager
+def track_admission(state: dict):
+    """
+    Record in state['started'] when the first call inside the block
+    is admitted (monotonic time), None while it's still queued.
+    """
+    token = _admitted.set(state)
+    try: yield
+    finally: _admitted.reset(token)
+
+# Scheduler shared by every call in the process
+scheduler = LlmScheduler()
+
+def schedule(model: str, tokens: int, fn, /, *args, **kwargs):
+    """
+    Run fn (a gemini call) once admitted by the shared scheduler.
+    """
+    state: dict|None = _pipeline.get()
+    user: str = state['user'] if state!=None else 'anonymous'
+    inflight: bool = state!=None and state['calls']>0
+    scheduler.acquire(model, tokens, user, inflight)
+    if state!=None: state['calls'] += 1
+    admitted: dict|None = _admitted.get()
+    if admitted!=None and admitted.get('started')==None: admitted['started'] = time.monotonic()
+    return fn(*args, **kwargs)
@@ -0,0 +1,43 @@
+"""
+Single pass json serialization for responses, prompts and usage metadata.
+Artifacts are dumped once with orjson or a cached pydantic TypeAdapter
+(both in rust) and the same bytes/str reused wherever they're needed,
+instead of model_dump -> jsonable_encoder -> json.dumps on every hop.
+"""
+# Local
+from ..models.general import Graph, ExpandedGraph, Sequence, Video, BatchResponse
+# Third party
+import orjson
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+from pydantic import TypeAdapter
+
+# Built once per process, building an adapter is the expensive part
+GRAPH: TypeAdapter[Graph] = TypeAdapter(Graph)
+EXPANDED_GRAPH: TypeAdapter[ExpandedGraph] = TypeAdapter(ExpandedGraph)
+VIDEOS: TypeAdapter[list[Video]] = TypeAdapter(list[Video])
+SEQUENCES: TypeAdapter[list[Sequence]] = TypeAdapter(list[Sequence])
+BATCH: TypeAdapter[BatchResponse] = TypeAdapter(BatchResponse)
+
+def dumps(data)->str:
+    """
+    Drop-in for json.dumps on plain python data (dicts, lists...).
+    """
+    return orjson.dumps(data).decode()
+
+class JsonResponse(ORJSONResponse):
+    """
+    Default response class, orjson instead of the stdlib encoder.
+    Pre-serialized bytes (see json_response) are passed through as is.
+    """
+    def render(self, content)->bytes:
+        if isinstance(content, bytes): return content
+        return super().render(content)
+
+def json_response(adapter: TypeAdapter, value, status_code: int=200)->Response:
+    """
+    Serialize a response model with its cached adapter in one pass.
+    NOTE: Returning a Response skips FastAPI's validation and
+    jsonable_encoder of the endpoint's response_model (kept for the docs)
+    """
+    return JsonResponse(adapter.dump_json(value), status_code=status_code)
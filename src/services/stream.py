@@ -0,0 +1,100 @@
+"""
+Incremental parsing of streamed structured (json) graph responses.
+Each node and edge is emitted as soon as its object closes, so the
+frontend can start drawing while the model is still writing notes.
+"""
+# System
+import json
+from typing import Callable, Iterable
+# Third party
+from pydantic import BaseModel
+
+# Arrays whose elements are emitted as they complete, with the event name
+ITEM_KEYS: dict[str, str] = {'nodes': 'node', 'edges': 'edge'}
+
+class GraphStreamParser:
+    """
+    Minimal incremental json scanner for Graph responses, either at the
+    root or nested under a `graph` key (FastSolution). Feed it text chunks
+    and it returns the (event, data) pairs completed by each chunk.
+    """
+    def __init__(self):
+        self.text: str = ''
+        self._pos: int = 0
+        # Open containers: type ('obj'/'arr'), key in parent, start index,
+        # and for objects the last key read and if a key is expected next
+        self._stack: list[dict] = []
+        self._inString: bool = False
+        self._escape: bool = False
+        self._stringStart: int = 0
+
+    def _is_graph(self, depth: int)->bool:
+        return depth==1 or (depth==2 and self._stack[1]['key']=='graph')
+
+    def feed(self, chunk: str)->list[tuple[str, object]]:
+        events: list[tuple[str, object]] = []
+        self.text += chunk
+        text: str = self.text
+        for i in range(self._pos, len(text)):
+            char: str = text[i]
+            if self._inString:
+                if self._escape: self._escape = False
+                elif char=='\\': self._escape = True
+                elif char=='"':
+                    self._inString = False
+                    self._string_closed(i, events)
+                continue
+            if char=='"':
+                self._inString = True
+                self._stringStart = i
+            elif char in '{[':
+                parent: dict|None = self._stack[-1] if len(self._stack)>0 else None
+                # Array elements inherit the array's key (e.g. nodes)
+                key: str|None = None
+                if parent!=None: key = parent['lastKey'] if parent['type']=='obj' else parent['key']
+                self._stack.append({
+                    'type': 'obj' if char=='{' else 'arr', 'key': key,
+                    'start': i, 'lastKey': None, 'expectKey': char=='{',
+                })
+            elif char in '}]':
+                # Stray or mismatched closers of malformed output are
+                # skipped, the response fails validation at the end
+                if len(self._stack)<=0 or self._stack[-1]['type']!=('obj' if char=='}' else 'arr'): continue
+                frame: dict = self._stack.pop()
+                parent = self._stack[-1] if len(self._stack)>0 else None
+                if frame['type']=='obj' and parent!=None and parent['type']=='arr' and parent['key'] in ITEM_KEYS:
+                    # Only items of the graph's own arrays
+                    if self._is_graph(len(self._stack)-1):
+                        try: events.append((ITEM_KEYS[parent['key']], json.loads(text[frame['start']:i+1])))
+                        except json.JSONDecodeError: pass # Malformed item, not emitted
+            elif char==',' and len(self._stack)>0 and self._stack[-1]['type']=='obj':
+                self._stack[-1]['expectKey'] = True
+        self._pos = len(text)
+        return events
+
+    def _string_closed(self, end: int, events: list)->None:
+        if len(self._stack)<=0: return
+        frame: dict = self._stack[-1]
+        if frame['type']!='obj': return
+        try: value: str = json.loads(self.text[self._stringStart:end+1])
+        except json.JSONDecodeError: return # Invalid escapes
+        if frame['expectKey']:
+            frame['lastKey'] = value
+            frame['expectKey'] = False
+        elif frame['lastKey']=='name' and self._is_graph(len(self._stack)):
+            events.append(('name', value))
+        return
+
+def collect(chunks: Iterable[str], schema: type[BaseModel], stage: str,
+        emit: Callable[[dict], None]
+    )->BaseModel:
+    """
+    Consume a stream of text chunks, emitting the graph's name, nodes and
+    edges as they complete, and return the full response validated
+    against the schema (e.g. models.general.Graph) once the stream ends.
+    """
+    parser = GraphStreamParser()
+    for chunk in chunks:
+        for event, data in parser.feed(chunk):
+            emit({'event': event, 'stage': stage, 'data': data})
+    return schema.model_validate_json(parser.text)
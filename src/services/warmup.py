@@ -0,0 +1,67 @@
+"""
+Startup warmup, run in the background right after the server starts so
+the first requests don't pay for SDK imports, client creation, the
+technique catalog or the video snapshot. Readiness (GET /ready) is only
+reported once the required steps are done.
+"""
+# System
+import os
+import time
+import threading
+from typing import Callable
+# Local
+from .llm import conn_gemini, types
+from .db import conn_supabase, get_techniques_cached, get_videos_cached
+from .ann import get_index
+from .projection import get_projection
+from .answers import get_answers
+from .metrics import record
+
+# Ping gemini during warmup to open its connection (WARMUP_GEMINI_PING=0 to skip)
+GEMINI_PING: bool = os.getenv('WARMUP_GEMINI_PING', '1')=='1'
+
+_state: dict = {'ready': False, 'started_at': None, 'seconds': None, 'steps': {}, 'errors': {}}
+_lock = threading.Lock()
+
+def _step(name: str, fn: Callable[[], object], required: bool=True)->None:
+    started: float = time.perf_counter()
+    try: fn()
+    except Exception as e:
+        # Optional steps only slow down the first requests when they fail
+        if required: _state['errors'][name] = str(e)
+        else: _state['errors'][name] = f'(optional) {str(e)}'
+    _state['steps'][name] = round(time.perf_counter()-started, 3)
+    return
+
+def warmup()->dict:
+    """
+    Create the shared clients, import the SDKs, load the cached catalog,
+    video snapshot and local index, and open connections. Returns status().
+    """
+    with _lock:
+        if _state['ready']: return status()
+        _state['started_at'] = time.time()
+        _state['errors'] = {}
+        started: float = time.perf_counter()
+        # NOTE: Building a config imports the genai types (the slowest import)
+        _step('gemini', lambda: (conn_gemini(), types.GenerateContentConfig()))
+        _step('supabase', conn_supabase)
+        _step('catalog', lambda: get_techniques_cached(conn_supabase()))
+        _step('videos', lambda: get_videos_cached(conn_supabase()), required=False)
+        _step('index', lambda: (get_index(), get_projection()), required=False)
+        _step('answers', get_answers, required=False)
+        if GEMINI_PING:
+            _step('gemini_connection', lambda: conn_gemini().models.get(model='gemini-2.0-flash-lite'), required=False)
+        _state['seconds'] = round(time.perf_counter()-started, 3)
+        _state['ready'] = not any(not e.startswith('(optional)') for e in _state['errors'].values())
+        record('warmup', seconds=_state['seconds'], ready=_state['ready'])
+    return status()
+
+def is_ready()->bool:
+    return _state['ready']
+
+def running()->bool:
+    return _lock.locked()
+
+def status()->dict:
+    return {**_state, 'steps': dict(_state['steps']), 'errors': dict(_state['errors'])}
@@ -11,6 +11,19 @@ load_dotenv()
 def conn_youtube() -> Resource:
     return build('youtube', 'v3', developerKey=os.getenv('YOUTUBE'))
 
+# Most ids the videos().list endpoint accepts per request
+BATCH_SIZE: int = 50
+
+def _to_video(item: dict) -> Video:
+    # Reshape a videos().list item (snippet part) into a Video
+    return Video(
+        id=item['id'], title=item['snippet']['title'],
+        description=item['snippet']['description'],
+        uploaded_at=item['snippet']['publishedAt'],
+        thumbnail=item['snippet']['thumbnails']['default']['url'],
+        uploaded_by=item['snippet']['channelTitle']
+    )
+
 def get_basic_info(client: Resource, videoId:str) -> Video | None:
     """
     Function for getting basic youtube information snippet.
@@ -25,15 +38,22 @@ def get_basic_info(client: Resource, videoId:str) -> Video | None:
     # and create Video object if data is available
     reshaped=None
     if len(response['items'])>0:
-        reshaped = Video(
-            id=videoId, title=response['items'][0]['snippet']['title'],
-            description=response['items'][0]['snippet']['description'],
-            uploaded_at=response['items'][0]['snippet']['publishedAt'],
-            thumbnail=response['items'][0]['snippet']['thumbnails']['default']['url'],
-            uploaded_by=response['items'][0]['snippet']['channelTitle']
-        )
+        reshaped = _to_video(response['items'][0])
     return reshaped
 
+def get_basic_info_batch(client: Resource, videoIds: list[str]) -> dict[str, Video]:
+    """
+    Same as get_basic_info for up to BATCH_SIZE (50) videos in
+    a single request (1 quota unit), returns a dict of video id to
+    Video. Ids without metadata (e.g. removed videos) are left out.
+    """
+    if len(videoIds)>BATCH_SIZE: raise ValueError(f'At most {BATCH_SIZE} ids per request')
+    response = client.videos().list(
+        part='snippet',
+        id=','.join(videoIds),
+        maxResults=BATCH_SIZE,
+    ).execute()
+    return {item['id']: _to_video(item) for item in response['items']}
 
 if __name__=="__main__":
     # initialize a sample list of video Id's to
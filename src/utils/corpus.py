@@ -0,0 +1,198 @@
+"""
+Ingestion of new tutorials into the embeddings corpus searched by
+match_documents. Transcripts (or paragraphs) are broken down into
+sequences with extract_sequences, chunked, deduplicated by the SHA-256
+of each chunk's content, embedded in batched requests and bulk inserted.
+"""
+# System
+import os
+import re
+import json
+import hashlib
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# Local
+from ..models.general import Sequence
+from ..services.llm import conn_gemini, extract_sequences, create_embeddings, EMBED_BATCH_SIZE
+from ..services.db import conn_supabase, get_existing_hashes, insert_embedding_records
+from ..services.projection import get_projection
+from .ingest import batched
+from .jobs import Progress
+# Third party
+import numpy as np
+from google import genai
+from supabase import Client
+
+# Longest chunk (characters) embedded as one record
+CHUNK_CHARS: int = int(os.getenv('CHUNK_CHARS', 1500))
+# Concurrent extraction and embedding requests
+CORPUS_WORKERS: int = int(os.getenv('CORPUS_WORKERS', 4))
+# Hashes checked for duplicates per request
+HASH_BATCH_SIZE: int = 200
+
+def chunk_hash(content: str)->str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def chunk_sequence(sequence: Sequence, max_chars: int=CHUNK_CHARS)->list[dict]:
+    """
+    Turn an extracted sequence into paragraph chunks (name + content)
+    of at most max_chars, splitting between steps. A single step longer
+    than max_chars is kept whole rather than cut mid sentence.
+    """
+    chunks: list[dict] = []
+    steps: list[str] = []
+    for step in sequence.steps:
+        if len(steps)>0 and len(' '.join(steps+[step]))>max_chars:
+            chunks.append(' '.join(steps))
+            steps = []
+        steps.append(step.strip())
+    if len(steps)>0: chunks.append(' '.join(steps))
+    # Numbered names when a sequence spans several chunks
+    return [{
+        'name': sequence.name if len(chunks)==1 else f'{sequence.name} ({i+1})',
+        'content': content,
+    } for i, content in enumerate(chunks)]
+
+class EmbeddingStore(ABC):
+    """
+    Where ingested chunks are deduplicated against and written to.
+    existing returns the given content hashes that are already stored.
+    """
+    @abstractmethod
+    def existing(self, hashes: list[str])->set[str]: ...
+
+    @abstractmethod
+    def insert(self, records: list[dict])->None: ...
+
+class SupabaseStore(EmbeddingStore):
+    def __init__(self, client: Client):
+        self.client = client
+
+    def existing(self, hashes: list[str])->set[str]:
+        return get_existing_hashes(self.client, hashes)
+
+    def insert(self, records: list[dict])->None:
+        insert_embedding_records(self.client, records)
+        return
+
+class LocalStore(EmbeddingStore):
+    """
+    In-memory store for dry runs and tests.
+    """
+    def __init__(self):
+        self.records: list[dict] = []
+
+    def existing(self, hashes: list[str])->set[str]:
+        stored: set[str] = {record['content_hash'] for record in self.records}
+        return {h for h in hashes if h in stored}
+
+    def insert(self, records: list[dict])->None:
+        self.records.extend(records)
+        return
+
+class LocalGemini:
+    """
+    Stand-in for the gemini client with the calls used here: sequences
+    are every few sentences of the paragraph and embeddings are random
+    unit vectors seeded by the text (identical text, identical vector).
+    """
+    def __init__(self, dims: int=768, sentences: int=4):
+        self.models = self
+        self.dims = dims
+        self.sentences = sentences
+
+    def generate_content(self, model: str, contents: list, config=None):
+        sentences: list[str] = [s for s in re.split(r'(?<=[.!?])\s+', contents[0]) if s.strip()]
+        groups: list[list[str]] = batched(sentences, self.sentences)
+        return SimpleNamespace(parsed=[
+            Sequence(name=f'Sequence {i+1}', steps=group) for i, group in enumerate(groups)
+        ])
+
+    def embed_content(self, model: str, contents: list, config=None):
+        embeddings: list = []
+        for text in contents:
+            rng = np.random.default_rng(int(chunk_hash(text)[:16], 16))
+            vector: np.ndarray = rng.standard_normal(self.dims)
+            embeddings.append(SimpleNamespace(values=(vector/np.linalg.norm(vector)).tolist()))
+        return SimpleNamespace(embeddings=embeddings)
+
+def ingest_transcripts(gemini: genai.Client, store: EmbeddingStore, transcripts: list[dict],
+        workers: int=CORPUS_WORKERS, batch: int=EMBED_BATCH_SIZE
+    )->dict:
+    """
+    Given transcripts ({'video_id', 'text'}), extract their sequences,
+    chunk them and insert the chunks that aren't already stored
+    (by content hash) with their embeddings, a batch at a time.
+    A failed batch is reported and skipped, the rest are still inserted
+    (and its chunks are picked up by the next run, they aren't stored).
+    Returns counts of the extracted, duplicate, inserted and failed chunks.
+    """
+    report: dict = {'transcripts': len(transcripts), 'failed': 0, 'chunks': 0, 'duplicates': 0,
+                    'inserted': 0, 'failed_chunks': 0}
+
+    def extract(transcript: dict)->list[dict]:
+        extracted: list[Sequence] = extract_sequences(client=gemini, paragraph=transcript['text']).parsed or []
+        return [
+            {**chunk, 'video_id': transcript['video_id'], 'content_hash': chunk_hash(chunk['content'])}
+            for sequence in extracted for chunk in chunk_sequence(sequence)
+        ]
+
+    # Break down every transcript, deduplicating chunks within the run
+    chunks: dict[str, dict] = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures: list = [executor.submit(extract, transcript) for transcript in transcripts]
+        for transcript, future in zip(transcripts, futures):
+            try:
+                for chunk in future.result():
+                    report['chunks'] += 1
+                    chunks.setdefault(chunk['content_hash'], chunk)
+            except Exception as e:
+                report['failed'] += 1
+                print(f"\t{transcript['video_id']}: Failed to extract sequences. Error: {str(e)[:80]}")
+
+    # Skip chunks already in the corpus
+    hashes: list[str] = list(chunks)
+    stored: set[str] = set()
+    for hashBatch in batched(hashes, HASH_BATCH_SIZE): stored |= store.existing(hashBatch)
+    new: list[dict] = [chunks[h] for h in hashes if h not in stored]
+    report['duplicates'] = report['chunks']-len(new)
+
+    # Embed and insert the new chunks, one request each per batch
+    projection = get_projection()
+    progress = Progress(total=len(new), label='chunks')
+
+    def embed(chunkBatch: list[dict])->int:
+        embedded = create_embeddings(gemini, paragraphs=[chunk['content'] for chunk in chunkBatch])
+        vectors: list[list[float]] = [embedding.values for embedding in embedded.embeddings]
+        records: list[dict] = [{**chunk, 'embedding': json.dumps(vector)} for chunk, vector in zip(chunkBatch, vectors)]
+        # Fill the reduced column too if searches use a projection
+        if projection!=None:
+            for record, reduced in zip(records, projection.apply(vectors)):
+                record['embedding_reduced'] = json.dumps(reduced.tolist())
+        store.insert(records)
+        progress.advance(len(records))
+        return len(records)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures: dict = {executor.submit(embed, chunkBatch): chunkBatch for chunkBatch in batched(new, batch)}
+        for future in as_completed(futures):
+            try:
+                report['inserted'] += future.result()
+            except Exception as e:
+                report['failed_chunks'] += len(futures[future])
+                print(f'\tFailed batch of {len(futures[future])} chunks: {str(e)[:80]}')
+    print(f"{report['inserted']} chunks inserted, {report['duplicates']} duplicates skipped "
+          f"from {report['transcripts']} transcripts ({report['failed']} failed, "
+          f"{report['failed_chunks']} chunks failed)")
+    return report
+
+# Driver ingesting transcripts from a json file ([{video_id, text}, ...])
+# NOTE: Pass --dry-run to use the local fake backends
+if __name__=="__main__":
+    import sys
+    with open(sys.argv[1]) as f: transcripts: list[dict] = json.load(f)
+    if '--dry-run' in sys.argv:
+        ingest_transcripts(LocalGemini(), LocalStore(), transcripts)
+    else:
+        ingest_transcripts(conn_gemini(), SupabaseStore(conn_supabase()), transcripts)
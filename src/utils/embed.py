@@ -1,45 +1,38 @@
-# System
-import time
 # Local
-from ..models.general import Video
-from ..services.db import conn_supabase, get_unique_embedded_videoids, insert_video_record, update_video_record
-from .. services.youtube import conn_youtube, get_basic_info
+from ..services.db import conn_supabase, get_unique_embedded_videoids, scan
+from ..services.youtube import conn_youtube
+from .ingest import ingest_videos
 # Third party
 from supabase import Client # imported for types since update_videos.. uses custom query
 
-def set_embedding_basic_info(start: int, timeout:int=5):
+def _fake_youtube():
+    # Local stand-in for dry runs, kept with the tests
+    # NOTE: Dry runs are started from the repo root
+    from tests.fakes import FakeYoutube
+    return FakeYoutube()
+
+def set_embedding_basic_info(dry_run: bool=False):
     """
     Function for collecting the basic information for all unique
     videos in the embedding table and storing that in the videos
     table. The function and data collection is used once as a script.
-    NOTE: Safer to run function in batches to avoid timeout errors.
+    NOTE: Videos are fetched 50 per request by concurrent workers
+    under a shared rate limit, see utils.ingest. Resumes automatically
+    from the job's checkpoint if a previous run was interrupted.
     """
     # Initalize supabase connection to create db client
     # and fetch a list of unique video id's from the embedding table
     db_client = conn_supabase()
     uniqueIds: list[str] = get_unique_embedded_videoids(client=db_client)
     # Initialize client for using the youtube data API
-    yt_client = conn_youtube()
-    # Iterate over the video Id's, grab their basic info
-    # and insert records into the video table
-    for id in uniqueIds[start:]: # NOTE: Run in batch to avoid timeout errors
-        print(f'{id}: Fetching metadata')
-        metadata: Video = get_basic_info(yt_client, id)        
-        # Handle cases where no metadata is available 
-        # by skipping the video and passing a msg to the terminal
-        if metadata==None:
-            print(f'\tNo metadata available. Skipped')
-            continue
-        # Else create a record in the videos table
-        try:
-            insert_video_record(client=db_client, video=metadata)
-            print(f'\tInserted record to video table.')
-        except: print(f'\tFailed to insert video record to db.')
-        # Call time.sleep to avoid rate-limit errors
-        time.sleep(timeout)
-    return
+    # NOTE: Dry runs use a local fake and don't write to the db
+    yt_client = _fake_youtube() if dry_run else conn_youtube()
+    # Fetch basic info for every video id
+    # and upsert the records into the video table
+    return ingest_videos(uniqueIds, yt_client=yt_client, db_client=db_client,
+                         dry_run=dry_run, job='embedding_basic_info')
 
-def update_videos_thumbnail_channel(start:int, timeout: int=2):
+def update_videos_thumbnail_channel(dry_run: bool=False):
     """
     For fetching and passing the thumbnail 
     along with the channel title, we need to 
@@ -51,30 +44,18 @@ def update_videos_thumbnail_channel(start:int, timeout: int=2):
     # Initialize client for using the supabase 
     # and the youtube data API's
     db_client: Client = conn_supabase()
-    yt_client = conn_youtube()
+    yt_client = _fake_youtube() if dry_run else conn_youtube()
     
     # Fetch all the unique videos by video ID in the videos table
-    response = (
-        db_client.table('videos')
-        .select('video_id')
-        .execute()
-    )
-
-    # Iterate over each of the id's 
-    # NOTE: Length is 180 rn (Jul 10, 2025)
-    # Going to run in batches to avoid hitting rate limits
-    for video in response.data[start:]:
-        # Fetch their basic info using the already
-        # created youtube service function
-        id = video['video_id']
-        metadata: Video = get_basic_info(yt_client, id)
+    # NOTE: Paged by video_id, a single select is capped at postgrest's max rows
+    videoIds: list[str] = [video['video_id'] for video in scan(
+        db_client, 'videos', 'video_id', key='video_id')]
 
-        # With the fetched basic info, extract required values
-        # and update the videos table to contain the values
-        response = update_video_record(db_client, metadata)
-        # Adding sleep to avoid hitting rate limits
-        time.sleep(timeout)
-    return
+    # Fetch their basic info in batches and update the videos table
+    # to contain the thumbnail and channel title values
+    # NOTE: Only videos whose metadata changed are written, see utils.jobs
+    return ingest_videos(videoIds, yt_client=yt_client, db_client=db_client,
+                         dry_run=dry_run, job='videos_refresh')
 
 # 3)
 # Review the usage script, mainly the queries
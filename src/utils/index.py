@@ -0,0 +1,70 @@
+# System
+import os
+import json
+from typing import Iterator
+# Local
+from ..services.db import conn_supabase, scan_pages, SCAN_PAGE_SIZE
+from ..services.ann import IvfIndex
+from ..services.projection import Projection, get_projection
+# Third party
+import numpy as np
+from supabase import Client
+
+def iter_embeddings(client: Client, page_size: int=SCAN_PAGE_SIZE)->Iterator[tuple[list[dict], list[list[float]]]]:
+    """
+    Generator over the embeddings table one page at a time, yielding
+    the records (without the vector) and their full width vectors.
+    """
+    for page in scan_pages(client, 'embeddings', 'id, name, content, video_id, embedding', page_size=page_size):
+        # NOTE: pgvector columns are serialized as strings
+        vectors: list[list[float]] = []
+        for record in page:
+            embedding = record.pop('embedding')
+            vectors.append(json.loads(embedding) if isinstance(embedding, str) else embedding)
+        yield page, vectors
+    return
+
+def fetch_embeddings(client: Client, page_size: int=SCAN_PAGE_SIZE)->tuple[list[dict], list[list[float]]]:
+    """
+    Return every record in the embeddings table (without the vector)
+    and the full width vectors in the same order.
+    """
+    # Page through the embeddings table to avoid
+    # hitting the postgrest row limit in a single select
+    vectors: list[list[float]] = []
+    records: list[dict] = []
+    for pageRecords, pageVectors in iter_embeddings(client, page_size=page_size):
+        records.extend(pageRecords)
+        vectors.extend(pageVectors)
+    return records, vectors
+
+def export_index(path: str, page_size: int=SCAN_PAGE_SIZE, cells: int|None=None)->IvfIndex:
+    """
+    Function for building the local approximate index from
+    every record in the embeddings table and saving it to disk.
+    Point ANN_INDEX_PATH at the saved directory to search it
+    instead of calling the match_documents rpc.
+    NOTE: Run as a script after ingesting new tutorials.
+    """
+    # NOTE: The index itself needs every vector in memory, kept as
+    # float32 pages (not python lists) and projected a page at a time
+    client: Client = conn_supabase()
+    records: list[dict] = []
+    pages: list[np.ndarray] = []
+    projection: Projection|None = get_projection()
+    for pageRecords, pageVectors in iter_embeddings(client, page_size=page_size):
+        records.extend(pageRecords)
+        # Store reduced vectors if a projection is configured
+        # so the index matches the space queries are searched in
+        pages.append(projection.apply(pageVectors) if projection!=None else np.asarray(pageVectors, dtype=np.float32))
+    if len(pages)<=0: raise ValueError('No embeddings to index')
+    vectors: np.ndarray = np.vstack(pages)
+
+    print(f'Building index for {len(records)} embeddings')
+    index: IvfIndex = IvfIndex.build(vectors, records, cells=cells)
+    index.save(path)
+    print(f'Saved index with {len(index.centroids)} cells to {path}')
+    return index
+
+if __name__=="__main__":
+    export_index(os.getenv('ANN_INDEX_PATH', 'index'))
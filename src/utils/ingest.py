@@ -0,0 +1,114 @@
+"""
+Concurrent ingestion of tutorial metadata from the youtube data api.
+Video ids are looked up 50 at a time (one quota unit per request) by a
+bounded pool of workers sharing a token bucket, and each batch is
+written to the videos table in a single upsert (changed rows only).
+"""
+# System
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# Local
+from ..models.general import Video
+from ..services.db import upsert_video_records, get_video_hashes
+from ..services.youtube import BATCH_SIZE, get_basic_info_batch
+from ..services.scheduler import TokenBucket
+from .jobs import Checkpoint, Progress, content_hash
+# Third party
+from googleapiclient.discovery import Resource
+from supabase import Client
+
+# Youtube requests per second allowed across workers (and burst size)
+YOUTUBE_RPS: float = float(os.getenv('YOUTUBE_RPS', 10))
+INGEST_WORKERS: int = int(os.getenv('INGEST_WORKERS', 4))
+
+class RateLimiter:
+    """
+    Thread-safe wrapper of the scheduler's TokenBucket,
+    blocking callers until a request is allowed.
+    """
+    def __init__(self, rate: float, burst: float|None=None):
+        self._bucket = TokenBucket(rate=rate, capacity=burst or rate)
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float=1)->None:
+        while True:
+            with self._lock:
+                wait: float = self._bucket.wait_time(amount)
+                if wait<=0:
+                    self._bucket.take(amount)
+                    return
+            time.sleep(wait)
+
+def batched(items: list, size: int)->list[list]:
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+def ingest_videos(videoIds: list[str], yt_client: Resource, db_client: Client|None,
+        workers: int=INGEST_WORKERS, rate: float=YOUTUBE_RPS, dry_run: bool=False,
+        job: str|None=None, force: bool=False
+    )->dict:
+    """
+    Fetch the metadata of every video id and upsert it into the videos table,
+    only rewriting rows whose content hash changed (unless force).
+    With a job name, progress is checkpointed (utils.jobs) and a rerun
+    resumes with the videos that weren't processed yet.
+    With dry_run, nothing is written (db_client can be None).
+    Returns counts of the updated, unchanged, missing (no metadata) and failed videos.
+    """
+    limiter = RateLimiter(rate)
+    checkpoint: Checkpoint|None = Checkpoint(job) if job!=None and not dry_run else None
+    uniqueIds: list[str] = list(dict.fromkeys(videoIds))
+    pending: list[str] = checkpoint.pending(uniqueIds) if checkpoint!=None else uniqueIds
+    if len(pending)<len(uniqueIds): print(f'Resuming {job}, {len(uniqueIds)-len(pending)} videos already processed')
+    batches: list[list[str]] = batched(pending, BATCH_SIZE)
+    progress = Progress(total=len(pending), label='videos')
+    report: dict = {'videos': len(pending), 'done': 0, 'unchanged': 0, 'missing': 0, 'failed': 0, 'requests': 0}
+
+    def work(batch: list[str])->dict[str, list[str]]:
+        limiter.acquire()
+        fetched: dict[str, Video] = get_basic_info_batch(yt_client, batch)
+        hashes: dict[str, str] = {id: content_hash(video) for id, video in fetched.items()}
+        # Skip rows whose stored hash matches what was fetched
+        stored: dict = get_video_hashes(db_client, list(fetched)) if db_client!=None and not force else {}
+        changed: list[Video] = [video for id, video in fetched.items() if stored.get(id)!=hashes[id]]
+        if not dry_run: upsert_video_records(db_client, changed, hashes=hashes)
+        changedIds: set[str] = {video.id for video in changed}
+        return {
+            'done': [id for id in batch if id in changedIds],
+            'unchanged': [id for id in batch if id in fetched and id not in changedIds],
+            'missing': [id for id in batch if id not in fetched],
+        }
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures: dict = {executor.submit(work, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            batch: list[str] = futures[future]
+            report['requests'] += 1
+            try:
+                statuses: dict[str, list[str]] = future.result()
+            except Exception as e:
+                statuses = {'failed': batch}
+                print(f'\tFailed batch of {len(batch)} ({batch[0]}..): {str(e)[:80]}')
+            for status, ids in statuses.items():
+                report[status] += len(ids)
+                if checkpoint!=None: checkpoint.mark(ids, status)
+            if checkpoint!=None: checkpoint.save()
+            progress.advance(len(batch))
+    # Completed jobs start over on the next run, failed items are retried first
+    if checkpoint!=None: checkpoint.save(finished=report['failed']<=0)
+    report['seconds'] = round(time.perf_counter()-progress.started, 2)
+    report['rate'] = round(progress.rate(), 1)
+    print(f"{'[dry run] ' if dry_run else ''}{report['done']} updated, {report['unchanged']} unchanged "
+          f"of {report['videos']} videos in {report['seconds']}s ({report['rate']}/s, "
+          f"{report['requests']} requests, {report['missing']} missing, {report['failed']} failed)")
+    return report
+
+# Driver simulating a full catalog refresh against the fake client
+# NOTE: Run from the repo root, the fakes live with the tests
+if __name__=="__main__":
+    import sys
+    from tests.fakes import FakeYoutube
+    count: int = int(sys.argv[1]) if len(sys.argv)>1 else 5000
+    ids: list[str] = [f'video{i:05d}' for i in range(count)]
+    ingest_videos(ids, yt_client=FakeYoutube(latency=0.3, missing={ids[0]}), db_client=None, dry_run=True)
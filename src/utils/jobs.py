@@ -0,0 +1,102 @@
+"""
+Resumable ingestion jobs. A job's progress (per-item status and the last
+item processed) is checkpointed to a local json file after every batch,
+so a rerun after a timeout or crash picks up where it stopped. Once a job
+completes, the next run starts over (e.g. the routine metadata refresh).
+"""
+# System
+import os
+import json
+import time
+import hashlib
+import threading
+# Third party
+from pydantic import BaseModel
+
+# Where job checkpoints are kept (not committed)
+CHECKPOINT_DIR: str = os.getenv('INGEST_CHECKPOINT_DIR', '.jobs')
+# Statuses that don't need to be processed again when resuming
+# NOTE: Failed items are retried
+FINAL: set[str] = {'done', 'unchanged', 'missing'}
+
+def content_hash(item: BaseModel)->str:
+    """
+    Hash of a model's stored fields, compared against the hash saved
+    with the row to skip writing items that haven't changed.
+    """
+    return hashlib.sha256(item.model_dump_json().encode()).hexdigest()
+
+class Checkpoint:
+    """
+    Per-item status of a job, saved atomically to <directory>/<name>.json.
+    """
+    def __init__(self, name: str, directory: str=CHECKPOINT_DIR):
+        self.path: str = os.path.join(directory, f'{name}.json')
+        self._lock = threading.Lock()
+        self.state: dict = {'status': {}, 'last_id': None, 'finished': False}
+        if os.path.exists(self.path):
+            with open(self.path) as f: self.state = json.load(f)
+        # A completed job is run again from the start
+        if self.state['finished']: self.reset()
+
+    def reset(self)->None:
+        self.state = {'status': {}, 'last_id': None, 'finished': False}
+        return
+
+    def pending(self, ids: list[str])->list[str]:
+        status: dict = self.state['status']
+        return [i for i in ids if status.get(i) not in FINAL]
+
+    def mark(self, ids: list[str], status: str)->None:
+        with self._lock:
+            for i in ids: self.state['status'][i] = status
+            if len(ids)>0: self.state['last_id'] = ids[-1]
+        return
+
+    def counts(self)->dict[str, int]:
+        counts: dict[str, int] = {}
+        for status in self.state['status'].values():
+            counts[status] = counts.get(status, 0)+1
+        return counts
+
+    def save(self, finished: bool=False)->None:
+        with self._lock:
+            self.state['finished'] = finished
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Write then rename so a crash never leaves a partial file
+            temp: str = self.path+'.tmp'
+            with open(temp, 'w') as f: json.dump(self.state, f)
+            os.replace(temp, self.path)
+        return
+
+class Progress:
+    """
+    Prints processed/total items, throughput and the estimated time
+    left, at most once every `interval` seconds.
+    """
+    def __init__(self, total: int, label: str='items', interval: float=2.0):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done: int = 0
+        self.started: float = time.perf_counter()
+        self._printed: float = 0.0
+        self._lock = threading.Lock()
+
+    def advance(self, count: int)->None:
+        with self._lock:
+            self.done += count
+            now: float = time.perf_counter()
+            if now-self._printed>=self.interval or self.done>=self.total:
+                self._printed = now
+                print(self.line())
+        return
+
+    def rate(self)->float:
+        elapsed: float = time.perf_counter()-self.started
+        return self.done/elapsed if elapsed>0 else 0.0
+
+    def line(self)->str:
+        rate: float = self.rate()
+        left: float = (self.total-self.done)/rate if rate>0 else 0.0
+        return f'\t{self.done}/{self.total} {self.label} ({rate:.1f}/s, ~{left:.0f}s left)'
@@ -0,0 +1,226 @@
+"""
+Offline precomputation of popular problems mined from the usage logs.
+Every /solve logs its problem (with the hyde, grounded text and sequences)
+to the usage_metadata table. This job streams that history, embeds the unique
+problems, clusters them with k-means, solves a representative problem of
+the busiest clusters with the batch pipeline and saves the graphs to the
+warm answer store (services.answers) that /solve serves close matches from.
+NOTE: Meant to run off-peak (e.g. nightly cron), see PRECOMPUTE_HOURS
+"""
+# System
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+# Local
+from ..services.llm import conn_gemini, create_embeddings, query_dimensions, EMBED_BATCH_SIZE
+from ..services.db import conn_supabase, scan_usage_metadata
+from ..services.ann import kmeans, normalize
+from ..services.answers import ANSWER_THRESHOLD, AnswerStore
+from ..services.pipeline import solve_batch
+from ..services.serialize import GRAPH
+from .ingest import batched
+from .jobs import Progress
+# Third party
+import numpy as np
+from google import genai
+from supabase import Client
+
+# Where the answer store is saved (the same file /solve loads)
+ANSWERS_PATH: str = os.getenv('ANSWERS_PATH', 'answers.npz')
+# Most problems solved per run, i.e. the LLM budget of a run
+PRECOMPUTE_MAX: int = int(os.getenv('PRECOMPUTE_MAX', 200))
+# UTC hours the job may run in, e.g. "2-6" (unset runs any time)
+PRECOMPUTE_HOURS: str|None = os.getenv('PRECOMPUTE_HOURS')
+# Days of traffic the coverage is reported on
+RECENT_DAYS: int = int(os.getenv('PRECOMPUTE_RECENT_DAYS', 7))
+
+def normalize_problem(problem: str)->str:
+    # Problems differing only by case and spacing are the same problem
+    return re.sub(r'\s+', ' ', problem).strip().lower()
+
+def load_problems(client: Client, since: datetime|None=None,
+        recent_since: datetime|None=None
+    )->list[dict]:
+    """
+    Stream the askai usage log and return the unique problems
+    {problem, count, recent} with how often each was asked,
+    overall and since recent_since. Most asked first.
+    """
+    problems: dict[str, dict] = {}
+    records: int = 0
+    for page in scan_usage_metadata(client, since=since):
+        for record in page:
+            metadata: dict|None = record.get('metadata')
+            if not metadata or not metadata.get('problem'): continue
+            key: str = normalize_problem(metadata['problem'])
+            if len(key)<=0: continue
+            entry: dict = problems.setdefault(key, {'problem': metadata['problem'].strip(), 'count': 0, 'recent': 0})
+            entry['count'] += 1
+            usedAt: str|None = record.get('used_at')
+            if recent_since==None or (usedAt!=None and datetime.fromisoformat(usedAt)>=recent_since):
+                entry['recent'] += 1
+            records += 1
+    print(f'Loaded {records} usage records, {len(problems)} unique problems')
+    return sorted(problems.values(), key=lambda p: -p['count'])
+
+def embed_problems(gemini: genai.Client, problems: list[str], workers: int=4)->np.ndarray:
+    """
+    Embed the problems (as /solve embeds queries) in batched requests,
+    returned as unit vectors in the same order.
+    """
+    dimensions: int|None = query_dimensions()
+    progress = Progress(len(problems), label='problems embedded')
+
+    def embed(chunk: list[str])->list[list[float]]:
+        response = create_embeddings(gemini, chunk, dimensions=dimensions)
+        progress.advance(len(chunk))
+        return [e.values for e in response.embeddings]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages: list[list[list[float]]] = list(executor.map(embed, batched(problems, EMBED_BATCH_SIZE)))
+    if len(pages)<=0: return np.zeros((0, 0), dtype=np.float32)
+    return normalize(np.vstack([np.asarray(p, dtype=np.float32) for p in pages]))
+
+def pick_representatives(vectors: np.ndarray, counts: list[int], clusters: int,
+        limit: int=PRECOMPUTE_MAX, per_cluster: int=1
+    )->list[tuple[int, int, int]]:
+    """
+    Cluster the problem vectors and pick the `per_cluster` problems
+    closest to each centroid, busiest clusters (by traffic) first, up to
+    `limit` problems. Returns (row, cluster, cluster traffic) tuples.
+    """
+    centroids, labels = kmeans(vectors, clusters)
+    weights: np.ndarray = np.asarray(counts)
+    traffic: np.ndarray = np.bincount(labels, weights=weights, minlength=len(centroids))
+    # Similarity of each problem to its own centroid
+    closeness: np.ndarray = np.einsum('ij,ij->i', vectors, centroids[labels])
+    picked: list[tuple[int, int, int]] = []
+    for cluster in np.argsort(-traffic):
+        if traffic[cluster]<=0 or len(picked)>=limit: break
+        members: np.ndarray = np.flatnonzero(labels==cluster)
+        for row in members[np.argsort(-closeness[members])][:per_cluster]:
+            picked.append((int(row), int(cluster), int(traffic[cluster])))
+    return picked[:limit]
+
+def coverage(store: AnswerStore, vectors: np.ndarray, counts: list[int])->dict:
+    """
+    Fraction of the given traffic (problem vectors and how often each
+    was asked) that /solve would have served from the store.
+    """
+    weights: np.ndarray = np.asarray(counts, dtype=np.float64)
+    if len(vectors)<=0 or weights.sum()<=0: return {'requests': 0.0, 'problems': 0.0}
+    __, scores = store.scores(vectors)
+    covered: np.ndarray = scores>=store.threshold
+    asked: np.ndarray = weights>0
+    return {
+        'requests': round(float(weights[covered].sum()/weights.sum()), 4),
+        'problems': round(float(covered[asked].mean()), 4),
+    }
+
+def wait_off_peak(hours: str|None=PRECOMPUTE_HOURS)->None:
+    """
+    Sleep until the start of the off-peak window ("start-end", UTC hours).
+    """
+    if not hours: return
+    start, end = (int(h) for h in hours.split('-'))
+    def inside(hour: int)->bool:
+        return start<=hour<end if start<end else (hour>=start or hour<end)
+    while not inside(datetime.now(timezone.utc).hour):
+        time.sleep(60)
+    return
+
+def precompute(gemini: genai.Client, supabase: Client, path: str=ANSWERS_PATH,
+        clusters: int|None=None, limit: int=PRECOMPUTE_MAX, per_cluster: int=1,
+        days: int|None=None, recent_days: int=RECENT_DAYS, concurrency: int=4,
+        refresh: bool=False, dry_run: bool=False
+    )->dict:
+    """
+    Build (or rebuild) the warm answer store from the usage history of
+    the last `days` (all of it if None) and report its coverage of the
+    last `recent_days` of traffic. Answers already in the store for a
+    picked problem are kept unless refresh. Dry runs only report the
+    coverage the picked problems would have, without solving or saving.
+    NOTE: Coverage is measured on the same traffic the problems are mined
+    from, an upper bound on what future traffic will get
+    """
+    now: datetime = datetime.now(timezone.utc)
+    recentSince: datetime = now-timedelta(days=recent_days)
+    problems: list[dict] = load_problems(supabase, since=now-timedelta(days=days) if days else None,
+                                         recent_since=recentSince)
+    if len(problems)<=0: raise ValueError('No problems in the usage history')
+    vectors: np.ndarray = embed_problems(gemini, [p['problem'] for p in problems])
+    counts: list[int] = [p['count'] for p in problems]
+    clusters = clusters or max(1, int(np.sqrt(len(problems))))
+    picked: list[tuple[int, int, int]] = pick_representatives(vectors, counts, clusters,
+                                                              limit=limit, per_cluster=per_cluster)
+
+    # Reuse the answers of problems picked in a previous run
+    previous: dict[str, tuple[dict, np.ndarray]] = {}
+    if not refresh and os.path.exists(path):
+        store: AnswerStore = AnswerStore.load(path)
+        previous = {normalize_problem(a['problem']): (a, v) for a, v in zip(store.answers, store.vectors)}
+    answers: list[dict] = []
+    rows: list[int] = []
+    todo: list[tuple[int, int, int]] = []
+    for row, cluster, traffic in picked:
+        key: str = normalize_problem(problems[row]['problem'])
+        if key in previous:
+            answers.append({**previous[key][0], 'cluster': cluster, 'traffic': traffic})
+            rows.append(row)
+        else: todo.append((row, cluster, traffic))
+
+    failed: int = 0
+    errors: dict[str, int] = {}
+    if dry_run:
+        # Coverage as if every picked problem was solved
+        rows += [row for row, __, __ in todo]
+        answers += [{'problem': problems[row]['problem']} for row, __, __ in todo]
+    elif len(todo)>0:
+        wait_off_peak()
+        print(f'Solving {len(todo)} problems ({len(answers)} kept from the last run)')
+        started: float = time.perf_counter()
+        results: list = solve_batch(gemini, supabase, [problems[row]['problem'] for row, __, __ in todo],
+                                    concurrency=concurrency)
+        for (row, cluster, traffic), result in zip(todo, results):
+            if isinstance(result, Exception):
+                failed += 1
+                errors[str(result)] = errors.get(str(result), 0)+1
+                continue
+            graph, metadata = result
+            answers.append({
+                'problem': problems[row]['problem'],
+                'graph': GRAPH.dump_json(graph).decode(),
+                'metadata': metadata,
+                'cluster': cluster,
+                'traffic': traffic,
+                'created_at': now.isoformat(),
+            })
+            rows.append(row)
+        print(f'Solved {len(todo)-failed}/{len(todo)} in {time.perf_counter()-started:.1f}s')
+
+    store = AnswerStore(vectors[rows] if len(rows)>0 else np.zeros((0, 0)), answers)
+    if not dry_run: store.save(path)
+    report: dict = {
+        'problems': len(problems),
+        'requests': sum(counts),
+        'recent_requests': sum(p['recent'] for p in problems),
+        'clusters': clusters,
+        'answers': len(store),
+        'solved': len(todo)-failed if not dry_run else 0,
+        'failed': failed,
+        'errors': errors,
+        'threshold': ANSWER_THRESHOLD,
+        'coverage': coverage(store, vectors, [p['recent'] for p in problems]),
+        'dry_run': dry_run,
+    }
+    print(f"Coverage of the last {recent_days} days: {report['coverage']['requests']:.1%} of requests, "
+          f"{report['coverage']['problems']:.1%} of unique problems ({len(store)} answers)")
+    return report
+
+if __name__=="__main__":
+    # NOTE: Workers reload the store when the file changes, no restart needed
+    precompute(conn_gemini(), conn_supabase(), refresh='--refresh' in sys.argv,
+               dry_run='--dry-run' in sys.argv)
@@ -0,0 +1,65 @@
+# System
+import os
+import json
+# Local
+from ..services.db import conn_supabase
+from ..services.projection import Projection
+from .index import iter_embeddings
+# Third party
+import numpy as np
+from supabase import Client
+
+def reproject_embeddings(dims: int, method: str='truncate', path: str='projection.npz',
+        sample: int=5000, batch: int=200
+    )->Projection:
+    """
+    Migration script for filling the embedding_reduced column
+    (see migrations/001_reduced_embeddings.sql) for every existing
+    row in the embeddings table. For PCA, the projection is fit on a
+    random sample of rows and saved to `path`, set EMBEDDING_PROJECTION
+    to that path (or EMBEDDING_DIMENSIONS for truncation) once done.
+    NOTE: Safe to re-run, rows are overwritten with the new projection.
+    Rows are streamed a batch at a time, memory stays flat with table size.
+    """
+    client: Client = conn_supabase()
+
+    if method=='pca':
+        # First pass keeps a uniform random sample (reservoir) of the rows
+        # so only `sample` vectors are in memory while fitting
+        rng = np.random.default_rng(0)
+        reservoir: list[list[float]] = []
+        seen: int = 0
+        for __, vectors in iter_embeddings(client, page_size=batch):
+            for vector in vectors:
+                if len(reservoir)<sample: reservoir.append(vector)
+                else:
+                    slot: int = int(rng.integers(0, seen+1))
+                    if slot<sample: reservoir[slot] = vector
+                seen += 1
+        print(f'Sampled {len(reservoir)} of {seen} embeddings')
+        projection: Projection|None = Projection.fit_pca(np.asarray(reservoir, dtype=np.float32), dims)
+        projection.save(path)
+        print(f'Saved PCA projection to {path}')
+    else: projection = None
+
+    # Update rows a page at a time through the bulk update rpc
+    updated: int = 0
+    for records, vectors in iter_embeddings(client, page_size=batch):
+        if projection==None: projection = Projection.truncate(dims, input_dims=len(vectors[0]))
+        reduced: np.ndarray = projection.apply(vectors)
+        rows: list[dict] = [
+            {'id': record['id'], 'embedding': json.dumps(vector.tolist())}
+            for record, vector in zip(records, reduced)
+        ]
+        try:
+            client.rpc(fn='set_reduced_embeddings', params={'rows': rows}).execute()
+            updated += len(rows)
+            print(f'{updated}: Updated batch')
+        except Exception as e: print(f'{records[0]["id"]}: Failed to update batch. Error: {str(e)}')
+    return projection
+
+if __name__=="__main__":
+    reproject_embeddings(
+        dims=int(os.getenv('EMBEDDING_DIMENSIONS', 256)),
+        method=os.getenv('EMBEDDING_METHOD', 'truncate'),
+    )
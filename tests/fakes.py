@@ -0,0 +1,93 @@
+"""
+Local stand-ins for the external clients, used by the tests and for dry
+runs of the ingestion scripts (no quota used, nothing written).
+"""
+# System
+import time
+import threading
+
+class FakeYoutube:
+    """
+    Stand-in for the youtube data api client. Returns made up snippets
+    for every id, except the ones in `missing`, after `latency` seconds.
+    Requests including an id in `failing` raise instead.
+    """
+    def __init__(self, latency: float=0.2, missing: set[str]|None=None, failing: set[str]|None=None):
+        self.latency = latency
+        self.missing = missing or set()
+        self.failing = failing or set()
+        self.requests: int = 0
+        self.ids: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    def videos(self):
+        return self
+
+    def list(self, part: str, id: str, **kwargs):
+        with self._lock:
+            self.requests += 1
+            self.ids.append(id.split(','))
+        if len(self.failing.intersection(id.split(',')))>0: return _FakeRequest(self.latency, [], failed=True)
+        ids: list[str] = [i for i in id.split(',') if i not in self.missing]
+        return _FakeRequest(self.latency, [{
+            'id': i, 'etag': f'etag-{i}',
+            'snippet': {
+                'title': f'Tutorial {i}', 'description': None,
+                'publishedAt': '2025-01-01T00:00:00Z', 'channelTitle': 'Channel',
+                'thumbnails': {'default': {'url': f'https://i.ytimg.com/vi/{i}/default.jpg'}},
+            },
+        } for i in ids])
+
+class _FakeRequest:
+    def __init__(self, latency: float, items: list[dict], failed: bool=False):
+        self.latency = latency
+        self.items = items
+        self.failed = failed
+
+    def execute(self)->dict:
+        time.sleep(self.latency)
+        if self.failed: raise RuntimeError('quotaExceeded')
+        return {'items': self.items}
+
+class FakeVideos:
+    """
+    Stand-in for the supabase client's videos table, answering the
+    queries of services.db's get_video_hashes and upsert_video_records.
+    """
+    def __init__(self):
+        self.rows: dict[str, dict] = {}
+        self.upserts: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    def table(self, name: str):
+        assert name=='videos'
+        return _FakeQuery(self)
+
+class _FakeQuery:
+    def __init__(self, db: FakeVideos):
+        self.db = db
+        self.ids: list[str]|None = None
+        self.data: list[dict]|None = None
+
+    def select(self, columns: str):
+        return self
+
+    def in_(self, column: str, ids: list[str]):
+        self.ids = ids
+        return self
+
+    def upsert(self, data: list[dict], on_conflict: str):
+        self.data = data
+        return self
+
+    def execute(self):
+        with self.db._lock:
+            if self.data!=None:
+                self.db.upserts.append([row['video_id'] for row in self.data])
+                for row in self.data: self.db.rows[row['video_id']] = row
+                return _FakeResponse(self.data)
+            return _FakeResponse([self.db.rows[i] for i in self.ids if i in self.db.rows])
+
+class _FakeResponse:
+    def __init__(self, data: list[dict]):
+        self.data = data
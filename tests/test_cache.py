@@ -0,0 +1,106 @@
+"""
+Tests of services.cache's backends: TTL expiry, the atomic pop shared
+by concurrent callers and size bounded (LRU) eviction of SqliteCache.
+"""
+# System
+import time
+import threading
+# Local
+from src.services.cache import CacheBackend, MemoryCache, SqliteCache
+# Third party
+import pytest
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path)->CacheBackend:
+    if request.param=='memory': return MemoryCache()
+    return SqliteCache(str(tmp_path/'cache.sqlite3'))
+
+def test_values_round_trip(cache):
+    cache.set('graph', {'name': 'Guard pass', 'nodes': [1, 2]})
+    assert cache.get('graph')=={'name': 'Guard pass', 'nodes': [1, 2]}
+    assert cache.get('missing', 'default')=='default'
+    cache.delete('graph')
+    assert cache.get('graph')==None
+    assert cache.get_or_set('count', lambda: 3)==3
+    assert cache.get_or_set('count', lambda: 4)==3
+
+def test_keys_expire(cache):
+    cache.set('short', 'value', ttl=0.2)
+    cache.set('forever', 'value')
+    assert cache.get('short')=='value'
+    time.sleep(0.3)
+    assert cache.get('short')==None and cache.pop('short')==None
+    assert cache.get('forever')=='value'
+
+def test_pop_gets_and_deletes(cache):
+    cache.set('checkpoint', [1, 2, 3])
+    assert cache.pop('checkpoint')==[1, 2, 3]
+    assert cache.pop('checkpoint', 'gone')=='gone'
+
+def test_concurrent_pop_is_atomic(tmp_path):
+    # Many callers (each with their own connection, like workers)
+    # popping the same key, only one of them gets it
+    path: str = str(tmp_path/'cache.sqlite3')
+    caches: list[SqliteCache] = [SqliteCache(path) for __ in range(4)]
+    for attempt in range(20):
+        caches[0].set('checkpoint', attempt)
+        got: list = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(8)
+        def pop(cache: SqliteCache)->None:
+            barrier.wait()
+            value = cache.pop('checkpoint')
+            if value!=None:
+                with lock: got.append(value)
+        threads = [threading.Thread(target=pop, args=(caches[i%4],)) for i in range(8)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        assert got==[attempt]
+
+def test_shared_across_instances(tmp_path):
+    path: str = str(tmp_path/'cache.sqlite3')
+    SqliteCache(path).set('catalog', ['Mount', 'Armbar'], ttl=60)
+    assert SqliteCache(path).get('catalog')==['Mount', 'Armbar']
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = SqliteCache(str(tmp_path/'cache.sqlite3'), max_items=5, evict_every=1, touch_after=0)
+    for i in range(5):
+        cache.set(f'key{i}', i)
+        time.sleep(0.01)
+    # Read recently, kept over keys written after it
+    assert cache.get('key0')==0
+    time.sleep(0.01)
+    for i in range(5, 8):
+        cache.set(f'key{i}', i)
+        time.sleep(0.01)
+    kept: list[str] = [f'key{i}' for i in range(8) if cache.get(f'key{i}')!=None]
+    assert kept==['key0', 'key4', 'key5', 'key6', 'key7']
+
+def test_eviction_runs_every_few_writes(tmp_path):
+    cache = SqliteCache(str(tmp_path/'cache.sqlite3'), max_items=2, evict_every=5)
+    for i in range(4): cache.set(f'key{i}', i)
+    assert all(cache.get(f'key{i}')==i for i in range(4))
+    cache.set('key4', 4)
+    assert sum(cache.get(f'key{i}')!=None for i in range(5))==2
+
+def test_expired_keys_are_evicted(tmp_path):
+    cache = SqliteCache(str(tmp_path/'cache.sqlite3'))
+    cache.set('short', 'value', ttl=0.1)
+    cache.set('forever', 'value')
+    time.sleep(0.2)
+    cache.evict()
+    rows: list = cache._connect().execute('select key from cache').fetchall()
+    assert rows==[('forever',)]
+
+def test_memory_cache_is_bounded():
+    cache = MemoryCache(max_items=3)
+    for i in range(3): cache.set(f'key{i}', i)
+    cache.get('key0')
+    cache.set('key3', 3)
+    assert cache.get('key1')==None and cache.get('key0')==0
+
+def test_backend_must_implement_interface():
+    class PartialCache(CacheBackend):
+        def get(self, key, default=None): return default
+    with pytest.raises(TypeError):
+        PartialCache()
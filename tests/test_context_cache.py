@@ -0,0 +1,166 @@
+"""
+Tests of services.context_cache's PrefixManager with the local stand-in
+for gemini's cached contents, and of the inline fallback of the llm calls.
+"""
+# System
+import time
+import threading
+from types import SimpleNamespace
+# Local
+from src.services import llm
+from src.services.cache import MemoryCache, set_cache
+from src.services.cancel import Cancelled
+from src.services.context_cache import LocalPrefixCache, PrefixManager, set_backend
+# Third party
+import pytest
+
+class CountingCache(LocalPrefixCache):
+    """
+    LocalPrefixCache counting creates, optionally slow or failing.
+    """
+    def __init__(self, delay: float=0.0, fail: bool=False):
+        super().__init__()
+        self.delay = delay
+        self.fail = fail
+        self.creates: int = 0
+        self._count = threading.Lock()
+
+    def create(self, client, model, contents, system_instruction, ttl):
+        with self._count: self.creates += 1
+        if self.delay>0: time.sleep(self.delay)
+        if self.fail: raise RuntimeError('cached contents unavailable')
+        return super().create(client, model, contents, system_instruction, ttl)
+
+def _manager(backend: CountingCache, **kwargs)->PrefixManager:
+    return PrefixManager(backend, shared=kwargs.pop('shared', MemoryCache()), **kwargs)
+
+def test_prefix_is_reused():
+    backend = CountingCache()
+    manager: PrefixManager = _manager(backend)
+    first: str = manager.get(None, 'flowchart', 'model', ['catalog', 'instructions'])
+    assert manager.get(None, 'flowchart', 'model', ['catalog', 'instructions'])==first
+    assert backend.creates==1
+    # Other stages (or models) get their own prefix
+    assert manager.get(None, 'rename', 'model', ['catalog', 'instructions'])!=first
+    assert backend.creates==2
+
+def test_concurrent_first_use_creates_once():
+    backend = CountingCache(delay=0.2)
+    manager: PrefixManager = _manager(backend)
+    names: list[str] = []
+    def get()->None:
+        names.append(manager.get(None, 'flowchart', 'model', ['catalog']))
+    threads = [threading.Thread(target=get) for __ in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert backend.creates==1
+    assert len(set(names))==1 and names[0]!=None
+
+def test_slow_create_does_not_block_other_prefixes():
+    backend = CountingCache(delay=0.5)
+    manager: PrefixManager = _manager(backend)
+    slow = threading.Thread(target=manager.get, args=(None, 'flowchart', 'slow', ['catalog']))
+    slow.start()
+    time.sleep(0.05)
+    backend.delay = 0.0
+    started: float = time.monotonic()
+    assert manager.get(None, 'rename', 'fast', ['catalog'])!=None
+    assert time.monotonic()-started<0.25
+    slow.join()
+
+def test_prefix_recreated_near_expiry():
+    backend = CountingCache()
+    manager: PrefixManager = _manager(backend, ttl=1, margin=0)
+    first: str = manager.get(None, 'flowchart', 'model', ['catalog'])
+    time.sleep(1.1)
+    second: str = manager.get(None, 'flowchart', 'model', ['catalog'])
+    assert second!=first and backend.creates==2
+    # Replaced near expiry, left for in-flight requests to finish with
+    assert first in backend.entries
+
+def test_changed_content_replaces_and_deletes_prefix():
+    backend = CountingCache()
+    manager: PrefixManager = _manager(backend)
+    first: str = manager.get(None, 'flowchart', 'model', ['catalog v1'])
+    second: str = manager.get(None, 'flowchart', 'model', ['catalog v2'])
+    assert second!=first
+    assert first not in backend.entries and second in backend.entries
+
+def test_evicted_prefix_is_recreated():
+    backend = CountingCache()
+    shared = MemoryCache()
+    manager: PrefixManager = _manager(backend, shared=shared)
+    first: str = manager.get(None, 'flowchart', 'model', ['catalog'])
+    manager.evict(first)
+    assert shared.get('prefix:flowchart:model')==None
+    assert manager.get(None, 'flowchart', 'model', ['catalog'])!=first
+    assert backend.creates==2
+
+def test_failed_create_goes_inline_during_cooldown():
+    backend = CountingCache(fail=True)
+    manager: PrefixManager = _manager(backend, cooldown=60)
+    assert manager.get(None, 'flowchart', 'model', ['catalog'])==None
+    backend.fail = False
+    # Not retried until the cooldown is over
+    assert manager.get(None, 'flowchart', 'model', ['catalog'])==None
+    assert backend.creates==1
+
+def test_workers_share_published_prefix():
+    backend = CountingCache()
+    shared = MemoryCache()
+    first: str = _manager(backend, shared=shared).get(None, 'flowchart', 'model', ['catalog'])
+    # Another worker (its own manager) reuses it instead of creating one
+    assert _manager(backend, shared=shared).get(None, 'flowchart', 'model', ['catalog'])==first
+    assert backend.creates==1
+
+@pytest.fixture
+def local_prefixes():
+    # Fresh shared cache, names of local prefixes repeat across tests
+    set_cache(MemoryCache())
+    backend = LocalPrefixCache()
+    set_backend(backend)
+    yield backend
+    set_backend(None)
+    set_cache(None)
+
+def _client(fail_cached: Exception|None=None):
+    """
+    Fake gemini client recording the configs it was called with,
+    cached calls raise fail_cached (e.g. an expired prefix).
+    """
+    calls: list = []
+    def generate_content(model, contents, config=None):
+        calls.append(config)
+        if config.cached_content and fail_cached!=None: raise fail_cached
+        return SimpleNamespace(text='{}', parsed=None)
+    return SimpleNamespace(models=SimpleNamespace(generate_content=generate_content)), calls
+
+def test_cached_call_uses_prefix(local_prefixes):
+    client, calls = _client()
+    llm.create_flowchart(client, 'problem', 'sequences', 'techniques')
+    assert len(calls)==1 and calls[0].cached_content in local_prefixes.entries
+
+def test_failed_cached_call_goes_inline_and_evicts(local_prefixes):
+    client, calls = _client(fail_cached=RuntimeError('cached content expired'))
+    llm.create_flowchart(client, 'problem', 'sequences', 'techniques')
+    assert len(calls)==2
+    assert calls[0].cached_content!=None and calls[1].cached_content==None
+    # The failed prefix was forgotten, the next call creates a new one
+    llm.create_flowchart(client, 'problem', 'sequences', 'techniques')
+    assert calls[2].cached_content not in (None, calls[0].cached_content)
+
+def test_failed_cached_stream_goes_inline(local_prefixes):
+    calls: list = []
+    def generate_content_stream(model, contents, config=None):
+        calls.append(config)
+        if config.cached_content: raise RuntimeError('cached content expired')
+        return iter([SimpleNamespace(text='{"name"'), SimpleNamespace(text=': "g"}')])
+    client = SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream))
+    assert ''.join(llm.create_flowchart(client, 'problem', 'sequences', 'techniques', stream=True))=='{"name": "g"}'
+    assert calls[0].cached_content!=None and calls[1].cached_content==None
+
+def test_cancelled_cached_call_is_not_retried(local_prefixes):
+    client, calls = _client(fail_cached=Cancelled())
+    with pytest.raises(Cancelled):
+        llm.create_flowchart(client, 'problem', 'sequences', 'techniques')
+    assert len(calls)==1
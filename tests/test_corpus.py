@@ -0,0 +1,102 @@
+"""
+Tests of utils.corpus's ingest_transcripts against the local store and
+gemini stand-in: chunking, deduplication by content hash, the reduced
+embeddings of a projection and failed embedding batches.
+"""
+# System
+import json
+# Local
+from src.models.general import Sequence
+from src.services import scheduler as scheduling
+from src.services.projection import Projection
+from src.services.scheduler import LlmScheduler
+from src.utils import corpus
+from src.utils.corpus import EmbeddingStore, LocalGemini, LocalStore, chunk_hash, chunk_sequence, ingest_transcripts
+# Third party
+import pytest
+
+TRANSCRIPTS: list[dict] = [{
+    'video_id': 'video1',
+    'text': 'Grip the collar. Post the foot. Shrimp out. Recover guard. '
+            'Frame on the hip. Insert the knee. Square up. Sweep to mount.',
+}, {
+    'video_id': 'video2',
+    # Same first sequence as video1 (another upload of the same tutorial)
+    'text': 'Grip the collar. Post the foot. Shrimp out. Recover guard. '
+            'Break the posture. Climb the guard. Isolate the arm. Finish the armbar.',
+}]
+
+@pytest.fixture(autouse=True)
+def unlimited(monkeypatch):
+    # Scheduler without practical limits for the local calls
+    monkeypatch.setattr(scheduling, 'scheduler', LlmScheduler(limits={
+        'gemini-2.0-flash-lite': (100_000, 100_000_000), 'text-embedding-004': (100_000, 100_000_000)}))
+    monkeypatch.setattr(corpus, 'get_projection', lambda: None)
+
+class FailingGemini(LocalGemini):
+    """
+    LocalGemini whose embedding requests fail if they include `text`.
+    """
+    def __init__(self, text: str, **kwargs):
+        super().__init__(**kwargs)
+        self.text = text
+
+    def embed_content(self, model, contents, config=None):
+        if any(self.text in content for content in contents): raise RuntimeError('500 internal error')
+        return super().embed_content(model, contents, config)
+
+def test_chunk_sequence_splits_between_steps():
+    sequence = Sequence(name='Escape', steps=['a'*40, 'b'*40, 'c'*40, 'd'*200])
+    chunks: list[dict] = chunk_sequence(sequence, max_chars=100)
+    assert [chunk['name'] for chunk in chunks]==['Escape (1)', 'Escape (2)', 'Escape (3)']
+    # Steps are kept whole, even the one over max_chars
+    assert chunks[0]['content']=='a'*40+' '+'b'*40
+    assert chunks[2]['content']=='d'*200
+    assert chunk_sequence(Sequence(name='Escape', steps=['a', 'b']))==[{'name': 'Escape', 'content': 'a b'}]
+
+def test_transcripts_are_chunked_and_embedded():
+    store = LocalStore()
+    report: dict = ingest_transcripts(LocalGemini(dims=16), store, TRANSCRIPTS, batch=2)
+    assert report['chunks']==4 and report['duplicates']==1 and report['inserted']==3
+    assert report['failed']==0 and report['failed_chunks']==0
+    contents: list[str] = [record['content'] for record in store.records]
+    assert sorted(contents)==sorted({
+        'Grip the collar. Post the foot. Shrimp out. Recover guard.',
+        'Frame on the hip. Insert the knee. Square up. Sweep to mount.',
+        'Break the posture. Climb the guard. Isolate the arm. Finish the armbar.',
+    })
+    for record in store.records:
+        assert record['content_hash']==chunk_hash(record['content'])
+        assert len(json.loads(record['embedding']))==16
+        assert 'embedding_reduced' not in record
+
+def test_second_run_skips_stored_chunks():
+    store = LocalStore()
+    ingest_transcripts(LocalGemini(dims=16), store, TRANSCRIPTS)
+    report: dict = ingest_transcripts(LocalGemini(dims=16), store, TRANSCRIPTS)
+    assert report['inserted']==0 and report['duplicates']==4
+    assert len(store.records)==3
+
+def test_reduced_embeddings_with_projection(monkeypatch):
+    projection: Projection = Projection.truncate(4, input_dims=16)
+    monkeypatch.setattr(corpus, 'get_projection', lambda: projection)
+    store = LocalStore()
+    ingest_transcripts(LocalGemini(dims=16), store, TRANSCRIPTS)
+    for record in store.records:
+        reduced: list[float] = json.loads(record['embedding_reduced'])
+        assert reduced==pytest.approx(projection.apply(json.loads(record['embedding'])).tolist(), abs=1e-6)
+
+def test_failed_batch_is_counted_and_skipped():
+    store = LocalStore()
+    report: dict = ingest_transcripts(FailingGemini('armbar', dims=16), store, TRANSCRIPTS, batch=1)
+    assert report['failed_chunks']==1 and report['inserted']==2
+    assert all('armbar' not in record['content'] for record in store.records)
+    # Not stored, the next run picks it up
+    report = ingest_transcripts(LocalGemini(dims=16), store, TRANSCRIPTS)
+    assert report['inserted']==1 and len(store.records)==3
+
+def test_store_must_implement_interface():
+    class PartialStore(EmbeddingStore):
+        def existing(self, hashes): return set()
+    with pytest.raises(TypeError):
+        PartialStore()
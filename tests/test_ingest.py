@@ -0,0 +1,66 @@
+"""
+Tests of utils.ingest's ingest_videos with the fake youtube client and
+videos table: batching, skipping unchanged videos by content hash and
+resuming an interrupted job from its checkpoint.
+"""
+# System
+import functools
+# Local
+from src.utils import ingest
+from src.utils.ingest import ingest_videos
+from src.utils.jobs import Checkpoint
+from src.services.youtube import BATCH_SIZE
+from tests.fakes import FakeVideos, FakeYoutube
+# Third party
+import pytest
+
+def _ids(count: int)->list[str]:
+    return [f'video{i:04d}' for i in range(count)]
+
+@pytest.fixture(autouse=True)
+def checkpoints(tmp_path, monkeypatch):
+    # Job checkpoints written to a temporary directory
+    monkeypatch.setattr(ingest, 'Checkpoint', functools.partial(Checkpoint, directory=str(tmp_path)))
+    return tmp_path
+
+def test_videos_are_fetched_and_written_in_batches():
+    youtube = FakeYoutube(latency=0.0, missing={'video0003'})
+    db = FakeVideos()
+    # Duplicate ids are only fetched once
+    report: dict = ingest_videos(_ids(120)+_ids(5), youtube, db, workers=3, rate=1000)
+    assert youtube.requests==3 and report['requests']==3
+    assert sorted(len(ids) for ids in youtube.ids)==[20, BATCH_SIZE, BATCH_SIZE]
+    assert len(db.upserts)==3 and max(len(ids) for ids in db.upserts)<=BATCH_SIZE
+    assert report['done']==119 and report['missing']==1 and report['failed']==0
+    assert len(db.rows)==119 and 'video0003' not in db.rows
+
+def test_unchanged_videos_are_skipped():
+    db = FakeVideos()
+    ingest_videos(_ids(60), FakeYoutube(latency=0.0), db, rate=1000)
+    report: dict = ingest_videos(_ids(60), FakeYoutube(latency=0.0), db, rate=1000)
+    assert report['unchanged']==60 and report['done']==0
+    # Nothing rewritten the second time, unless forced
+    assert len(db.upserts)==2
+    assert ingest_videos(_ids(60), FakeYoutube(latency=0.0), db, rate=1000, force=True)['done']==60
+
+def test_dry_run_writes_nothing():
+    db = FakeVideos()
+    report: dict = ingest_videos(_ids(10), FakeYoutube(latency=0.0), db, rate=1000, dry_run=True, job='dry')
+    assert report['done']==10 and db.upserts==[]
+
+def test_interrupted_job_resumes_from_checkpoint(checkpoints):
+    db = FakeVideos()
+    ids: list[str] = _ids(150)
+    # The second batch fails, e.g. out of quota
+    report: dict = ingest_videos(ids, FakeYoutube(latency=0.0, failing={ids[60]}), db, workers=1, rate=1000, job='refresh')
+    assert report['failed']==BATCH_SIZE and report['done']==100
+    assert (checkpoints/'refresh.json').exists()
+    # The rerun only fetches the failed batch
+    youtube = FakeYoutube(latency=0.0)
+    report = ingest_videos(ids, youtube, db, workers=1, rate=1000, job='refresh')
+    assert youtube.requests==1 and youtube.ids[0]==ids[BATCH_SIZE:2*BATCH_SIZE]
+    assert report['videos']==BATCH_SIZE and report['done']==BATCH_SIZE and report['failed']==0
+    assert len(db.rows)==150
+    # Finished, the next run starts over (and finds nothing changed)
+    report = ingest_videos(ids, FakeYoutube(latency=0.0), db, rate=1000, job='refresh')
+    assert report['videos']==150 and report['unchanged']==150
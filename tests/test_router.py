@@ -0,0 +1,131 @@
+"""
+Tests of services.router with fake slow and fast calls: hedging once a
+running call passes its expected latency, stopping the losing call,
+deadlines split across stages and the latency estimates.
+"""
+# System
+import time
+# Local
+from src.services import scheduler as scheduling
+from src.services.router import HEDGE_FACTOR, STAGE_WEIGHTS, DeadlineExceeded, ModelRouter, deadline, stage_budget
+from src.services.scheduler import LlmScheduler, TokenBucket, schedule
+# Third party
+import pytest
+
+# Candidates of the rename stage: preferred model, then the one hedged on
+PRIMARY: str = 'gemini-2.0-flash'
+HEDGE: str = 'gemini-2.0-flash-lite'
+
+@pytest.fixture(autouse=True)
+def unlimited(monkeypatch):
+    # Scheduler without practical limits, tests empty buckets to queue calls
+    monkeypatch.setattr(scheduling, 'scheduler', LlmScheduler(limits={
+        PRIMARY: (100_000, 100_000_000), HEDGE: (100_000, 100_000_000)}))
+    return scheduling.scheduler
+
+def _calls(seconds: dict[str, float]):
+    """
+    A routed call taking `seconds[model]` once admitted by the scheduler,
+    and the log of (model, started at) of calls that got to run.
+    """
+    ran: list[tuple[str, float]] = []
+    def call(model: str)->str:
+        def work()->str:
+            ran.append((model, time.monotonic()))
+            time.sleep(seconds[model])
+            return model
+        return schedule(model, 1, work)
+    return call, ran
+
+def _router(primary: float=0.2)->ModelRouter:
+    router = ModelRouter()
+    router._latency[PRIMARY] = primary
+    router._latency[HEDGE] = 0.1
+    return router
+
+def _block(scheduler: LlmScheduler, model: str, rate: float=0.1)->None:
+    # Calls to the model wait in the queue (empty bucket, slow refill)
+    queue = scheduler._queue(model)
+    queue.requests = TokenBucket(rate, 1)
+    queue.requests.tokens = 0
+    return
+
+def test_fast_call_is_not_hedged():
+    call, ran = _calls({PRIMARY: 0.05, HEDGE: 0.0})
+    assert _router().run('rename', call)==PRIMARY
+    assert [model for model, __ in ran]==[PRIMARY]
+
+def test_slow_call_is_hedged_after_threshold():
+    router: ModelRouter = _router(primary=0.2)
+    call, ran = _calls({PRIMARY: 1.0, HEDGE: 0.0})
+    started: float = time.monotonic()
+    assert router.run('rename', call)==HEDGE
+    assert [model for model, __ in ran]==[PRIMARY, HEDGE]
+    # Hedged once running for HEDGE_FACTOR times its expected latency
+    assert ran[1][1]-ran[0][1]>=0.2*HEDGE_FACTOR
+    assert time.monotonic()-started<1.0
+
+def test_hedging_can_be_disabled():
+    call, ran = _calls({PRIMARY: 0.5, HEDGE: 0.0})
+    assert _router(primary=0.1).run('rename', call, hedge=False)==PRIMARY
+    assert [model for model, __ in ran]==[PRIMARY]
+
+def test_queued_call_is_not_hedged_or_timed(unlimited):
+    # Waiting for the rate limit isn't slowness, it's neither hedged
+    # nor counted in the model's latency
+    _block(unlimited, PRIMARY, rate=2)
+    router: ModelRouter = _router(primary=0.1)
+    call, ran = _calls({PRIMARY: 0.05, HEDGE: 0.0})
+    assert router.run('rename', call)==PRIMARY
+    assert [model for model, __ in ran]==[PRIMARY]
+    assert router.latency(PRIMARY)<0.2
+
+def test_losing_hedge_is_stopped(unlimited):
+    # The hedge is stuck in the queue when the first call finishes,
+    # it gives up its place instead of running later
+    _block(unlimited, HEDGE, rate=0.2)
+    call, ran = _calls({PRIMARY: 0.6, HEDGE: 0.0})
+    assert _router(primary=0.1).run('rename', call)==PRIMARY
+    time.sleep(0.7)
+    assert [model for model, __ in ran]==[PRIMARY]
+    assert unlimited._queue(HEDGE).pending==[]
+
+def test_deadline_exceeded_when_budget_runs_out(unlimited):
+    call, ran = _calls({PRIMARY: 2.0, HEDGE: 2.0})
+    started: float = time.monotonic()
+    with deadline(0.5, stages=['rename']):
+        with pytest.raises(DeadlineExceeded) as error:
+            _router().run('rename', call, hedge=False)
+    assert error.value.stage=='rename'
+    assert 0.5<=time.monotonic()-started<1.0
+
+def test_timed_out_queued_call_is_dropped(unlimited):
+    _block(unlimited, PRIMARY, rate=0.2)
+    call, ran = _calls({PRIMARY: 0.0, HEDGE: 0.0})
+    with deadline(0.3, stages=['rename']):
+        with pytest.raises(DeadlineExceeded):
+            _router().run('rename', call, hedge=False)
+    time.sleep(0.6)
+    assert ran==[] and unlimited._queue(PRIMARY).pending==[]
+
+def test_stage_budget_splits_remaining_deadline():
+    assert stage_budget('hyde')==None
+    with deadline(10, stages=['hyde', 'embed', 'ground']):
+        total: float = STAGE_WEIGHTS['hyde']+STAGE_WEIGHTS['embed']+STAGE_WEIGHTS['ground']
+        assert stage_budget('hyde')==pytest.approx(10*STAGE_WEIGHTS['hyde']/total, rel=0.01)
+        # Finished stages hand their share to the ones left
+        _router().run('hyde', lambda model: 'hyde')
+        assert stage_budget('ground')==pytest.approx(10*STAGE_WEIGHTS['ground']/(total-STAGE_WEIGHTS['hyde']), rel=0.01)
+
+def test_latency_is_a_moving_average():
+    router = ModelRouter(alpha=0.5)
+    router._latency['m'] = 4.0
+    router.observe('m', 2.0)
+    assert router.latency('m')==3.0
+    router.observe('m', 2.0)
+    assert router.latency('m')==2.5
+
+def test_choose_prefers_models_fitting_the_budget():
+    router: ModelRouter = _router(primary=5.0)
+    assert router.choose('rename', None)==[PRIMARY, HEDGE]
+    assert router.choose('rename', 1.0)==[HEDGE, PRIMARY]
@@ -0,0 +1,96 @@
+"""
+Tests of services.scheduler's admission control with small limits:
+fair queueing across users, in-flight pipelines first, early rejection
+and cancellation of queued calls.
+"""
+# System
+import time
+import threading
+# Local
+from src.services.cancel import Cancelled, cancellation
+from src.services.scheduler import LlmScheduler, Overloaded, TokenBucket
+# Third party
+import pytest
+
+def _scheduler(rate: float=10.0, max_wait: float=60.0)->LlmScheduler:
+    """
+    Scheduler for model 'm' with an empty request bucket refilled
+    at `rate` per second (one call at a time), tokens unlimited.
+    """
+    scheduler = LlmScheduler(limits={'m': (60, 10_000_000)}, max_wait=max_wait)
+    queue = scheduler._queue('m')
+    queue.requests = TokenBucket(rate, 1)
+    queue.requests.tokens = 0
+    return scheduler
+
+def _queue_calls(scheduler: LlmScheduler, calls: list[tuple[str, bool]])->list[str]:
+    """
+    Queue the (user, inflight) calls in order and return the users
+    in the order their calls were admitted.
+    """
+    served: list[str] = []
+    lock = threading.Lock()
+    def acquire(user: str, inflight: bool)->None:
+        scheduler.acquire('m', 1, user, inflight)
+        with lock: served.append(user)
+    threads: list[threading.Thread] = []
+    for user, inflight in calls:
+        threads.append(threading.Thread(target=acquire, args=(user, inflight)))
+        threads[-1].start()
+        # Queued in this order, well before the first refill
+        time.sleep(0.005)
+    for thread in threads: thread.join()
+    return served
+
+def test_users_are_served_fairly():
+    # A heavy user queued first doesn't hold back a user queued after it
+    served: list[str] = _queue_calls(_scheduler(), [('heavy', True)]*4+[('light', True)]*2)
+    assert served==['heavy', 'light', 'heavy', 'light', 'heavy', 'heavy']
+
+def test_inflight_calls_go_first():
+    served: list[str] = _queue_calls(_scheduler(), [('new', False), ('new', False), ('inflight', True)])
+    assert served[0]=='inflight'
+
+def test_check_rejects_with_retry_after():
+    scheduler: LlmScheduler = _scheduler(rate=0.1, max_wait=1)
+    with pytest.raises(Overloaded) as error:
+        scheduler.check(['m'])
+    # One call ahead of the refill at 0.1 per second
+    assert error.value.retry_after==10
+    assert error.value.model=='m'
+    # New pipelines are rejected in acquire too, in-flight ones always queue
+    with pytest.raises(Overloaded):
+        scheduler.acquire('m', 1, 'user', inflight=False)
+
+def test_retry_after_is_at_least_a_second():
+    assert Overloaded('m', 0.2).retry_after==1
+    assert Overloaded('m', 2.1).retry_after==3
+
+def test_cancelled_waiter_releases_its_slot():
+    scheduler: LlmScheduler = _scheduler(rate=1.0)
+    event = threading.Event()
+    errors: list[Exception] = []
+    def cancelled_call()->None:
+        with cancellation(event):
+            try: scheduler.acquire('m', 1, 'gone', inflight=True)
+            except Cancelled as e: errors.append(e)
+    waiter = threading.Thread(target=cancelled_call)
+    waiter.start()
+    time.sleep(0.05)
+    # Queued behind the call about to be cancelled, at the same start time
+    other = threading.Thread(target=scheduler.acquire, args=('m', 1, 'other', True))
+    other.start()
+    time.sleep(0.05)
+    event.set()
+    waiter.join(timeout=2)
+    assert len(errors)==1
+    started: float = time.monotonic()
+    other.join(timeout=3)
+    # Served at the first refill instead of waiting behind the cancelled call
+    assert not other.is_alive() and time.monotonic()-started<1.5
+    assert scheduler._queue('m').pending==[]
+
+def test_fair_queue_state_is_bounded():
+    scheduler = LlmScheduler(limits={'m': (10_000, 10_000_000)})
+    for i in range(50): scheduler.acquire('m', 1, f'user{i}', inflight=True)
+    assert scheduler._queue('m').finish=={}
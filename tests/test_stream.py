@@ -0,0 +1,85 @@
+"""
+Tests of services.stream's incremental graph parser and collect:
+strings with json syntax in them, chunks splitting tokens anywhere
+and malformed model output.
+"""
+# System
+import json
+# Local
+from src.models.general import FastSolution, Graph
+from src.services.stream import GraphStreamParser, collect
+# Third party
+import pytest
+from pydantic import ValidationError
+
+GRAPH: dict = {
+    'name': 'Guard {pass} "to mount"',
+    'nodes': [{'id': 1, 'technique_id': 10}, {'id': 2, 'technique_id': 20}],
+    'edges': [{'id': 1, 'source_id': 1, 'target_id': 2, 'note': 'Hips up, then [slide] the knee \\ "walk" over {'}],
+}
+
+def _events(chunks: list[str])->list[tuple[str, object]]:
+    parser = GraphStreamParser()
+    events: list[tuple[str, object]] = []
+    for chunk in chunks: events += parser.feed(chunk)
+    return events
+
+def _expected(graph: dict)->list[tuple[str, object]]:
+    return [('name', graph['name'])]+[('node', node) for node in graph['nodes']]+[('edge', edge) for edge in graph['edges']]
+
+def test_whole_response():
+    assert _events([json.dumps(GRAPH)])==_expected(GRAPH)
+
+def test_strings_with_braces_and_escaped_quotes():
+    # Braces, brackets and quotes inside strings don't open or close anything
+    text: str = json.dumps(GRAPH)
+    assert '\\"' in text and '\\\\' in text
+    events = _events([text])
+    assert events[-1]==('edge', GRAPH['edges'][0])
+    assert events[0]==('name', 'Guard {pass} "to mount"')
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_chunks_splitting_tokens(size):
+    # Escapes, keys and numbers split across chunks of any size
+    text: str = json.dumps(GRAPH, indent=2)
+    assert _events([text[i:i+size] for i in range(0, len(text), size)])==_expected(GRAPH)
+
+def test_events_as_soon_as_items_close():
+    parser = GraphStreamParser()
+    assert parser.feed('{"name": "g", "nodes": [{"id": 1, "techni')==[('name', 'g')]
+    assert parser.feed('que_id": 10}, {"id"')==[('node', {'id': 1, 'technique_id': 10})]
+    assert parser.feed(': 2, "technique_id": 20}]')==[('node', {'id': 2, 'technique_id': 20})]
+
+def test_graph_nested_in_fast_solution():
+    # Only the graph's own name and items, not the sequences'
+    solution: dict = {'sequences': [{'name': 'Sweep', 'steps': ['Hook {the} leg']}], 'graph': GRAPH}
+    assert _events([json.dumps(solution)])==_expected(GRAPH)
+
+def test_collect_emits_and_validates():
+    emitted: list[dict] = []
+    text: str = json.dumps(GRAPH)
+    graph = collect([text[i:i+5] for i in range(0, len(text), 5)], Graph, 'flowchart', emitted.append)
+    assert graph==Graph.model_validate(GRAPH)
+    assert [(event['event'], event['data']) for event in emitted]==_expected(GRAPH)
+    assert all(event['stage']=='flowchart' for event in emitted)
+
+def test_collect_fast_solution():
+    solution: dict = {'sequences': [{'name': 'Sweep', 'steps': []}], 'graph': GRAPH}
+    assert collect([json.dumps(solution)], FastSolution, 'fast', lambda event: None).graph.name==GRAPH['name']
+
+@pytest.mark.parametrize('text', [
+    # Cut off mid stream, invalid json, unbalanced and wrong shapes
+    json.dumps(GRAPH)[:-20],
+    '{"name": "g", "nodes": [}',
+    '}]{"name": "g"}',
+    '{"name": "g", "nodes": [{"id": 1]}',
+    '{"name": "bad \\x escape", "nodes": [], "edges": []}',
+    '{"name": "g", "nodes": [{"id": "one"}], "edges": []}',
+    '',
+])
+def test_collect_malformed_output_raises_validation_error(text):
+    # Items completed before the output went wrong are still emitted,
+    # then the response fails validation like a non streamed one
+    emitted: list[dict] = []
+    with pytest.raises(ValidationError):
+        collect([text], Graph, 'flowchart', emitted.append)
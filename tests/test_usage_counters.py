@@ -0,0 +1,133 @@
+"""
+Tests of migrations/005_usage_counters.sql against a real Postgres:
+the log_usage rpc (used by services.db log_use), the append-only usage
+log and re-running the migration. Uses the database at TEST_DATABASE_URL
+(it creates and drops its own schema), or a throwaway local server with
+pgserver (pip install pgserver "psycopg[binary]"), skipped otherwise.
+Run from the repo root:
+    python -m pytest tests
+"""
+# System
+import os
+import uuid
+import tempfile
+import threading
+from datetime import date
+# Local
+from src.services.db import usage_period
+# Third party
+import pytest
+psycopg = pytest.importorskip('psycopg')
+
+MIGRATION: str = os.path.join(os.path.dirname(__file__), '..', 'migrations', '005_usage_counters.sql')
+# The usage table as it was before the migration, the backfill's source
+USAGE_TABLE: str = '''
+    create table usage (
+      id bigint generated always as identity primary key,
+      user_id uuid not null,
+      feature text not null default 'askai',
+      used_at timestamptz not null default now(),
+      metadata jsonb
+    )
+'''
+
+@pytest.fixture(scope='module')
+def dsn():
+    url: str|None = os.getenv('TEST_DATABASE_URL')
+    if url:
+        yield url
+        return
+    pgserver = pytest.importorskip('pgserver')
+    with tempfile.TemporaryDirectory() as directory:
+        server = pgserver.get_server(directory, cleanup_mode='stop')
+        yield server.get_uri()
+        server.cleanup()
+
+@pytest.fixture
+def db(dsn):
+    """
+    Autocommit connection with search_path set to a fresh schema
+    holding the pre-migration usage table and a few logged uses.
+    """
+    schema: str = f'test_{uuid.uuid4().hex[:8]}'
+    conn = psycopg.connect(dsn, autocommit=True)
+    conn.execute(f'create schema {schema}')
+    conn.execute(f'set search_path to {schema}')
+    conn.execute(USAGE_TABLE)
+    try: yield conn
+    finally:
+        conn.execute(f'drop schema {schema} cascade')
+        conn.close()
+
+def _migrate(conn)->None:
+    with open(MIGRATION) as f: conn.execute(f.read())
+    return
+
+def _connect(db):
+    # Another connection to the same schema, e.g. for concurrent callers
+    conn = psycopg.connect(db.info.dsn, password=db.info.password, autocommit=True)
+    conn.execute(f"set search_path to {db.execute('select current_schema()').fetchone()[0]}")
+    return conn
+
+def test_log_usage_increments_atomically(db):
+    _migrate(db)
+    user: str = str(uuid.uuid4())
+    threads: int = 8
+    calls: int = 25
+    counts: list[int] = []
+    lock = threading.Lock()
+
+    def log()->None:
+        with _connect(db) as conn:
+            for __ in range(calls):
+                used: int = conn.execute('select log_usage(%s, %s, %s)',
+                                         (user, 'askai', '{"problem": "mount escape"}')).fetchone()[0]
+                with lock: counts.append(used)
+        return
+
+    workers = [threading.Thread(target=log) for __ in range(threads)]
+    for worker in workers: worker.start()
+    for worker in workers: worker.join()
+    # Every call saw a distinct count, none were lost
+    assert sorted(counts)==list(range(1, threads*calls+1))
+    assert db.execute('select used from usage_counters where user_id=%s', (user,)).fetchone()[0]==threads*calls
+    assert db.execute('select count(*) from usage_metadata where user_id=%s', (user,)).fetchone()[0]==threads*calls
+
+def test_log_usage_without_metadata_only_counts(db):
+    _migrate(db)
+    user: str = str(uuid.uuid4())
+    assert db.execute('select log_usage(%s)', (user,)).fetchone()[0]==1
+    assert db.execute("select log_usage(%s, 'askai', null)", (user,)).fetchone()[0]==2
+    assert db.execute('select count(*) from usage_metadata').fetchone()[0]==0
+
+def test_usage_metadata_is_append_only(db):
+    _migrate(db)
+    db.execute('select log_usage(%s, %s, %s)', (str(uuid.uuid4()), 'askai', '{"problem": "guard pass"}'))
+    with pytest.raises(psycopg.errors.RaiseException, match='append-only'):
+        db.execute("update usage_metadata set metadata='{}'")
+    with pytest.raises(psycopg.errors.RaiseException, match='append-only'):
+        db.execute('delete from usage_metadata')
+    assert db.execute('select count(*) from usage_metadata').fetchone()[0]==1
+
+@pytest.mark.parametrize('timezone', ['UTC', 'Pacific/Kiritimati', 'America/Adak'])
+def test_period_matches_usage_period(db, timezone):
+    # Counted in the UTC month whatever the session's time zone,
+    # the same period get_usage reads
+    _migrate(db)
+    db.execute(f"set timezone to '{timezone}'")
+    user: str = str(uuid.uuid4())
+    db.execute('select log_usage(%s)', (user,))
+    period: date = db.execute('select period from usage_counters where user_id=%s', (user,)).fetchone()[0]
+    assert period.isoformat()==usage_period()
+
+def test_backfill_is_safe_to_rerun(db):
+    user: str = str(uuid.uuid4())
+    for __ in range(3):
+        db.execute("insert into usage (user_id, metadata) values (%s, '{\"problem\": \"back take\"}')", (user,))
+    _migrate(db)
+    assert db.execute('select used from usage_counters where user_id=%s', (user,)).fetchone()[0]==3
+    # Live uses after the migration aren't reset or duplicated by a re-run
+    db.execute('select log_usage(%s)', (user,))
+    _migrate(db)
+    assert db.execute('select used from usage_counters where user_id=%s', (user,)).fetchone()[0]==4
+    assert db.execute('select count(*) from usage_metadata').fetchone()[0]==3